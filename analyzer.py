@@ -4,6 +4,11 @@ import logging
 import time
 import base64
 import io
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import groupby
+from clustering import cluster_coords
+from merged import MergedIndex, range_ref
 
 # ================= ГЛОБАЛЬНЫЕ НАСТРОЙКИ ПО УМОЛЧАНИЮ =================
 DEFAULT_PARAMS = {
@@ -12,7 +17,8 @@ DEFAULT_PARAMS = {
     "MAX_CHARS_BLOCK": 3000,
     "MIN_TABLE_ROWS": 10,
     "VALIDATION_THRESHOLD": 0.98,
-    "SHOW_MERGED_MAP": True
+    "SHOW_MERGED_MAP": True,
+    "IMAGE_CONCURRENCY": 4
 }
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,22 +37,42 @@ class RobustExcelParser:
         self.params.update(kwargs)
 
     def _image_to_base64(self, img):
-        """Конвертация объекта изображения openpyxl в base64 string."""
+        """
+        Конвертация объекта изображения openpyxl в base64 string.
+        PNG/JPEG кодируются как есть, без PIL; остальные форматы — через PNG.
+        """
+        try:
+            raw_data = img._data()  # исходные байты картинки из пакета
+        except Exception:
+            raw_data = None
+        if raw_data and (raw_data.startswith(b"\x89PNG\r\n\x1a\n") or raw_data.startswith(b"\xff\xd8\xff")):
+            return base64.b64encode(raw_data).decode('utf-8')
         try:
             # Картинка лежит в img.ref (объект изображения)
             # В разных версиях openpyxl доступ может отличаться
             from PIL import Image
-            image = Image.open(img.ref)
+            image = Image.open(io.BytesIO(raw_data) if raw_data else img.ref)
             buffered = io.BytesIO()
             image.save(buffered, format="PNG")
             return base64.b64encode(buffered.getvalue()).decode('utf-8')
         except Exception as e:
-            # Если не получилось через PIL, пробуем прочитать байты напрямую, если это возможно
-            try:
-                raw_data = img._data() # Внутренний метод некоторых версий
+            if raw_data:
                 return base64.b64encode(raw_data).decode('utf-8')
+            return f"ERROR_LOADING_IMAGE: {str(e)}"
+
+    def _analyze_image(self, img, vlm_callback):
+        b64_str = self._image_to_base64(img)
+        analysis = vlm_callback(b64_str) if vlm_callback else "No VLM callback"
+
+        # Вместо объекта Anchor сохраняем строку, чтобы не было ошибки repr
+        anchor_pos = "Unknown"
+        if hasattr(img, 'anchor'):
+            # Обычно это объект TwoCellAnchor или OneCellAnchor
+            try:
+                anchor_pos = f"{get_column_letter(img.anchor._from.col + 1)}{img.anchor._from.row + 1}"
             except:
-                return f"ERROR_LOADING_IMAGE: {str(e)}"
+                anchor_pos = str(img.anchor)
+        return {"anchor": anchor_pos, "vlm_res": analysis}
 
     def parse_file(self, file_path: str, vlm_callback=None):
         start_time = time.time()
@@ -83,16 +109,11 @@ class RobustExcelParser:
 
     def _process_sheet(self, sheet, vlm_callback):
         sig_data = {}
-        merged_lookup = {}
-        
-        for rng in sheet.merged_cells.ranges:
-            for r in range(rng.min_row, rng.max_row + 1):
-                for c in range(rng.min_col, rng.max_col + 1):
-                    merged_lookup[(r, c)] = rng
+        merged = MergedIndex((r.min_row, r.min_col, r.max_row, r.max_col) for r in sheet.merged_cells.ranges)
 
         for row in sheet.iter_rows():
             for cell in row:
-                if self._is_significant(cell, (cell.row, cell.column) in merged_lookup):
+                if self._is_significant(cell, merged.lookup(cell.row, cell.column) is not None):
                     sig_data[(cell.row, cell.column)] = cell.value
 
         if not sig_data: return None
@@ -100,23 +121,9 @@ class RobustExcelParser:
         # Обработка изображений
         images_results = []
         if hasattr(sheet, '_images') and sheet._images:
-            for img in sheet._images:
-                b64_str = self._image_to_base64(img)
-                analysis = vlm_callback(b64_str) if vlm_callback else "No VLM callback"
-                
-                # Вместо объекта Anchor сохраняем строку, чтобы не было ошибки repr
-                anchor_pos = "Unknown"
-                if hasattr(img, 'anchor'):
-                    # Обычно это объект TwoCellAnchor или OneCellAnchor
-                    try:
-                        anchor_pos = f"{get_column_letter(img.anchor._from.col + 1)}{img.anchor._from.row + 1}"
-                    except:
-                        anchor_pos = str(img.anchor)
-
-                images_results.append({
-                    "anchor": anchor_pos,
-                    "vlm_res": analysis
-                })
+            # Картинки отправляются в VLM параллельно, порядок результатов сохраняется
+            with ThreadPoolExecutor(max_workers=self.params["IMAGE_CONCURRENCY"]) as pool:
+                images_results = list(pool.map(lambda img: self._analyze_image(img, vlm_callback), sheet._images))
 
         # Кластеризация
         clusters = self._cluster_regions(list(sig_data.keys()))
@@ -125,7 +132,7 @@ class RobustExcelParser:
         cells_covered = 0
         for cluster in clusters:
             cells_covered += len(cluster)
-            reg = self._analyze_region(sheet, cluster, sig_data, merged_lookup)
+            reg = self._analyze_region(sheet, cluster, sig_data, merged)
             regions.append(reg)
 
         coverage = cells_covered / len(sig_data)
@@ -139,52 +146,46 @@ class RobustExcelParser:
         }
 
     def _cluster_regions(self, coords):
-        coords_set = set(coords)
-        visited = set()
-        clusters = []
-        sorted_coords = sorted(coords)
-
-        for node in sorted_coords:
-            if node in visited: continue
-            cluster, queue = [], [node]
-            visited.add(node)
-            while queue:
-                r, c = queue.pop(0)
-                cluster.append((r, c))
-                for nr in range(r - self.params["V_TOLERANCE"], r + self.params["V_TOLERANCE"] + 1):
-                    for nc in range(c - self.params["H_TOLERANCE"], c + self.params["H_TOLERANCE"] + 1):
-                        neighbor = (nr, nc)
-                        if neighbor in coords_set and neighbor not in visited:
-                            visited.add(neighbor); queue.append(neighbor)
-            clusters.append(cluster)
-        return clusters
-
-    def _analyze_region(self, sheet, cluster_coords, sig_data, merged_lookup):
+        return cluster_coords(coords, self.params["V_TOLERANCE"], self.params["H_TOLERANCE"])
+
+    def _analyze_region(self, sheet, cluster_coords, sig_data, merged):
+        # Только ячейки кластера (он упорядочен row-major), без обхода всего bbox
         rows, cols = [c[0] for c in cluster_coords], [c[1] for c in cluster_coords]
         min_r, max_r, min_c, max_c = min(rows), max(rows), min(cols), max(cols)
-        
-        lines = []
-        for r in range(min_r, max_r + 1):
-            row_parts, skip_cols = [], set()
-            for c in range(min_c, max_c + 1):
-                if c in skip_cols: continue
-                coord = (r, c)
-                if coord in merged_lookup:
-                    m = merged_lookup[coord]
-                    if r == m.min_row and c == m.min_col:
+
+        lines, tail = [], None
+        n_lines, n_chars = 0, 0
+        for r, cells in groupby(cluster_coords, key=lambda coord: coord[0]):
+            row_parts = []
+            for coord in cells:
+                c = coord[1]
+                m = merged.lookup(r, c) if len(merged) else None
+                if m is not None:
+                    if r == m[0] and c == m[1]:
                         val = sig_data.get(coord, "")
-                        addr = str(m) if self.params["SHOW_MERGED_MAP"] else f"{get_column_letter(c)}{r}"
+                        addr = range_ref(m) if self.params["SHOW_MERGED_MAP"] else f"{get_column_letter(c)}{r}"
                         row_parts.append(f"[{addr}]: {str(val).strip()}")
-                    for col_idx in range(m.min_col, m.max_col + 1): skip_cols.add(col_idx)
-                else:
-                    val = sig_data.get(coord)
-                    if val is not None:
-                        row_parts.append(f"[{get_column_letter(c)}{r}]: {str(val).strip()}")
-            if row_parts: lines.append(" | ".join(row_parts))
-
-        is_table = len("\n".join(lines)) > self.params["MAX_CHARS_BLOCK"] and len(lines) > self.params["MIN_TABLE_ROWS"]
-        if is_table:
-            preview = "\n".join(lines[:5]) + f"\n... [SKIPPED {len(lines)-10} ROWS] ...\n" + "\n".join(lines[-5:])
+                    continue
+                val = sig_data.get(coord)
+                if val is not None:
+                    row_parts.append(f"[{get_column_letter(c)}{r}]: {str(val).strip()}")
+            if not row_parts: continue
+
+            line = " | ".join(row_parts)
+            n_chars += len(line) + (1 if n_lines else 0)
+            n_lines += 1
+            if tail is not None:
+                # Тип уже ясен (таблица): храним только первые и последние 5 строк
+                tail.append(line)
+                if len(lines) < 5: lines.append(line)
+                continue
+            lines.append(line)
+            if n_chars > self.params["MAX_CHARS_BLOCK"] and n_lines > self.params["MIN_TABLE_ROWS"]:
+                tail = deque(lines[-5:], maxlen=5)
+                del lines[5:]
+
+        if tail is not None:
+            preview = "\n".join(lines) + f"\n... [SKIPPED {n_lines-10} ROWS] ...\n" + "\n".join(tail)
             res_type = "data_table"
         else:
             preview = "\n".join(lines); res_type = "data_form"
@@ -0,0 +1,2 @@
+# Реализация — в xlsx_parser/clustering.py (одна копия на оба анализатора)
+from xlsx_parser.clustering import cluster_cells, cluster_coords, cluster_spans, label_segments  # noqa: F401
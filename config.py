@@ -23,4 +23,65 @@ OCR_GPU = os.getenv("OCR_GPU", "False").lower() == "true"
 
 LOG_FILE = "parsing.log"
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
-DEBUG_DIR = "debug_snapshots" # Папка для снапшотов страниц
\ No newline at end of file
+DEBUG_DIR = "debug_snapshots" # Папка для снапшотов страниц
+# Ремонт ответа LLM: сколько текстовых перезапросов (без картинки) допускается,
+# если локальный ремонт JSON не помог
+LLM_REPAIR_RETRIES = int(os.getenv("LLM_REPAIR_RETRIES", 1))
+
+# Склейка мелких страниц в один multi-image запрос
+COALESCE_IMAGES = os.getenv("COALESCE_IMAGES", "False").lower() == "true"
+COALESCE_MAX_IMAGES = int(os.getenv("COALESCE_MAX_IMAGES", 4))
+COALESCE_TOKEN_BUDGET = int(os.getenv("COALESCE_TOKEN_BUDGET", 6000))  # картинки + текст промпта
+COALESCE_SMALL_IMAGE_TOKENS = int(os.getenv("COALESCE_SMALL_IMAGE_TOKENS", 1000))
+
+# Двухуровневый режим: сначала страница уходит в низком разрешении,
+# в высоком — только если ответ неуверенный или расходится с текстовым слоем
+TIERED_MODE = os.getenv("TIERED_MODE", "False").lower() == "true"
+LOWRES_IMAGE_WIDTH = int(os.getenv("LOWRES_IMAGE_WIDTH", 512))
+TIER_CONFIDENCE_THRESHOLD = float(os.getenv("TIER_CONFIDENCE_THRESHOLD", 0.8))
+TIER_AGREEMENT_THRESHOLD = float(os.getenv("TIER_AGREEMENT_THRESHOLD", 0.6))
+# Порог для каждой сущности: одна неуверенная таблица среди уверенных абзацев средним не видна
+TIER_ENTITY_CONFIDENCE_FLOOR = float(os.getenv("TIER_ENTITY_CONFIDENCE_FLOOR", 0.6))
+
+# Тайлинг крупных/плотных страниц вместо пережатия до нечитаемого качества
+TILING_MODE = os.getenv("TILING_MODE", "False").lower() == "true"
+TILE_TRIGGER_PAGE_AREA = float(os.getenv("TILE_TRIGGER_PAGE_AREA", 1.5))  # в площадях A4
+TILE_TRIGGER_QUALITY = int(os.getenv("TILE_TRIGGER_QUALITY", 29))  # JPEG-качество, ниже которого страница "раздавлена"
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.08))  # доля перекрытия соседних тайлов
+TILE_MAX_TILES = int(os.getenv("TILE_MAX_TILES", 9))
+TILE_CONCURRENCY = int(os.getenv("TILE_CONCURRENCY", 4))
+
+# Таблицы из векторного слоя PDF (page.find_tables) до вызова VLM
+NATIVE_TABLES = os.getenv("NATIVE_TABLES", "True").lower() == "true"
+NATIVE_TABLE_MIN_FILL = float(os.getenv("NATIVE_TABLE_MIN_FILL", 0.3))  # минимальная доля непустых ячеек
+
+# PPTX: текст, таблицы и заметки из XML слайдов; в VLM — только слайды с графикой
+PPTX_NATIVE_EXTRACTION = os.getenv("PPTX_NATIVE_EXTRACTION", "True").lower() == "true"
+
+# Пул теплых конвертеров PPT/PPTX -> PDF (headless LibreOffice; теплый режим через UNO требует python3-uno)
+PPT_CONVERTER_POOL_SIZE = int(os.getenv("PPT_CONVERTER_POOL_SIZE", 2))
+PPT_CONVERTER_TIMEOUT = float(os.getenv("PPT_CONVERTER_TIMEOUT", 60))  # секунд на файл
+PPT_CONVERTER_MAX_JOBS = int(os.getenv("PPT_CONVERTER_MAX_JOBS", 50))  # перезапуск после N файлов (0 — без лимита)
+PPT_CONVERTER_MAX_RSS_MB = float(os.getenv("PPT_CONVERTER_MAX_RSS_MB", 1500))  # перезапуск при росте памяти (0 — без лимита)
+PPT_CONVERTER_BINARY = os.getenv("PPT_CONVERTER_BINARY", "")  # пусто — soffice/libreoffice из PATH
+PPT_CONVERTER_STUB = os.getenv("PPT_CONVERTER_STUB", "False").lower() == "true"  # заглушка без офиса (тесты)
+
+# Единая точка входа document_dispatcher.py: общий бюджет ресурсов для всех форматов
+DOC_CPU_WORKERS = int(os.getenv("DOC_CPU_WORKERS", max(1, (os.cpu_count() or 2) // 2)))  # одновременных задач
+DOC_LLM_CONCURRENCY = int(os.getenv("DOC_LLM_CONCURRENCY", 2))  # одновременных запросов к LLM от всех процессов
+DOC_LARGE_FILE_MB = float(os.getenv("DOC_LARGE_FILE_MB", 5))  # крупные файлы идут в отдельную полосу очереди
+DOC_RESULT_CACHE_DIR = os.getenv("DOC_RESULT_CACHE_DIR", "doc_cache")  # пусто — без кэша результатов
+DOC_CACHE_VERSION = 1  # увеличить при изменении кода пайплайнов: старые результаты кэша станут недоступны
+
+# Очередь запросов к LLM: первыми идут дешевые (shortest-job-first), дорогие не голодают за счет старения
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 4))  # одновременных запросов процесса (0 — без очереди)
+LLM_AGING_TOKENS_PER_SEC = float(os.getenv("LLM_AGING_TOKENS_PER_SEC", 500))  # удешевление ожидающего запроса в секунду
+LLM_DECODE_WEIGHT = float(os.getenv("LLM_DECODE_WEIGHT", 8))  # токен ответа дороже токена промпта
+LLM_EXPECTED_OUTPUT_BASE = int(os.getenv("LLM_EXPECTED_OUTPUT_BASE", 150))  # токенов ответа на картинку
+LLM_EXPECTED_OUTPUT_RATIO = float(os.getenv("LLM_EXPECTED_OUTPUT_RATIO", 1.2))  # ответ пересказывает текст подсказок
+PAGE_CONCURRENCY = int(os.getenv("PAGE_CONCURRENCY", 8))  # страниц, одновременно ожидающих ответа LLM
+
+# Запись результатов (serializer.py): json — через orjson, если он установлен; msgpack — бинарный
+# формат для передачи между этапами и сервисами (без пакета msgpack — откат на json)
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "json")
+RESULT_COMPACT = os.getenv("RESULT_COMPACT", "True").lower() == "true"  # без отступов
@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+import resource_budget
+
+# Модули config/llm_client/prompts/analyzer есть и в корне, и в xlsx_parser,
+# поэтому форматы обрабатываются в разных пулах процессов со своим sys.path.
+# Здесь на уровне модуля нельзя импортировать config: воркер xlsx подгрузит корневой.
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+XLSX_DIR = os.path.join(ROOT_DIR, "xlsx_parser")
+PPTX_DIR = os.path.join(ROOT_DIR, "pptx_parser")
+
+FORMATS = {".pdf": "pdf", ".xlsx": "xlsx", ".xlsm": "xlsx", ".pptx": "presentation", ".ppt": "presentation"}
+FAMILIES = {"pdf": "root", "presentation": "root", "xlsx": "xlsx"}
+
+logger = logging.getLogger("DocumentDispatcher")
+
+
+def detect_format(file_path: str) -> Optional[str]:
+    return FORMATS.get(os.path.splitext(file_path)[1].lower())
+
+
+def file_digest(file_path: str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def pipeline_version() -> str:
+    """
+    Версия настроек пайплайнов для ключа кэша результатов: значения корневого config
+    (с учетом переменных окружения) и исходники config/prompts обоих семейств.
+    Настройки самого диспетчера (DOC_*) на результат не влияют и не учитываются.
+    """
+    import config
+    settings = {name: value for name, value in vars(config).items() if name.isupper() and not name.startswith("DOC_")}
+    settings["DOC_CACHE_VERSION"] = config.DOC_CACHE_VERSION
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False, default=repr).encode("utf-8"))
+    for folder in (ROOT_DIR, XLSX_DIR):
+        for name in ("config.py", "prompts.py"):
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def output_name(file_path: str) -> str:
+    """Имя результата файла: основа и расширение (deck.pdf и deck.pptx не совпадают)."""
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    return f"{stem}_{ext.lstrip('.').lower()}" if ext else stem
+
+
+def output_path(kind: str, file_path: str, output_dir: str, fmt: str = "json") -> str:
+    """Куда пайплайн формата пишет итоговый результат (расширение — по формату записи)."""
+    from serializer import result_path
+    if kind == "xlsx":
+        # Папка книги — как workbook_dirname в xlsx_parser/analyzer.py
+        return result_path(os.path.join(output_dir, output_name(file_path), "final_results.json"), fmt)
+    return result_path(os.path.join(output_dir, f"{output_name(file_path)}.json"), fmt)
+
+
+# --- процессы-воркеры ---
+
+def _init_worker(family: str, llm_semaphore, output_dir: str, temp_root: str):
+    """Настройка процесса пула: пути модулей, общий семафор LLM, своя временная папка."""
+    if family == "xlsx":
+        sys.path.insert(0, XLSX_DIR)
+        # Вложенный пул сегментации отнимал бы ядра у соседних задач
+        os.environ["XLSX_SHEET_WORKERS"] = "0"
+    else:
+        sys.path.append(PPTX_DIR)
+        os.environ["OUTPUT_DIR"] = output_dir
+        os.environ["PPT_CONVERTER_POOL_SIZE"] = "1"
+    resource_budget.install(llm_semaphore)
+    # Временные файлы всех пайплайнов воркера — внутри общей папки запуска
+    tempfile.tempdir = tempfile.mkdtemp(prefix=f"{family}_", dir=temp_root)
+
+
+def _run_pdf(file_path: str, output_dir: str, fmt: str) -> Tuple[str, List[str]]:
+    from main import run_pipeline
+    path = output_path("pdf", file_path, output_dir, fmt)
+    summary = run_pipeline(file_path, path) or {}
+    problems = [f"страница {n} без результата" for n in summary.get("missing_pages", [])]
+    return path, problems
+
+
+def _run_xlsx(file_path: str, output_dir: str, fmt: str) -> Tuple[str, List[str]]:
+    from dispatcher import ExcelProcessingDispatcher
+    dispatcher = ExcelProcessingDispatcher(output_dir=output_dir)
+    try:
+        result = asyncio.run(dispatcher.process_file_workflow(file_path))
+    finally:
+        dispatcher.parser.close()
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError(result["error"])
+    problems = [f"лист '{title}': ошибка разбора" for title, report in (result or {}).items()
+                if isinstance(report, dict) and "error" in report]
+    problems += [f"лист '{title}': нет оценки LLM или скорера" for title in dispatcher.undecided_sheets]
+    return output_path("xlsx", file_path, output_dir, fmt), problems
+
+
+def _render_pdf_pages(pdf_path: str, debug_folder: str) -> Tuple[List[Dict], int]:
+    """
+    Страницы PDF через пайплайн страниц: ([{"page", "extraction"}], число страниц);
+    страницы без ответа пропускаются.
+    """
+    import fitz
+    from main import process_single_page
+    from ocr_engine import OCRManager
+
+    ocr_manager = OCRManager()
+    rendered = []
+    with fitz.open(pdf_path) as doc:
+        for i, page in enumerate(doc):
+            extraction = process_single_page(page, i, ocr_manager, debug_folder)
+            if extraction:
+                rendered.append({"page": i + 1, "extraction": extraction})
+        return rendered, doc.page_count
+
+
+def _run_presentation(file_path: str, output_dir: str, fmt: str) -> Tuple[str, List[str]]:
+    """
+    PPTX: текстовые слайды — из XML, слайды с графикой — через PDF и пайплайн страниц
+    (та же сборка, что в pptx_parser). PPT и нестандартные пакеты конвертируются целиком.
+    """
+    from config import DEBUG_DIR, PPTX_NATIVE_EXTRACTION, RESULT_COMPACT
+    from converter_pool import get_converter_pool
+    from image_utils import prepare_output_folders
+    from serializer import write_result
+    from slides import degraded_slides, load_slides, log_render_failure, merge_rendered, split_slides, \
+        visual_subset_pdf
+
+    slides = None
+    if PPTX_NATIVE_EXTRACTION and file_path.lower().endswith(".pptx"):
+        slides = load_slides(file_path)
+
+    results, visual, rendered, expected = {}, [], [], None
+    if slides is not None:
+        results, visual = split_slides(slides)
+        expected = len(slides)
+
+    if slides is None or visual:
+        debug_folder = os.path.join(DEBUG_DIR, output_name(file_path))
+        prepare_output_folders(debug_folder, output_dir)
+        pdf_path, subset_path = None, None
+        try:
+            if slides is None:
+                # Без XML-разбора запасного результата нет: ошибка конвертации — ошибка файла
+                pdf_path = get_converter_pool().convert_sync(file_path)
+                rendered, expected = _render_pdf_pages(pdf_path, debug_folder)
+            else:
+                try:
+                    pdf_path = get_converter_pool().convert_sync(file_path)
+                    subset_path = visual_subset_pdf(pdf_path, visual)
+                except Exception as e:
+                    log_render_failure(file_path, e)
+                if subset_path:
+                    rendered, _ = _render_pdf_pages(subset_path, debug_folder)
+        finally:
+            for path in (pdf_path, subset_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    pages = merge_rendered(results, visual, rendered) if slides is not None else rendered
+    problems = [f"слайдов без результата: {expected - len(pages)}"] if len(pages) < expected else []
+    degraded = degraded_slides(pages)
+    if degraded:
+        problems.append(f"слайды без разбора графики (только текст из XML): {degraded}")
+    path = write_result(output_path("presentation", file_path, output_dir, fmt), pages, fmt, RESULT_COMPACT)
+    return path, problems
+
+
+_RUNNERS = {"pdf": _run_pdf, "xlsx": _run_xlsx, "presentation": _run_presentation}
+
+
+def _run_job(kind: str, file_path: str, output_dir: str, fmt: str) -> Dict:
+    """
+    Обработка файла в воркере. status: ok — результат полный; degraded — результат
+    записан, но часть страниц или листов не обработана (в кэш такой не попадает).
+    """
+    started = time.monotonic()
+    report = {"file": file_path, "format": kind}
+    # Старый результат не удаляется: по отметке времени он не сойдет за новый
+    expected = output_path(kind, file_path, output_dir, fmt)
+    stale = os.path.getmtime(expected) if os.path.exists(expected) else None
+    resource_budget.queue_stats(reset=True)
+    try:
+        path, problems = _RUNNERS[kind](file_path, output_dir, fmt)
+        if not os.path.exists(path) or (path == expected and os.path.getmtime(path) == stale):
+            report.update(status="error", error="pipeline produced no result")
+        elif problems:
+            report.update(status="degraded", output=path, problems=problems)
+        else:
+            report.update(status="ok", output=path)
+    except Exception as e:
+        report.update(status="error", error=f"{type(e).__name__}: {e}")
+    report["seconds"] = round(time.monotonic() - started, 2)
+    report["llm_queue"] = resource_budget.queue_stats(reset=True)
+    if kind == "presentation":
+        from converter_pool import converter_metrics
+        report["converter"] = converter_metrics(reset=True)
+    return report
+
+
+# --- планировщик ---
+
+class DocumentDispatcher:
+    """
+    Единая точка входа для PDF, XLSX и PPT/PPTX. Все форматы делят:
+    - бюджет CPU: одновременно выполняется не больше cpu_workers задач;
+    - бюджет LLM: межпроцессный семафор на запросы к серверу модели;
+    - кэш результатов по хэшу содержимого файла и версии настроек пайплайнов.
+    Мелкие файлы идут первыми; крупные идут своей полосой: пока мелкие ждут,
+    им достается от одного до cpu_workers - 1 слотов (при одном воркере — ни одного).
+    """
+
+    def __init__(self, output_dir: Optional[str] = None, cpu_workers: Optional[int] = None,
+                 llm_concurrency: Optional[int] = None, cache_dir: Optional[str] = None,
+                 large_file_mb: Optional[float] = None):
+        import config
+        self.output_dir = os.path.abspath(output_dir or config.OUTPUT_DIR)
+        self.result_format = config.RESULT_FORMAT  # пайплайны в воркерах читают ту же переменную окружения
+        self.cpu_workers = max(1, cpu_workers or config.DOC_CPU_WORKERS)
+        self.cache_dir = config.DOC_RESULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.large_bytes = (large_file_mb or config.DOC_LARGE_FILE_MB) * 1024 * 1024
+        self._ctx = mp.get_context("spawn")
+        self._llm_semaphore = self._ctx.BoundedSemaphore(max(1, llm_concurrency or config.DOC_LLM_CONCURRENCY))
+        self._temp_root = tempfile.mkdtemp(prefix="docdispatch_")
+        self._pools: Dict[str, ProcessPoolExecutor] = {}
+        self.version = pipeline_version() if self.cache_dir else ""
+
+    def _pool(self, family: str) -> ProcessPoolExecutor:
+        if family not in self._pools:
+            self._pools[family] = ProcessPoolExecutor(
+                max_workers=self.cpu_workers, mp_context=self._ctx, initializer=_init_worker,
+                initargs=(family, self._llm_semaphore, self.output_dir, self._temp_root),
+            )
+        return self._pools[family]
+
+    # --- кэш ---
+
+    def _cache_path(self, job: Dict) -> str:
+        from serializer import result_path
+        name = f"{job['format']}_{job['digest']}_{self.version}.json"
+        return result_path(os.path.join(self.cache_dir, name), self.result_format)
+
+    def _from_cache(self, job: Dict) -> Optional[Dict]:
+        if not self.cache_dir or not os.path.exists(self._cache_path(job)):
+            return None
+        target = output_path(job["format"], job["file"], self.output_dir, self.result_format)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(self._cache_path(job), target)
+        return {"file": job["file"], "format": job["format"], "status": "ok", "output": target,
+                "seconds": 0.0, "from_cache": True}
+
+    def _store_cache(self, job: Dict, report: Dict):
+        # Только полный результат: degraded (LLM недоступна, листы без оценки) закрепился бы навсегда
+        if not self.cache_dir or report["status"] != "ok":
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._cache_path(job)}.{os.getpid()}.tmp"
+        shutil.copyfile(report["output"], tmp_path)
+        os.replace(tmp_path, self._cache_path(job))
+
+    # --- очередь ---
+
+    def _next_job(self, small: deque, large: deque, running: Dict) -> Optional[Dict]:
+        large_running = sum(1 for job in running.values() if job["large"])
+        if large and large_running < (self.cpu_workers - 1 if small else self.cpu_workers) \
+                and (large_running == 0 or not small):
+            return large.popleft()
+        if small:
+            return small.popleft()
+        return None
+
+    def run(self, files: List[str]) -> List[Dict]:
+        reports: List[Dict] = []
+        small, large = deque(), deque()
+        owners: Dict[str, str] = {}  # путь результата -> файл, которому он достался
+        for file_path in files:
+            kind = detect_format(file_path)
+            if kind is None:
+                reports.append({"file": file_path, "format": None, "status": "unsupported", "seconds": 0.0})
+                continue
+            # Одноименные файлы из разных каталогов записали бы один результат поверх другого
+            target = os.path.normcase(output_path(kind, file_path, self.output_dir, self.result_format))
+            if target in owners:
+                reports.append({"file": file_path, "format": kind, "status": "duplicate", "seconds": 0.0,
+                                "error": f"результат совпадает с {owners[target]}"})
+                logger.warning(f"⚠️ {file_path}: результат совпадает с {owners[target]}, файл пропущен")
+                continue
+            owners[target] = file_path
+            size = os.path.getsize(file_path)
+            job = {"file": file_path, "format": kind, "large": size >= self.large_bytes,
+                   "digest": file_digest(file_path) if self.cache_dir else None}
+            cached = self._from_cache(job) if self.cache_dir else None
+            if cached:
+                logger.info(f"♻️ {file_path}: результат из кэша")
+                reports.append(cached)
+                continue
+            (large if job["large"] else small).append(job)
+
+        running = {}  # future -> задача
+        while small or large or running:
+            while len(running) < self.cpu_workers:
+                job = self._next_job(small, large, running)
+                if job is None:
+                    break
+                future = self._pool(FAMILIES[job["format"]]).submit(
+                    _run_job, job["format"], job["file"], self.output_dir, self.result_format
+                )
+                running[future] = job
+                logger.info(f"▶️ {job['file']} ({job['format']}{', крупный' if job['large'] else ''})")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    report = future.result()
+                except BrokenProcessPool as e:
+                    # Упавший воркер ломает весь пул семейства — следующий будет создан заново
+                    self._pools.pop(FAMILIES[job["format"]], None)
+                    report = {"file": job["file"], "format": job["format"], "status": "crashed",
+                              "error": str(e), "seconds": 0.0}
+                self._store_cache(job, report)
+                reports.append(report)
+                icon = {"ok": "✅", "degraded": "⚠️"}.get(report["status"], "❌")
+                logger.info(f"{icon} {job['file']}: {report['status']} за {report['seconds']} с")
+        return reports
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
+        self._pools.clear()
+        shutil.rmtree(self._temp_root, ignore_errors=True)
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if detect_format(name) and not name.startswith("~$")
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def summarize(reports: List[Dict], elapsed: float) -> Dict:
+    statuses: Dict[str, int] = {}
+    formats: Dict[str, int] = {}
+    for r in reports:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+        formats[str(r["format"])] = formats.get(str(r["format"]), 0) + 1
+    return {
+        "files": len(reports),
+        "elapsed_sec": round(elapsed, 2),
+        "files_per_min": round(len(reports) / elapsed * 60, 2) if elapsed else 0.0,
+        "statuses": statuses,
+        "formats": formats,
+        "from_cache": sum(1 for r in reports if r.get("from_cache")),
+        "failed": [r for r in reports if r["status"] != "ok"],
+    }
+
+
+def main():
+    import config
+    import utils  # noqa: F401 — настройка логирования в консоль и parsing.log
+
+    parser = argparse.ArgumentParser(description="Парсинг PDF, XLSX и PPT/PPTX с общим бюджетом ресурсов")
+    parser.add_argument("paths", nargs="+", help="файлы или каталоги")
+    parser.add_argument("--output", default=config.OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=config.DOC_CPU_WORKERS)
+    parser.add_argument("--llm-concurrency", type=int, default=config.DOC_LLM_CONCURRENCY)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    files = collect_files(args.paths)
+    logger.info(f"📂 {len(files)} файлов, воркеров: {args.workers}, запросов к LLM: {args.llm_concurrency}")
+    dispatcher = DocumentDispatcher(args.output, args.workers, args.llm_concurrency,
+                                    cache_dir="" if args.no_cache else None)
+    start = time.monotonic()
+    try:
+        reports = dispatcher.run(files)
+    finally:
+        dispatcher.close()
+    summary = summarize(reports, time.monotonic() - start)
+
+    os.makedirs(dispatcher.output_dir, exist_ok=True)
+    with open(os.path.join(dispatcher.output_dir, "dispatch_report.json"), "w", encoding="utf-8") as f:
+        json.dump({**summary, "reports": reports}, f, ensure_ascii=False, indent=2)
+    logger.info(f"🏁 {summary['files']} файлов за {summary['elapsed_sec']} с, статусы: {summary['statuses']}")
+    for r in summary["failed"]:
+        logger.error(f"❌ {r['file']}: {r.get('error') or r.get('problems') or r['status']}")
+
+
+if __name__ == "__main__":
+    main()
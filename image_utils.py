@@ -2,12 +2,13 @@ import io
 import os
 import base64
 import shutil
+from typing import Tuple
 from PIL import Image, ImageOps
 from utils import logger, timer, get_base64_size_kb
 from config import TARGET_IMAGE_KB, MAX_IMAGE_WIDTH
 
-def process_and_compress_image(image_bytes: bytes) -> str:
-    """Сжатие изображения для входа Vision LLM."""
+def compress_image_with_quality(image_bytes: bytes, max_width: int = MAX_IMAGE_WIDTH) -> Tuple[str, int]:
+    """Сжатие изображения для входа Vision LLM. Возвращает (base64, итоговое качество JPEG)."""
     with timer("Сжатие"):
         img = Image.open(io.BytesIO(image_bytes))
         img = ImageOps.exif_transpose(img)
@@ -15,9 +16,9 @@ def process_and_compress_image(image_bytes: bytes) -> str:
             img = img.convert('RGB')
 
         w, h = img.size
-        if w > MAX_IMAGE_WIDTH:
-            new_h = int(h * (MAX_IMAGE_WIDTH / w))
-            img = img.resize((MAX_IMAGE_WIDTH, new_h), Image.Resampling.LANCZOS)
+        if w > max_width:
+            new_h = int(h * (max_width / w))
+            img = img.resize((max_width, new_h), Image.Resampling.LANCZOS)
 
         quality = 85
         output = io.BytesIO()
@@ -28,7 +29,11 @@ def process_and_compress_image(image_bytes: bytes) -> str:
             output = io.BytesIO()
             img.save(output, format="JPEG", quality=quality)
         
-        return base64.b64encode(output.getvalue()).decode("utf-8")
+        return base64.b64encode(output.getvalue()).decode("utf-8"), quality
+
+def process_and_compress_image(image_bytes: bytes, max_width: int = MAX_IMAGE_WIDTH) -> str:
+    """Сжатие изображения для входа Vision LLM."""
+    return compress_image_with_quality(image_bytes, max_width)[0]
 
 def prepare_output_folders(debug_folder: str, output_dir: str):
     """Пересоздает папку снапшотов и проверяет папку результатов."""
@@ -43,3 +48,12 @@ def save_snapshot(b64_str: str, page_num: int, folder: str):
     path = os.path.join(folder, f"page_{page_num + 1}.jpg")
     with open(path, "wb") as f:
         f.write(img_data)
+
+def estimate_image_tokens(b64_str: str, patch_px: int = 28) -> int:
+    """
+    Оценка числа визуальных токенов: Qwen2.5-VL отдает один токен
+    на блок 28x28 пикселей. Читается только заголовок картинки.
+    """
+    with Image.open(io.BytesIO(base64.b64decode(b64_str))) as img:
+        w, h = img.size
+    return -(-w // patch_px) * -(-h // patch_px)
@@ -1,9 +1,15 @@
 import requests
-import json
-import re
-from typing import Optional, Dict
-from utils import logger
-from config import GEMMA_ENDPOINT, GEMMA_MODEL, LLM_TIMEOUT, API_TOKEN, LLM_ENDPOINT, LLM_MODEL
+from typing import Optional, Dict, List
+from utils import logger, estimate_text_tokens
+from config import (GEMMA_ENDPOINT, GEMMA_MODEL, LLM_TIMEOUT, API_TOKEN, LLM_ENDPOINT, LLM_MODEL, LLM_REPAIR_RETRIES,
+                    LLM_CONCURRENCY, LLM_AGING_TOKENS_PER_SEC, LLM_DECODE_WEIGHT, LLM_EXPECTED_OUTPUT_BASE,
+                    LLM_EXPECTED_OUTPUT_RATIO)
+from image_utils import estimate_image_tokens
+from llm_output import parse_layout_response, parse_llm_json, split_batch_response
+from prompts import get_repair_prompt
+from resource_budget import configure, llm_slot
+
+configure(LLM_CONCURRENCY, LLM_AGING_TOKENS_PER_SEC)
 
 # def call_gemma_sync(prompt: str, image_b64: str) -> Optional[Dict]:
 #     """Отправляет запрос к Vision модели и парсит JSON ответ."""
@@ -50,68 +56,136 @@ from config import GEMMA_ENDPOINT, GEMMA_MODEL, LLM_TIMEOUT, API_TOKEN, LLM_ENDP
 #         logger.error(f"Ошибка при обращении к LLM: {e}")
 #         return None
 
-def call_gemma_sync(prompt: str, image_b64: str) -> Optional[Dict]:
+def request_cost(prompt: str, images_b64: List[str] = ()) -> float:
     """
-    Вызов Qwen2.5-VL через llama-server (OpenAI-совместимый API).
+    Оценка стоимости запроса в токенах промпта для очереди LLM: текст, картинки
+    и ожидаемый ответ с весом декодирования. Layout-ответ пересказывает текст
+    OCR-подсказок и текстового слоя, поэтому растет вместе с промптом.
     """
-    print("\n" + "="*60)
-    print("--- ОТПРАВЛЯЕМЫЙ ПРОМПТ ---")
-    print(prompt)
-    print("="*60 + "\n")
+    prompt_tokens = estimate_text_tokens(prompt)
+    image_tokens = sum(estimate_image_tokens(b64) for b64 in images_b64)
+    expected_output = LLM_EXPECTED_OUTPUT_BASE * max(1, len(images_b64)) + LLM_EXPECTED_OUTPUT_RATIO * prompt_tokens
+    return prompt_tokens + image_tokens + LLM_DECODE_WEIGHT * expected_output
 
-    # Формируем структуру сообщений для Vision-модели в llama.cpp
+def _post_chat(content, cost: float = 0.0, label: str = "") -> str:
+    """Отправляет chat-запрос в llama-server и возвращает текст ответа."""
     payload = {
         "model": LLM_MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text", 
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_b64}"
-                        }
-                    }
-                ]
-            }
-        ],
+        "messages": [{"role": "user", "content": content}],
         "temperature": 0.0,
         "stream": False,
-        # Важно: llama.cpp может игнорировать "format": "json" в чат-режиме, 
-        # поэтому мы полагаемся на наш Regex в парсинге.
+        # Важно: llama.cpp может игнорировать "format": "json" в чат-режиме,
+        # поэтому мы полагаемся на локальный парсинг и ремонт ответа.
     }
-
-    try:
+    with llm_slot(cost, label):
         response = requests.post(
-            LLM_ENDPOINT, 
-            json=payload, 
+            LLM_ENDPOINT,
+            json=payload,
             timeout=LLM_TIMEOUT,
             headers={"Content-Type": "application/json"}
         )
+    try:
         response.raise_for_status()
-        
-        # В OpenAI формате ответ лежит в choices[0].message.content
-        res_data = response.json()
-        full_text = res_data['choices'][0]['message']['content']
-        
-        # Логируем ответ для отладки
-        logger.debug(f"Raw LLM Response: {full_text}")
-
-        # Извлечение JSON из текста (Qwen часто оборачивает в ```json ... ```)
-        match = re.search(r'(\{.*\}|\[.*\])', full_text, re.DOTALL)
-        if match:
-            clean_json = match.group(1)
-            return json.loads(clean_json)
-        
-        logger.error("JSON не найден в ответе Qwen")
-        return None
+    except requests.HTTPError:
+        logger.error(f"Ответ сервера: {response.text}")
+        raise
+    # В OpenAI формате ответ лежит в choices[0].message.content
+    return response.json()['choices'][0]['message']['content']
+
+def _repair_with_llm(broken_text: str, errors: List[str]) -> Optional[Dict]:
+    """Текстовый перезапрос только на исправление JSON — без повторной отправки картинки."""
+    for attempt in range(1, LLM_REPAIR_RETRIES + 1):
+        logger.warning(f"Ремонт ответа через LLM (попытка {attempt}): {'; '.join(errors[:5])}")
+        try:
+            repair_prompt = get_repair_prompt(broken_text, errors)
+            fixed_text = _post_chat(repair_prompt, request_cost(repair_prompt), "ремонт JSON")
+        except Exception as e:
+            logger.error(f"Ошибка при ремонте ответа: {e}")
+            return None
+        result, errors, _ = parse_layout_response(fixed_text)
+        if result is not None and not errors:
+            return result
+        broken_text = fixed_text
+    return None
 
+def call_gemma_sync(prompt: str, image_b64: str, label: str = "") -> Optional[Dict]:
+    """
+    Вызов Qwen2.5-VL через llama-server (OpenAI-совместимый API).
+    Ответ проверяется по схеме layout-промпта; битый JSON чинится локально,
+    и только если это не помогло — текстовым перезапросом без картинки.
+    """
+    print("\n" + "="*60)
+    print("--- ОТПРАВЛЯЕМЫЙ ПРОМПТ ---")
+    print(prompt)
+    print("="*60 + "\n")
+
+    # Формируем структуру сообщений для Vision-модели в llama.cpp
+    content = [
+        {
+            "type": "text",
+            "text": prompt
+        },
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{image_b64}"
+            }
+        }
+    ]
+
+    try:
+        full_text = _post_chat(content, request_cost(prompt, [image_b64]), label)
     except Exception as e:
         logger.error(f"Ошибка при вызове llama-server: {e}")
-        if 'response' in locals():
-            logger.error(f"Ответ сервера: {response.text}")
         return None
+
+    # Логируем ответ для отладки
+    logger.debug(f"Raw LLM Response: {full_text}")
+
+    result, errors, repaired = parse_layout_response(full_text)
+    if result is not None and not errors:
+        if repaired:
+            logger.info("🩹 JSON ответа исправлен локально")
+        return result
+
+    fixed = _repair_with_llm(full_text, errors)
+    if fixed is not None:
+        return fixed
+
+    # Частично валидный ответ лучше, чем потерянная страница
+    if isinstance(result, dict) and isinstance(result.get("entities"), list):
+        logger.warning(f"Ответ не прошел валидацию, сохраняем как есть: {'; '.join(errors[:5])}")
+        return result
+    logger.error("JSON не найден в ответе Qwen")
+    return None
+
+def call_gemma_batch_sync(prompt: str, images_b64: List[str], label: str = "") -> List[Optional[Dict]]:
+    """
+    Один multi-image запрос на несколько мелких страниц.
+    Возвращает результаты в порядке картинок; None — элемент не получен
+    или не прошел валидацию (вызывающий код отправляет его отдельным запросом).
+    """
+    print("\n" + "="*60)
+    print(f"--- ОТПРАВЛЯЕМЫЙ ПРОМПТ (пакет из {len(images_b64)} изображений) ---")
+    print(prompt)
+    print("="*60 + "\n")
+
+    content = [{"type": "text", "text": prompt}]
+    content += [
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}
+        for b64 in images_b64
+    ]
+
+    try:
+        full_text = _post_chat(content, request_cost(prompt, images_b64), label)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном вызове llama-server: {e}")
+        return [None] * len(images_b64)
+
+    logger.debug(f"Raw LLM Batch Response: {full_text}")
+    obj, _ = parse_llm_json(full_text)
+    results = split_batch_response(obj, len(images_b64))
+    missing = sum(r is None for r in results)
+    if missing:
+        logger.warning(f"Пакетный ответ: {missing} из {len(images_b64)} элементов не получены")
+    return results
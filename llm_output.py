@@ -0,0 +1,304 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Схема сущностей из prompts.get_layout_prompt
+ENTITY_TYPES = {"text_block", "table", "diagram_or_chart", "figure", "form"}
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_LABEL_KEYS = ("text", "label", "name", "value", "title")
+
+
+def extract_json_text(text: str) -> Optional[str]:
+    """Вырезает JSON-фрагмент из ответа модели (снимает ```json ... ``` и текст вокруг)."""
+    if not text:
+        return None
+    fence = _FENCE_RE.search(text)
+    if fence:
+        text = fence.group(1)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return None
+    return text[min(starts):].strip()
+
+
+def _drop_trailing_comma(out: List[str]):
+    """Убирает висящую запятую (и пробелы после нее) перед закрывающей скобкой."""
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i:]
+
+
+def repair_json_text(text: str) -> str:
+    """
+    Локальный ремонт JSON: висящие запятые, хвост после закрытия корня,
+    оборванные строки и незакрытые массивы/объекты (обрыв генерации по лимиту токенов).
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    # Точки безопасного обрыва: позиция в out и стек скобок на этот момент
+    safe_points: List[Tuple[int, List[str]]] = []
+    in_str = escape = False
+
+    for ch in text:
+        if in_str:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_str = False
+            continue
+
+        if ch == '"':
+            in_str = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+            safe_points.append((len(out), stack.copy()))
+        elif ch in "}]":
+            if not stack or stack[-1] != ch:
+                continue  # лишняя/чужая скобка
+            _drop_trailing_comma(out)
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break  # корень закрыт, остальное — мусор
+        elif ch == ",":
+            _drop_trailing_comma(out)
+            safe_points.append((len(out), stack.copy()))
+            out.append(ch)
+        else:
+            out.append(ch)
+
+    if not stack:
+        return "".join(out)
+
+    # Ответ оборван: сначала пробуем просто закрыть строку и скобки
+    tail = list(out)
+    if in_str:
+        if escape:
+            tail.pop()
+        tail.append('"')
+    _drop_trailing_comma(tail)
+    candidate = "".join(tail) + "".join(reversed(stack))
+    try:
+        json.loads(candidate)
+        return candidate
+    except json.JSONDecodeError:
+        pass
+
+    # Иначе откатываемся к последнему целому элементу
+    for pos, st in reversed(safe_points[-8:]):
+        head = out[:pos]
+        _drop_trailing_comma(head)
+        candidate = "".join(head) + "".join(reversed(st))
+        try:
+            json.loads(candidate)
+            return candidate
+        except json.JSONDecodeError:
+            continue
+    return candidate
+
+
+def parse_llm_json(text: str) -> Tuple[Optional[Any], bool]:
+    """
+    Парсит ответ модели. Возвращает (объект, был_ли_ремонт).
+    Сначала строгий json, затем локальный ремонт.
+    """
+    fragment = extract_json_text(text)
+    if fragment is None:
+        return None, False
+    try:
+        obj, _ = json.JSONDecoder().raw_decode(fragment)
+        return obj, False
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json_text(fragment)), True
+    except json.JSONDecodeError:
+        return None, True
+
+
+def _label_to_str(label: Any) -> str:
+    if isinstance(label, dict):
+        for key in _LABEL_KEYS:
+            if isinstance(label.get(key), str) and label[key].strip():
+                return label[key]
+        return " ".join(str(v) for v in label.values() if v not in (None, ""))
+    if isinstance(label, list):
+        return " ".join(_label_to_str(x) for x in label)
+    return "" if label is None else str(label)
+
+
+def _to_confidence(value: Any) -> Optional[float]:
+    try:
+        conf = float(str(value).strip().rstrip("%"))
+    except (TypeError, ValueError):
+        return None
+    if conf > 1.0:
+        conf /= 100.0
+    return max(0.0, min(1.0, conf))
+
+
+def normalize_layout(obj: Any) -> Any:
+    """Приводит ответ к схеме layout-промпта там, где это можно сделать без модели."""
+    if isinstance(obj, list):
+        obj = {"metadata": {}, "entities": obj}
+    if not isinstance(obj, dict):
+        return obj
+    if not isinstance(obj.get("metadata"), dict):
+        obj["metadata"] = {}
+    entities = obj.get("entities")
+    if isinstance(entities, dict):
+        entities = [entities]
+    if not isinstance(entities, list):
+        return obj
+
+    for idx, ent in enumerate(entities, start=1):
+        if not isinstance(ent, dict):
+            continue
+        ent.setdefault("id", f"E{idx}")
+        if "confidence" in ent:
+            conf = _to_confidence(ent["confidence"])
+            if conf is not None:
+                ent["confidence"] = conf
+        data = ent.get("data")
+        if not isinstance(data, dict):
+            continue
+        labels = data.get("extracted_labels")
+        if isinstance(labels, (str, dict)):
+            labels = [labels]
+        if isinstance(labels, list):
+            data["extracted_labels"] = [s for s in (_label_to_str(x) for x in labels) if s]
+        rows = data.get("rows")
+        if isinstance(rows, list):
+            data["rows"] = [r if isinstance(r, list) else [r] for r in rows]
+    obj["entities"] = entities
+    return obj
+
+
+def validate_layout(obj: Any) -> List[str]:
+    """Быстрая проверка схемы. Пустой список — ответ пригоден."""
+    if not isinstance(obj, dict):
+        return ["корень ответа должен быть объектом"]
+    entities = obj.get("entities")
+    if not isinstance(entities, list):
+        return ["поле 'entities' должно быть массивом"]
+
+    errors = []
+    for i, ent in enumerate(entities):
+        where = f"entities[{i}]"
+        if not isinstance(ent, dict):
+            errors.append(f"{where}: должен быть объектом")
+            continue
+        e_type = ent.get("type")
+        if e_type not in ENTITY_TYPES:
+            errors.append(f"{where}.type: неизвестный тип {e_type!r}")
+        if "confidence" in ent and not isinstance(ent["confidence"], (int, float)):
+            errors.append(f"{where}.confidence: должно быть числом 0.0-1.0")
+        data = ent.get("data")
+        if not isinstance(data, dict):
+            errors.append(f"{where}.data: должен быть объектом")
+            continue
+        if e_type == "table":
+            if not isinstance(data.get("rows"), list):
+                errors.append(f"{where}.data.rows: должен быть массивом строк")
+            if "headers" in data and not isinstance(data["headers"], list):
+                errors.append(f"{where}.data.headers: должен быть массивом")
+        elif e_type == "text_block" and not isinstance(data.get("text"), str):
+            errors.append(f"{where}.data.text: должна быть строка")
+        elif e_type == "form" and not isinstance(data.get("fields"), list):
+            errors.append(f"{where}.data.fields: должен быть массивом")
+        labels = data.get("extracted_labels")
+        if labels is not None and not (isinstance(labels, list) and all(isinstance(x, str) for x in labels)):
+            errors.append(f"{where}.data.extracted_labels: должен быть массивом строк")
+    return errors
+
+
+def parse_layout_response(text: str) -> Tuple[Optional[Dict], List[str], bool]:
+    """Полный локальный цикл: извлечение, ремонт, нормализация, валидация."""
+    obj, repaired = parse_llm_json(text)
+    if obj is None:
+        return None, ["валидный JSON не найден в ответе"], repaired
+    obj = normalize_layout(obj)
+    return obj, validate_layout(obj), repaired
+
+
+def split_batch_response(obj: Any, count: int) -> List[Optional[Dict]]:
+    """
+    Раскладывает ответ multi-image запроса по индексам изображений.
+    Невалидные и пропущенные элементы возвращаются как None.
+    """
+    results: List[Optional[Dict]] = [None] * count
+    if isinstance(obj, dict):
+        obj = obj.get("results")
+    if not isinstance(obj, list):
+        return results
+    for pos, item in enumerate(obj):
+        if not isinstance(item, dict):
+            continue
+        idx = item.pop("index", pos)
+        if not isinstance(idx, int) or not 0 <= idx < count or results[idx] is not None:
+            continue
+        item = normalize_layout(item)
+        if not validate_layout(item):
+            results[idx] = item
+    return results
+
+
+_WORD_RE = re.compile(r"\w{3,}", re.UNICODE)
+
+
+def _collect_strings(value: Any, out: List[str]):
+    if isinstance(value, str):
+        out.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _collect_strings(v, out)
+    elif isinstance(value, list):
+        for v in value:
+            _collect_strings(v, out)
+
+
+def entities_text(result: Dict) -> str:
+    """Весь текст, извлеченный моделью из сущностей страницы."""
+    parts: List[str] = []
+    for ent in result.get("entities") or []:
+        if isinstance(ent, dict):
+            _collect_strings(ent.get("data"), parts)
+    return " ".join(parts)
+
+
+def _confidences(result: Dict) -> List[Dict]:
+    return [
+        ent for ent in result.get("entities") or []
+        if isinstance(ent, dict) and isinstance(ent.get("confidence"), (int, float))
+    ]
+
+
+def mean_confidence(result: Dict) -> Optional[float]:
+    """Средняя уверенность по сущностям; None, если модель ее не указала."""
+    values = [ent["confidence"] for ent in _confidences(result)]
+    return sum(values) / len(values) if values else None
+
+
+def least_confident(result: Dict) -> Optional[Dict]:
+    """Сущность с минимальной уверенностью; None, если модель ее не указала."""
+    return min(_confidences(result), key=lambda ent: ent["confidence"], default=None)
+
+
+def text_layer_agreement(result: Dict, text_layer: str) -> Optional[float]:
+    """
+    Доля слов текстового слоя PDF, найденных в ответе модели.
+    None — у страницы нет текстового слоя (скан), сравнивать не с чем.
+    """
+    layer_words = {w.lower() for w in _WORD_RE.findall(text_layer or "")}
+    if not layer_words:
+        return None
+    found = {w.lower() for w in _WORD_RE.findall(entities_text(result))}
+    return len(layer_words & found) / len(layer_words)
@@ -1,79 +1,289 @@
 import fitz
-import json
 import os
 import sys
-from config import PDF_RENDER_DPI, OUTPUT_DIR, DEBUG_DIR
-from image_utils import process_and_compress_image, save_snapshot, prepare_output_folders
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from config import (PDF_RENDER_DPI, OUTPUT_DIR, DEBUG_DIR, COALESCE_IMAGES, COALESCE_MAX_IMAGES,
+                    COALESCE_TOKEN_BUDGET, COALESCE_SMALL_IMAGE_TOKENS, TIERED_MODE, LOWRES_IMAGE_WIDTH,
+                    TILING_MODE, TILE_TRIGGER_QUALITY, NATIVE_TABLES, PAGE_CONCURRENCY, RESULT_FORMAT,
+                    RESULT_COMPACT)
+from image_utils import (process_and_compress_image, compress_image_with_quality, save_snapshot,
+                         prepare_output_folders, estimate_image_tokens)
 from ocr_engine import OCRManager
-from prompts import get_layout_prompt
-from llm_client import call_gemma_sync
-from utils import logger, timer
+from prompts import get_layout_prompt, get_batch_layout_prompt
+from llm_client import call_gemma_sync, call_gemma_batch_sync
+from tiering import escalation_reason, TierStats
+from tiling import needs_tiling, prepare_tiles, extract_tiled
+from native_tables import find_native_tables, text_lines, has_graphics_outside, mask_rects, attach_native_tables
+from resource_budget import queue_stats
+from serializer import ResultWriter
+from utils import logger, timer, estimate_text_tokens
 
-def process_single_page(page, page_num, ocr_manager, debug_folder):
-    """Полный цикл обработки одной страницы."""
+def prepare_page(page, page_num, ocr_manager, debug_folder) -> Dict:
+    """Подготовка страницы к запросу в LLM: текстовый слой, рендер, OCR-подсказки."""
     logger.info(f"Начало обработки страницы {page_num + 1}")
-    
-    # 1. Текстовый слой PDF
-    text_layer = page.get_text("text").strip()
+
+    # 0. Таблицы из векторного слоя: VLM получит страницу уже без них
+    tables = find_native_tables(page) if NATIVE_TABLES else []
+    table_rects = [t["bbox"] for t in tables]
+
+    # 1. Текстовый слой PDF (строки с позициями нужны, чтобы поставить таблицы на место)
+    lines = text_lines(page, table_rects) if tables else []
+    text_layer = "\n".join(text for _, text in lines).strip() if tables else page.get_text("text").strip()
+
+    if tables and not text_layer and not has_graphics_outside(page, table_rects):
+        logger.info(f"📐 Страница {page_num + 1}: только векторные таблицы ({len(tables)}), VLM не нужна")
+        return {"page_num": page_num, "text_layer": "", "native_tables": tables, "skip_vlm": True}
 
     # 2. Рендеринг страницы
-    pix = page.get_pixmap(matrix=fitz.Matrix(PDF_RENDER_DPI, PDF_RENDER_DPI))
+    matrix = fitz.Matrix(PDF_RENDER_DPI, PDF_RENDER_DPI)
+    pix = page.get_pixmap(matrix=matrix)
+    if tables:
+        mask_rects(pix, table_rects, matrix)
     img_bytes = pix.tobytes("jpeg")
 
     # 3. Сжатие и сохранение снапшота
-    b64_img = process_and_compress_image(img_bytes)
+    b64_img, quality = compress_image_with_quality(img_bytes)
     save_snapshot(b64_img, page_num, debug_folder)
 
-    # 4. Получение OCR подсказок
+    # Крупная или плотная страница: вместо пережатия режем на читаемые тайлы
+    if TILING_MODE and needs_tiling(page, quality):
+        return {
+            "page_num": page_num,
+            "text_layer": text_layer,
+            "b64": b64_img,
+            "native_tables": tables,
+            "text_lines": lines,
+            "tiles": prepare_tiles(page, ocr_manager, dense=quality <= TILE_TRIGGER_QUALITY, masked=table_rects),
+        }
+
+    # 4. Получение OCR подсказок (по полному разрешению и для низкого уровня тоже)
     with timer("EasyOCR"):
         pre_ocr_hints = ocr_manager.get_preocr_data(b64_img)
 
-    # 5. Промпт
-    prompt = get_layout_prompt(pre_ocr_hints, text_layer)
+    item = {
+        "page_num": page_num,
+        "text_layer": text_layer,
+        "pre_ocr": pre_ocr_hints,
+        "b64": b64_img,
+        "native_tables": tables,
+        "text_lines": lines,
+        "tables_masked": bool(tables),
+    }
+    if TIERED_MODE:
+        item["b64_low"] = process_and_compress_image(img_bytes, max_width=LOWRES_IMAGE_WIDTH)
+    return item
+
+def extract_page(item: Dict, image_key: str = "b64") -> Optional[Dict]:
+    """Одиночный запрос к LLM для подготовленной страницы."""
+    if item.get("skip_vlm"):
+        return None
+    if item.get("tiles"):
+        return extract_tiled(item["tiles"])
+    prompt = get_layout_prompt(item["pre_ocr"], item["text_layer"], item.get("tables_masked", False))
+    return call_gemma_sync(prompt, item[image_key], label=f"стр. {item['page_num'] + 1}")
+
+def _extract_with_tables(item: Dict) -> Optional[Dict]:
+    return attach_native_tables(extract_page(item), item.get("native_tables"), item.get("text_lines"))
+
+def process_single_page(page, page_num, ocr_manager, debug_folder):
+    """Полный цикл обработки одной страницы."""
+    return _extract_with_tables(prepare_page(page, page_num, ocr_manager, debug_folder))
+
+def _page_pool() -> ThreadPoolExecutor:
+    """
+    Потоки страниц, ожидающих LLM. Порядок запросов определяет очередь
+    resource_budget (дешевые первыми), а не номер страницы.
+    """
+    return ThreadPoolExecutor(max_workers=max(1, PAGE_CONCURRENCY), thread_name_prefix="page")
+
+def _pack_small_pages(items: List[Dict], image_key: str = "b64") -> List[List[Dict]]:
+    """
+    Группирует подряд идущие мелкие страницы в пакеты под бюджет токенов.
+    Крупные страницы остаются одиночными запросами; порядок страниц сохраняется.
+    """
+    groups, current, budget = [], [], 0
+    for item in items:
+        img_tokens = estimate_image_tokens(item[image_key])
+        cost = img_tokens + estimate_text_tokens(item["pre_ocr"]) + estimate_text_tokens(item["text_layer"])
+        small = img_tokens <= COALESCE_SMALL_IMAGE_TOKENS
+        if current and (not small or len(current) >= COALESCE_MAX_IMAGES or budget + cost > COALESCE_TOKEN_BUDGET):
+            groups.append(current)
+            current, budget = [], 0
+        if not small:
+            groups.append([item])
+            continue
+        current.append(item)
+        budget += cost
+    if current:
+        groups.append(current)
+    return groups
+
+def _extract_group(group: List[Dict], image_key: str) -> Tuple[Dict[int, Optional[Dict]], int]:
+    """Результаты страниц пакета и число запросов к VLM (с добором выпавших страниц)."""
+    if len(group) == 1:
+        return {group[0]["page_num"]: extract_page(group[0], image_key)}, 1
 
-    # 6. Запрос к LLM
-    result = call_gemma_sync(prompt, b64_img)
-    return result
+    pages = ", ".join(str(it["page_num"] + 1) for it in group)
+    with timer(f"Пакет страниц [{pages}]"):
+        prompt = get_batch_layout_prompt(
+            [(it["pre_ocr"], it["text_layer"], it.get("tables_masked", False)) for it in group]
+        )
+        batch = call_gemma_batch_sync(prompt, [it[image_key] for it in group], label=f"стр. {pages}")
 
-def run_pipeline(pdf_path):
+    results, requests = {}, 1
+    for item, res in zip(group, batch):
+        if res is None:
+            # Элемент не вернулся из пакета — добираем отдельным запросом
+            res = extract_page(item, image_key)
+            requests += 1
+        results[item["page_num"]] = res
+    return results, requests
+
+def extract_pages_coalesced(items: List[Dict], image_key: str = "b64") -> Dict[int, Optional[Dict]]:
+    """Извлечение с упаковкой мелких страниц в multi-image запросы."""
+    results, requests = {}, 0
+    with _page_pool() as pool:
+        for part, count in pool.map(lambda group: _extract_group(group, image_key), _pack_small_pages(items, image_key)):
+            results.update(part)
+            requests += count
+    if items:
+        logger.info(f"🧩 Упаковка страниц ({image_key}): {len(items)} стр. за {requests} запросов к VLM "
+                    f"({len(items) / max(requests, 1):.1f} на запрос)")
+    return results
+
+def _extract_tier(items: List[Dict], image_key: str) -> Dict[int, Optional[Dict]]:
+    if COALESCE_IMAGES:
+        return extract_pages_coalesced(items, image_key)
+    with _page_pool() as pool:
+        futures = {item["page_num"]: pool.submit(extract_page, item, image_key) for item in items}
+    return {page_num: future.result() for page_num, future in futures.items()}
+
+def extract_pages(items: List[Dict]) -> Dict[int, Optional[Dict]]:
+    """
+    Извлечение подготовленных страниц. В режиме TIERED_MODE все страницы
+    сначала идут в низком разрешении, а в полном — только неуверенные.
+    """
+    native = {item["page_num"]: (item.get("native_tables"), item.get("text_lines")) for item in items}
+    # Страницы из одних векторных таблиц в VLM не идут;
+    # тайловые не упаковываются и не проходят низкий уровень
+    tiled = {item["page_num"]: extract_page(item) for item in items if item.get("tiles")}
+    items = [item for item in items if not item.get("tiles") and not item.get("skip_vlm")]
+
+    if not TIERED_MODE:
+        results = {**tiled, **_extract_tier(items, "b64")}
+        return {pn: attach_native_tables(results.get(pn), *native[pn]) for pn in native}
+
+    stats = TierStats()
+    with timer("Уровень low"):
+        results = _extract_tier(items, "b64_low")
+
+    escalate = []
+    for item in items:
+        reason = escalation_reason(results.get(item["page_num"]), item["text_layer"])
+        if reason:
+            logger.info(f"🔍 Страница {item['page_num'] + 1} -> высокое разрешение ({reason})")
+            stats.escalated(reason)
+            escalate.append(item)
+        else:
+            stats.hit("low")
+
+    if escalate:
+        with timer("Уровень high"):
+            high = _extract_tier(escalate, "b64")
+        for item in escalate:
+            escalated = high.get(item["page_num"])
+            if escalated:
+                results[item["page_num"]] = escalated
+                stats.hit("high")
+            else:
+                # В полном разрешении ответа нет — оставляем низкоуровневый
+                stats.hit("failed")
+
+    stats.log()
+    results = {**tiled, **results}
+    return {pn: attach_native_tables(results.get(pn), *native[pn]) for pn in native}
+
+def _write_page(writer: ResultWriter, page_num: int, page_result: Optional[Dict]) -> bool:
+    if page_result:
+        writer.append({"page": page_num + 1, "extraction": page_result})
+        logger.info(f"✅ Страница {page_num + 1} успешно обработана")
+        return True
+    logger.warning(f"⚠️ Страница {page_num + 1} не дала результата")
+    return False
+
+def _drain_pages(writer: ResultWriter, window: deque, keep: int) -> List[int]:
+    """
+    Запись страниц из головы окна (page_num, future) по порядку: готовые уходят сразу,
+    а пока в окне больше keep страниц — ждем голову. Возвращает номера страниц без результата.
+    """
+    missing = []
+    while window and (len(window) > keep or window[0][1].done()):
+        page_num, future = window.popleft()
+        if not _write_page(writer, page_num, future.result()):
+            missing.append(page_num + 1)
+    return missing
+
+def run_pipeline(pdf_path, output_json_path: Optional[str] = None) -> Optional[Dict]:
+    """
+    Обработка PDF целиком. Возвращает сводку {"output", "missing_pages"}
+    (номера страниц без результата) или None при критической ошибке.
+    output_json_path — куда писать результат (по умолчанию OUTPUT_DIR/<имя>.json).
+    """
     # Подготовка имен файлов и папок
     base_name = os.path.splitext(os.path.basename(pdf_path))[0]
     debug_folder = os.path.join(DEBUG_DIR, base_name)
-    output_json_path = os.path.join(OUTPUT_DIR, f"{base_name}.json")
+    output_json_path = output_json_path or os.path.join(OUTPUT_DIR, f"{base_name}.json")
 
     # Пересоздаем папку для картинок и проверяем папку для JSON
-    prepare_output_folders(debug_folder, OUTPUT_DIR)
+    prepare_output_folders(debug_folder, os.path.dirname(output_json_path) or ".")
 
     ocr_manager = OCRManager()
-    final_data = []
+    writer = ResultWriter(output_json_path, RESULT_FORMAT, RESULT_COMPACT)
+    missing = []
 
     try:
         with fitz.open(pdf_path) as doc:
-            for i, page in enumerate(doc):
-                page_result = process_single_page(page, i, ocr_manager, debug_folder)
-                if page_result:
-                    final_data.append({
-                        "page": i + 1,
-                        "extraction": page_result
-                    })
-                    logger.info(f"✅ Страница {i+1} успешно обработана")
-                else:
-                    logger.warning(f"⚠️ Страница {i+1} не дала результата")
-
-        # Сохранение итогового JSON
-        with open(output_json_path, "w", encoding="utf-8") as f:
-            json.dump(final_data, f, ensure_ascii=False, indent=2)
-        
-        logger.info(f"💾 Результаты сохранены в: {output_json_path}")
+            if COALESCE_IMAGES or TIERED_MODE:
+                prepared = [prepare_page(page, i, ocr_manager, debug_folder) for i, page in enumerate(doc)]
+                page_results = extract_pages(prepared)
+                for i in range(doc.page_count):
+                    if not _write_page(writer, i, page_results.get(i)):
+                        missing.append(i + 1)
+            else:
+                # Рендер и OCR идут по порядку, а готовые страницы ждут LLM параллельно:
+                # плотная страница не задерживает дешевые, подготовленные после нее
+                # Окно из PAGE_CONCURRENCY страниц: следующая готовится, только когда
+                # в окне есть место, — рендеры всего документа не ждут LLM в памяти
+                limit = max(1, PAGE_CONCURRENCY)
+                window = deque()
+                with _page_pool() as pool:
+                    for i, page in enumerate(doc):
+                        # Готовые страницы из головы окна пишутся в файл по порядку еще до
+                        # подготовки следующей: результаты в памяти не копятся
+                        missing += _drain_pages(writer, window, limit - 1)
+                        item = prepare_page(page, i, ocr_manager, debug_folder)
+                        window.append((i, pool.submit(_extract_with_tables, item)))
+                    missing += _drain_pages(writer, window, 0)
+
+        # Итоговый файл встает на место только целиком
+        saved_path = writer.close()
+
+        logger.info(f"💾 Результаты сохранены в: {saved_path}")
         logger.info(f"🖼️ Снапшоты страниц находятся в: {debug_folder}")
+        logger.info(f"⏳ Очередь LLM: {queue_stats()}")
+        return {"output": saved_path, "missing_pages": missing}
 
     except Exception as e:
+        writer.abort()
         logger.error(f"❌ Критическая ошибка пайплайна: {e}")
+        return None
 
 if __name__ == "__main__":
     # Аргумент командной строки или файл по умолчанию
     input_file = sys.argv[1] if len(sys.argv) > 1 else "PFR_777000_0SZIE_20251202_70f51a49-cfa5-11f0-afff-3a453110dbec (1).pdf"
     # "!Ознакомиться перед использованием.pdf"
-    
+
     with timer("Полный цикл обработки"):
         run_pipeline(input_file)
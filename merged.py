@@ -0,0 +1,2 @@
+# Реализация — в xlsx_parser/merged.py (одна копия на оба анализатора)
+from xlsx_parser.merged import MergedIndex, MergedRange, range_ref  # noqa: F401
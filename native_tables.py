@@ -0,0 +1,203 @@
+import re
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+import fitz
+from config import NATIVE_TABLE_MIN_FILL
+from utils import logger, timer
+
+
+def _center_in(word, rect) -> bool:
+    cx, cy = (word[0] + word[2]) / 2, (word[1] + word[3]) / 2
+    return rect.x0 <= cx <= rect.x1 and rect.y0 <= cy <= rect.y1
+
+
+def _table_cells(tab, words) -> List[List[str]]:
+    """
+    Текст ячеек по координатам слов: строка ищется по y центра слова,
+    колонка — по x внутри строки. Слова внутри ячейки идут в порядке чтения.
+    """
+    rows = tab.rows
+    row_tops = [row.bbox[1] for row in rows]
+    grid = [[[] for _ in row.cells] for row in rows]
+    bbox = fitz.Rect(tab.bbox)
+
+    for w in words:
+        if not _center_in(w, bbox):
+            continue
+        cx, cy = (w[0] + w[2]) / 2, (w[1] + w[3]) / 2
+        r = bisect_right(row_tops, cy) - 1
+        if r < 0 or cy > rows[r].bbox[3]:
+            continue
+        for c, cell in enumerate(rows[r].cells):
+            if cell and cell[0] <= cx <= cell[2]:
+                grid[r][c].append(w)
+                break
+
+    return [
+        [" ".join(w[4] for w in sorted(cell, key=lambda w: (w[5], w[6], w[7]))) for cell in row]
+        for row in grid
+    ]
+
+
+def find_native_tables(page) -> List[Dict]:
+    """
+    Таблицы из векторного слоя PDF (линии разметки + позиционированный текст).
+    Возвращает [{"bbox": Rect, "headers": [...], "rows": [[...]]}].
+    """
+    try:
+        with timer("find_tables"):
+            found = page.find_tables()
+    except Exception as e:
+        logger.warning(f"find_tables не сработал на странице {page.number + 1}: {e}")
+        return []
+    if not found.tables:
+        return []
+
+    words = page.get_text("words")
+    tables = []
+    for tab in found.tables:
+        rows = _table_cells(tab, words)
+        if tab.header and not tab.header.external and rows:
+            headers, rows = rows[0], rows[1:]
+        else:
+            headers = [name or "" for name in (tab.header.names if tab.header else [])]
+
+        n_cells = sum(len(r) for r in rows)
+        filled = sum(1 for r in rows for v in r if v)
+        # Отсекаем рамки и "таблицы" из одной строки/колонки — их лучше отдать VLM
+        if len(rows) < 2 or tab.col_count < 2 or not n_cells or filled / n_cells < NATIVE_TABLE_MIN_FILL:
+            continue
+        tables.append({"bbox": fitz.Rect(tab.bbox), "headers": headers, "rows": rows})
+    return tables
+
+
+def text_lines(page, rects: List["fitz.Rect"], clip: Optional["fitz.Rect"] = None) -> List[Tuple[float, str]]:
+    """Строки текстового слоя вне таблиц в порядке чтения: (верх строки, текст)."""
+    lines: Dict[tuple, List] = {}
+    for w in page.get_text("words", clip=clip):
+        if any(_center_in(w, r) for r in rects):
+            continue
+        lines.setdefault((w[5], w[6]), []).append(w)
+    return [
+        (min(w[1] for w in ws), " ".join(w[4] for w in sorted(ws, key=lambda w: w[7])))
+        for _, ws in sorted(lines.items())
+    ]
+
+
+def text_outside(page, rects: List["fitz.Rect"], clip: Optional["fitz.Rect"] = None) -> str:
+    """Текстовый слой страницы без слов, попавших в таблицы."""
+    return "\n".join(text for _, text in text_lines(page, rects, clip)).strip()
+
+
+def has_graphics_outside(page, rects: List["fitz.Rect"]) -> bool:
+    """Есть ли на странице картинки или векторная графика вне таблиц."""
+    if page.get_images(full=False):
+        return True
+    for d in page.get_drawings():
+        r = d.get("rect")
+        if r is not None and not any(fitz.Rect(t).contains(r) for t in rects):
+            return True
+    return False
+
+
+def mask_rects(pix, rects: List["fitz.Rect"], matrix):
+    """Закрашивает уже извлеченные таблицы на рендере, чтобы VLM их не перечитывала."""
+    for r in rects:
+        pix.set_rect((r * matrix).irect, (255,) * pix.n)
+
+
+def to_entities(tables: List[Dict]) -> List[Dict]:
+    """Таблицы в формате сущностей layout-промпта."""
+    return [
+        {
+            "id": f"T{idx}",
+            "type": "table",
+            "confidence": 1.0,
+            "source": "pdf_vector",
+            "data": {"headers": t["headers"], "rows": t["rows"]},
+        }
+        for idx, t in enumerate(tables, start=1)
+    ]
+
+
+_WORD_RE = re.compile(r"\w{2,}")
+
+
+def _entity_words(ent: Dict, limit: int = 6) -> List[str]:
+    """Первые слова текста сущности (значения data, кроме роли блока)."""
+    words: List[str] = []
+
+    def walk(value, key=None):
+        if len(words) >= limit or key == "role":
+            return
+        if isinstance(value, str):
+            words.extend(_WORD_RE.findall(value.lower()))
+        elif isinstance(value, dict):
+            for k, v in value.items():
+                walk(v, k)
+        elif isinstance(value, list):
+            for v in value:
+                walk(v)
+
+    walk(ent.get("data") if isinstance(ent, dict) else None)
+    return words[:limit]
+
+
+def _entity_top(ent: Dict, lines: List[Tuple[float, str]]) -> Optional[float]:
+    """
+    Верх сущности VLM по текстовому слою: строка, где нашлось больше всего
+    ее первых слов (не меньше двух). None — текста сущности в слое нет (картинка, схема).
+    """
+    words = _entity_words(ent)
+    if not words:
+        return None
+    best_y, best_hits = None, min(2, len(words)) - 1
+    for y, text in lines:
+        line_words = set(_WORD_RE.findall(text.lower()))
+        hits = sum(1 for w in words if w in line_words)
+        if hits > best_hits:
+            best_y, best_hits = y, hits
+    return best_y
+
+
+def _merge_by_position(entities: List, tables: List[Dict], lines: List[Tuple[float, str]]) -> List:
+    """
+    Вставка таблиц между сущностями VLM по вертикали: порядок VLM сохраняется,
+    позиция сущности берется из текстового слоя, у сущностей без текста — от соседей.
+    Если ни одну сущность найти в слое не удалось, таблицы идут в конец, как раньше.
+    """
+    tops = [_entity_top(ent, lines) for ent in entities]
+    known = [y for y in tops if y is not None]
+    if entities and not known:
+        return entities + to_entities(tables)
+    # Без позиции: верх предыдущей сущности (в начале — первой найденной); порядок VLM не нарушается
+    last = known[0] if known else 0.0
+    for i, y in enumerate(tops):
+        last = tops[i] = last if y is None else max(y, last)
+
+    ordered = sorted(tables, key=lambda t: t["bbox"].y0)
+    merged, i = [], 0
+    for table, ent in zip(ordered, to_entities(ordered)):
+        while i < len(entities) and tops[i] < table["bbox"].y0:
+            merged.append(entities[i])
+            i += 1
+        merged.append(ent)
+    return merged + entities[i:]
+
+
+def attach_native_tables(result: Optional[Dict], tables: List[Dict],
+                         lines: Optional[List[Tuple[float, str]]] = None) -> Optional[Dict]:
+    """
+    Добавляет векторные таблицы к ответу VLM по остальной части страницы —
+    на их место в порядке чтения (lines — строки text_lines той же страницы).
+    """
+    if not tables:
+        return result
+    result = result or {"metadata": {}, "entities": []}
+    entities = _merge_by_position(list(result.get("entities") or []), tables, lines or [])
+    for idx, ent in enumerate(entities, start=1):
+        if isinstance(ent, dict):
+            ent["id"] = f"E{idx}"
+    result["entities"] = entities
+    result.setdefault("metadata", {})["native_tables"] = len(tables)
+    return result
@@ -0,0 +1,394 @@
+import asyncio
+import logging
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from config import (PPT_CONVERTER_POOL_SIZE, PPT_CONVERTER_TIMEOUT, PPT_CONVERTER_MAX_JOBS,
+                    PPT_CONVERTER_MAX_RSS_MB, PPT_CONVERTER_STUB, PPT_CONVERTER_BINARY)
+
+try:
+    import uno  # python3-uno из поставки LibreOffice
+except ImportError:  # без него — отдельный soffice --convert-to на каждый файл
+    uno = None
+
+logger = logging.getLogger("ConverterPool")
+
+
+class ConversionTimeout(RuntimeError):
+    pass
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def _tree_rss_mb(pid: int) -> Optional[float]:
+    """RSS процесса и его потомков (soffice -> soffice.bin) по /proc; вне Linux — None."""
+    total, stack, seen = 0, [pid], False
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        seen = True
+                        break
+        except OSError:
+            continue
+        stack.extend(_children(current))
+    return total / 1024 if seen else None
+
+
+# Фильтры экспорта в PDF по типу документа (как их выбирает soffice --convert-to pdf)
+_PDF_FILTERS = (
+    ("com.sun.star.presentation.PresentationDocument", "impress_pdf_Export"),
+    ("com.sun.star.drawing.DrawingDocument", "draw_pdf_Export"),
+    ("com.sun.star.sheet.SpreadsheetDocument", "calc_pdf_Export"),
+    ("com.sun.star.text.TextDocument", "writer_pdf_Export"),
+)
+
+
+class LibreOfficeConverter:
+    """
+    Теплый headless LibreOffice со своим профилем. Если доступен модуль uno
+    (python3-uno), офис запускается один раз со слушателем на именованном канале,
+    и файлы конвертируются через UNO без нового процесса — холодный старт
+    оплачивается один раз на жизнь конвертера. Без uno каждый файл конвертирует
+    отдельный процесс soffice --convert-to с профилем конвертера (профиль
+    создается один раз, но сам офис стартует на каждый файл).
+    """
+
+    def __init__(self, index: int, binary: Optional[str] = None):
+        self.index = index
+        self.binary = binary or shutil.which("soffice") or shutil.which("libreoffice") or "soffice"
+        self.profile_dir = os.path.join(tempfile.gettempdir(), f"lo_pool_{os.getpid()}_{index}")
+        self.profile_url = Path(self.profile_dir).as_uri()
+        self._pipe_prefix = f"lo_pool_{os.getpid()}_{index}"
+        self.pipe_name: Optional[str] = None  # канал слушателя текущего запуска офиса
+        self.proc: Optional[subprocess.Popen] = None
+        self._desktop = None
+        self.jobs = 0
+
+    def start(self):
+        self.jobs = 0
+        self._desktop = None
+        if uno is None:
+            return
+        self.pipe_name = f"{self._pipe_prefix}_{uuid.uuid4().hex[:8]}"
+        self.proc = subprocess.Popen(
+            [self.binary, f"-env:UserInstallation={self.profile_url}", "--headless", "--invisible",
+             "--nologo", "--norestore", "--nodefault", f"--accept=pipe,name={self.pipe_name};urp;"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        )
+
+    def convert(self, input_path: str, out_dir: str, fmt: str, timeout: float) -> str:
+        output_path = os.path.join(out_dir, Path(input_path).stem + "." + fmt)
+        if uno is not None and fmt == "pdf":
+            self._convert_uno(input_path, output_path, timeout)
+        else:
+            self._convert_cli(input_path, out_dir, fmt, timeout)
+        if not os.path.exists(output_path):
+            raise RuntimeError(f"Файл .{fmt} не был создан")
+        self.jobs += 1
+        return output_path
+
+    def _convert_cli(self, input_path: str, out_dir: str, fmt: str, timeout: float):
+        cmd = [self.binary, f"-env:UserInstallation={self.profile_url}", "--headless", "--invisible",
+               "--convert-to", fmt, "--outdir", out_dir, input_path]
+        try:
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise ConversionTimeout(f"LibreOffice не ответил за {timeout} секунд при конвертации")
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode("utf-8", errors="replace") if e.stderr else ""
+            raise RuntimeError(f"Ошибка LibreOffice: {stderr}")
+
+    def _connect(self, deadline: float):
+        """Desktop офиса через канал слушателя; сразу после start() офис еще поднимается."""
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext")
+                return ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+            except Exception:
+                if time.monotonic() >= deadline or (self.proc and self.proc.poll() is not None):
+                    raise
+                time.sleep(0.2)
+
+    def _convert_uno(self, input_path: str, output_path: str, timeout: float):
+        # Вызовы UNO блокирующие и без таймаута: работа в отдельном потоке,
+        # по таймауту пул перезапускает конвертер, и зависший вызов обрывается вместе с офисом
+        outcome: Dict = {}
+
+        def run():
+            try:
+                if self._desktop is None:
+                    self._desktop = self._connect(time.monotonic() + timeout)
+                hidden = uno.createUnoStruct("com.sun.star.beans.PropertyValue", Name="Hidden", Value=True)
+                doc = self._desktop.loadComponentFromURL(
+                    uno.systemPathToFileUrl(os.path.abspath(input_path)), "_blank", 0, (hidden,)
+                )
+                if doc is None:
+                    raise RuntimeError("LibreOffice не открыл документ")
+                try:
+                    pdf_filter = next((f for service, f in _PDF_FILTERS if doc.supportsService(service)),
+                                      "writer_pdf_Export")
+                    export = uno.createUnoStruct("com.sun.star.beans.PropertyValue", Name="FilterName",
+                                                 Value=pdf_filter)
+                    doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(output_path)), (export,))
+                finally:
+                    doc.close(True)
+            except Exception as e:
+                self._desktop = None  # мост мог оборваться — при следующей задаче подключимся заново
+                outcome["error"] = e
+
+        worker = threading.Thread(target=run, daemon=True, name="uno-convert")
+        worker.start()
+        worker.join(timeout)
+        if worker.is_alive():
+            raise ConversionTimeout(f"LibreOffice не ответил за {timeout} секунд при конвертации")
+        if "error" in outcome:
+            raise RuntimeError(f"Ошибка LibreOffice: {outcome['error']}")
+
+    def rss_mb(self) -> Optional[float]:
+        return _tree_rss_mb(self.proc.pid) if self.proc else None
+
+    def stop(self):
+        self._desktop = None
+        if self.proc is not None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError, AttributeError):
+                self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class StubConverter:
+    """
+    Заглушка конвертера для тестов пула без офисного пакета: пишет минимальный PDF
+    (страница на входной файл). delay — имитация времени конвертации,
+    rss_per_job_mb — имитация роста памяти для проверки рециклинга.
+    """
+
+    _PDF = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+            b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+            b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+            b"trailer<</Root 1 0 R>>\n%%EOF\n")
+
+    def __init__(self, index: int, delay: float = 0.0, rss_per_job_mb: float = 0.0):
+        self.index = index
+        self.delay = delay
+        self.rss_per_job_mb = rss_per_job_mb
+        self.jobs = 0
+
+    def start(self):
+        self.jobs = 0
+
+    def convert(self, input_path: str, out_dir: str, fmt: str, timeout: float) -> str:
+        if self.delay > timeout:
+            time.sleep(timeout)
+            raise ConversionTimeout(f"Заглушка не ответила за {timeout} секунд")
+        time.sleep(self.delay)
+        output_path = os.path.join(out_dir, Path(input_path).stem + "." + fmt)
+        with open(output_path, "wb") as f:
+            f.write(self._PDF)
+        self.jobs += 1
+        return output_path
+
+    def rss_mb(self) -> Optional[float]:
+        return self.jobs * self.rss_per_job_mb
+
+    def stop(self):
+        pass
+
+
+class ConverterPool:
+    """
+    Пул долгоживущих конвертеров документов. Одновременных конвертаций не больше
+    size, остальные ждут в очереди. Конвертер перезапускается после таймаута задачи,
+    после max_jobs задач или когда память его процессов превысила max_rss_mb.
+    """
+
+    def __init__(self, size: int, factory: Callable[[int], object], job_timeout: float,
+                 max_jobs: int = 0, max_rss_mb: float = 0):
+        self.size = size
+        self.job_timeout = job_timeout
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self._factory = factory
+        self._idle: "queue.Queue" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="converter")
+        self._lock = threading.Lock()
+        self._unstarted = set()  # замены, которые не поднялись: запускаются перед следующей задачей
+        self._metrics = {
+            "queued": 0, "busy": 0, "max_queue_depth": 0, "completed": 0, "failed": 0,
+            "timeouts": 0, "recycled": 0, "wait_sec": 0.0, "convert_sec": 0.0,
+        }
+        for index in range(size):
+            converter = factory(index)
+            converter.start()
+            self._idle.put(converter)
+
+    async def convert(self, input_path: str, fmt: str = "pdf") -> str:
+        """Асинхронная конвертация; результат — путь к файлу во временной папке."""
+        self._enqueue()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run_job, input_path, fmt, time.monotonic())
+
+    def convert_sync(self, input_path: str, fmt: str = "pdf") -> str:
+        self._enqueue()
+        return self._executor.submit(self._run_job, input_path, fmt, time.monotonic()).result()
+
+    def _enqueue(self):
+        with self._lock:
+            self._metrics["queued"] += 1
+            self._metrics["max_queue_depth"] = max(self._metrics["max_queue_depth"], self._metrics["queued"])
+
+    def _run_job(self, input_path: str, fmt: str, submitted: float) -> str:
+        converter = self._idle.get()
+        started = time.monotonic()
+        with self._lock:
+            self._metrics["queued"] -= 1
+            self._metrics["busy"] += 1
+            self._metrics["wait_sec"] += started - submitted
+        recycle = False
+        try:
+            if converter in self._unstarted:
+                converter.start()
+                self._unstarted.discard(converter)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                output_path = converter.convert(input_path, tmp_dir, fmt, self.job_timeout)
+                # Уникальное имя: параллельные задачи с одинаковыми именами файлов не перетирают друг друга
+                final_path = Path(tempfile.gettempdir()) / f"converted_{uuid.uuid4().hex[:8]}_{Path(output_path).name}"
+                shutil.move(output_path, final_path)
+            self._count("completed")
+            return str(final_path)
+        except ConversionTimeout:
+            recycle = True
+            self._count("timeouts")
+            self._count("failed")
+            raise
+        except Exception:
+            self._count("failed")
+            raise
+        finally:
+            with self._lock:
+                self._metrics["busy"] -= 1
+                self._metrics["convert_sec"] += time.monotonic() - started
+            self._release(converter, recycle)
+
+    def _release(self, converter, recycle: bool):
+        if not recycle and self.max_jobs and converter.jobs >= self.max_jobs:
+            recycle = True
+        if not recycle and self.max_rss_mb:
+            rss = converter.rss_mb()
+            recycle = rss is not None and rss > self.max_rss_mb
+        if recycle:
+            try:
+                converter.stop()
+                converter.start()
+            except Exception as e:
+                logger.error(f"Converter restart failed: {e}")
+                converter = self._replace(converter)
+            self._count("recycled")
+        self._idle.put(converter)
+
+    def _replace(self, converter):
+        """Новый конвертер на место не перезапустившегося; если не поднялся и он — старт перед задачей."""
+        try:
+            converter.stop()
+        except Exception as e:
+            logger.warning(f"Converter stop failed: {e}")
+        self._unstarted.discard(converter)
+        fresh = self._factory(converter.index)
+        try:
+            fresh.start()
+        except Exception as e:
+            logger.error(f"Replacement converter start failed: {e}")
+            self._unstarted.add(fresh)
+        return fresh
+
+    def _count(self, key: str):
+        with self._lock:
+            self._metrics[key] += 1
+
+    def metrics(self, reset: bool = False) -> Dict:
+        """Сводка очереди и конвертаций; reset — счетчики (кроме текущих queued/busy) с нуля."""
+        with self._lock:
+            m = dict(self._metrics)
+            if reset:
+                for key in self._metrics:
+                    if key not in ("queued", "busy"):
+                        self._metrics[key] = type(self._metrics[key])()
+                self._metrics["max_queue_depth"] = self._metrics["queued"]
+        done = m["completed"] + m["failed"]
+        return {
+            "size": self.size,
+            "queue_depth": m["queued"],
+            "busy": m["busy"],
+            "max_queue_depth": m["max_queue_depth"],
+            "completed": m["completed"],
+            "failed": m["failed"],
+            "timeouts": m["timeouts"],
+            "recycled": m["recycled"],
+            "avg_wait_sec": round(m["wait_sec"] / done, 3) if done else 0.0,
+            "avg_convert_sec": round(m["convert_sec"] / done, 3) if done else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        logger.info(f"📊 Пул конвертеров: {self.metrics()}")
+        while not self._idle.empty():
+            self._idle.get_nowait().stop()
+
+
+_pool: Optional[ConverterPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_converter_pool() -> ConverterPool:
+    """Общий пул конвертеров процесса (создается при первом обращении по настройкам config)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if PPT_CONVERTER_STUB:
+                factory = StubConverter
+            else:
+                if uno is None:
+                    logger.warning("python3-uno недоступен: офис запускается на каждый файл")
+                factory = lambda index: LibreOfficeConverter(index, PPT_CONVERTER_BINARY or None)
+            _pool = ConverterPool(PPT_CONVERTER_POOL_SIZE, factory, PPT_CONVERTER_TIMEOUT,
+                                  PPT_CONVERTER_MAX_JOBS, PPT_CONVERTER_MAX_RSS_MB)
+        return _pool
+
+
+def converter_metrics(reset: bool = False) -> Optional[Dict]:
+    """Метрики общего пула процесса; None — пул еще не создавался."""
+    with _pool_lock:
+        return _pool.metrics(reset) if _pool is not None else None
+
+
+def shutdown_converter_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -9,15 +9,27 @@
         paddle_temperature: float = None,
         paddle_max_tokens: int = None,
     ):
-        # 1. Конвертация PPT/PPTX в PDF
-        # Используем run_in_executor, так как subprocess - блокирующая операция
+        llm_params = dict(
+            llm_max_tokens=llm_max_tokens,
+            llm_temperature=llm_temperature,
+            llm_top_p=llm_top_p,
+            paddle_temperature=paddle_temperature,
+            paddle_max_tokens=paddle_max_tokens,
+        )
         loop = asyncio.get_running_loop()
+
+        # 0. PPTX читается напрямую из XML слайдов: текст, таблицы и заметки без конвертации.
+        # Через PDF и VLM идут только слайды с картинками, диаграммами, SmartArt и OLE
+        if PPTX_NATIVE_EXTRACTION and file_path.lower().endswith(".pptx"):
+            # None — нестандартный пакет, старый путь через LibreOffice
+            slides = await loop.run_in_executor(None, load_slides, file_path)
+            if slides is not None:
+                return await self._process_pptx_slides(session, file_path, actual_name, slides, llm_params)
+
+        # 1. Конвертация PPT/PPTX в PDF
+        # Пул конвертеров: с python3-uno без холодного старта офиса, всегда с ограничением параллельности
         try:
-            pdf_path = await loop.run_in_executor(
-                None, 
-                convert_presentation_to_pdf, 
-                file_path
-            )
+            pdf_path = await get_converter_pool().convert(file_path)
         except RuntimeError as e:
             # Здесь можно добавить логирование ошибки
             raise e
@@ -28,11 +40,7 @@
                 session=session,
                 pdf_path=pdf_path,
                 actual_name=actual_name, # Сохраняем оригинальное имя файла презентации
-                llm_max_tokens=llm_max_tokens,
-                llm_temperature=llm_temperature,
-                llm_top_p=llm_top_p,
-                paddle_temperature=paddle_temperature,
-                paddle_max_tokens=paddle_max_tokens
+                **llm_params
             )
         finally:
             # 3. Уборка: удаляем временный PDF файл после обработки
@@ -42,3 +50,38 @@
                     os.remove(pdf_path)
                 except OSError:
                     pass
+
+    async def _process_pptx_slides(self, session, file_path: str, actual_name: str, slides, llm_params):
+        """
+        Сборка результата презентации: текстовые слайды — из XML, визуальные —
+        через PDF, в котором оставлены только они. Формат как у process_single_file:
+        [{"page": номер слайда, "extraction": {...}}].
+        """
+        results, visual = split_slides(slides)
+        rendered = None
+        if visual:
+            pdf_path, subset_path = None, None
+            try:
+                pdf_path = await get_converter_pool().convert(file_path)
+                # Рендерятся только визуальные слайды
+                subset_path = visual_subset_pdf(pdf_path, visual)
+            except Exception as e:
+                # Без PDF визуальные слайды остаются с текстом из XML (metadata.degraded)
+                log_render_failure(file_path, e)
+            try:
+                if subset_path:
+                    rendered = await self.process_single_file(
+                        session=session,
+                        pdf_path=subset_path,
+                        actual_name=actual_name,
+                        **llm_params
+                    )
+            finally:
+                for path in (pdf_path, subset_path):
+                    if path and os.path.exists(path):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+
+        return merge_rendered(results, visual, rendered)
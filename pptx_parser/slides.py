@@ -0,0 +1,326 @@
+import logging
+import os
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("PptxSlides")
+
+NS_P = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+NS_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+NS_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+NS_MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+
+_URI_TABLE = "http://schemas.openxmlformats.org/drawingml/2006/table"
+# Содержимое graphicFrame, которое без рендера не разобрать
+_VISUAL_URIS = {
+    "http://schemas.openxmlformats.org/drawingml/2006/chart": "chart",
+    "http://schemas.openxmlformats.org/drawingml/2006/diagram": "smartart",
+    "http://schemas.openxmlformats.org/presentationml/2006/ole": "ole",
+}
+_TITLE_TYPES = {"title", "ctrTitle"}
+_SKIP_PLACEHOLDERS = {"sldNum", "dt", "ftr", "hdr"}
+
+
+class PresentationReader:
+    """
+    Чтение PPTX напрямую из XML слайдов: текстовые рамки, таблицы и заметки
+    докладчика — без LibreOffice и рендера. Слайды с картинками, диаграммами,
+    SmartArt и OLE-объектами помечаются для VLM (поле visuals).
+    """
+
+    def __init__(self, file_path: str):
+        self.zf = zipfile.ZipFile(file_path)
+        self._names = set(self.zf.namelist())
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _parse(self, path: str) -> Optional[ET.Element]:
+        if path not in self._names:
+            return None
+        with self.zf.open(path) as f:
+            return ET.parse(f).getroot()
+
+    def _rels(self, part_path: str) -> Dict[str, Tuple[str, str]]:
+        """Id связи -> (тип, абсолютный путь цели) для части пакета."""
+        folder, name = posixpath.split(part_path)
+        root = self._parse(posixpath.join(folder, "_rels", name + ".rels"))
+        rels = {}
+        if root is None:
+            return rels
+        for rel in root.iter(f"{NS_PKG_REL}Relationship"):
+            if rel.get("TargetMode") == "External":
+                continue
+            target = rel.get("Target", "")
+            path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+            rels[rel.get("Id")] = (rel.get("Type", ""), path)
+        return rels
+
+    def slide_paths(self) -> List[str]:
+        """Пути слайдов в порядке показа; скрытые слайды (как и в экспорте в PDF) пропускаются."""
+        root = self._parse("ppt/presentation.xml")
+        if root is None:
+            raise ValueError("ppt/presentation.xml not found")
+        rels = self._rels("ppt/presentation.xml")
+        paths = []
+        for sld in root.iter(f"{NS_P}sldId"):
+            _, path = rels.get(sld.get(f"{NS_R}id"), ("", ""))
+            if path in self._names:
+                paths.append(path)
+        return paths
+
+    def read(self) -> List[Dict]:
+        slides = []
+        for path in self.slide_paths():
+            root = self._parse(path)
+            if root is None or root.get("show") in ("0", "false"):
+                continue
+            slide = self._read_slide(root)
+            slide["slide_num"] = len(slides) + 1
+            slide["notes"] = self._read_notes(path)
+            slides.append(slide)
+        return slides
+
+    # --- содержимое слайда ---
+
+    def _read_slide(self, root: ET.Element) -> Dict:
+        entities: List[Dict] = []
+        visuals: List[str] = []
+        title = ""
+        tree = root.find(f"{NS_P}cSld/{NS_P}spTree")
+        for shape in _ordered_shapes(tree) if tree is not None else []:
+            tag = shape.tag
+            if tag == f"{NS_P}pic":
+                visuals.append("picture")
+            elif tag == f"{NS_P}sp":
+                if shape.find(f"{NS_P}spPr/{NS_A}blipFill") is not None:
+                    visuals.append("picture")
+                ph_type = _placeholder_type(shape)
+                if ph_type in _SKIP_PLACEHOLDERS:
+                    continue
+                body = shape.find(f"{NS_P}txBody")
+                paragraphs = _paragraphs(body) if body is not None else []
+                if not paragraphs:
+                    continue
+                text = "\n".join(text for text, _ in paragraphs)
+                if ph_type in _TITLE_TYPES:
+                    role = "title"
+                    title = title or text
+                elif ph_type == "subTitle":
+                    role = "heading"
+                elif len(paragraphs) > 1 and any(bullet for _, bullet in paragraphs):
+                    role = "list"
+                else:
+                    role = "paragraph"
+                entities.append({"type": "text_block", "data": {"role": role, "text": text}})
+            elif tag == f"{NS_P}graphicFrame":
+                data = shape.find(f"{NS_A}graphic/{NS_A}graphicData")
+                uri = data.get("uri", "") if data is not None else ""
+                if uri == _URI_TABLE:
+                    table = _table(data.find(f"{NS_A}tbl"))
+                    if table:
+                        entities.append({"type": "table", "data": table})
+                elif uri in _VISUAL_URIS:
+                    visuals.append(_VISUAL_URIS[uri])
+
+        entities = [
+            {"id": f"E{idx}", "type": ent["type"], "confidence": 1.0, "source": "pptx_xml", "data": ent["data"]}
+            for idx, ent in enumerate(entities, start=1)
+        ]
+        return {"title": title, "entities": entities, "visuals": sorted(set(visuals))}
+
+    def _read_notes(self, slide_path: str) -> str:
+        for rel_type, path in self._rels(slide_path).values():
+            if not rel_type.endswith("/notesSlide"):
+                continue
+            root = self._parse(path)
+            if root is None:
+                return ""
+            parts = []
+            for shape in root.iter(f"{NS_P}sp"):
+                body = shape.find(f"{NS_P}txBody")
+                if _placeholder_type(shape) == "body" and body is not None:
+                    parts.extend(text for text, _ in _paragraphs(body))
+            return "\n".join(parts)
+        return ""
+
+
+def _placeholder_type(shape: ET.Element) -> Optional[str]:
+    ph = shape.find(f"{NS_P}nvSpPr/{NS_P}nvPr/{NS_P}ph")
+    if ph is None:
+        return None
+    return ph.get("type", "body")
+
+
+def _offset(shape: ET.Element) -> Tuple[int, int]:
+    """(y, x) верхнего левого угла фигуры в EMU; без координат — в конец."""
+    off = shape.find(f"{NS_P}spPr/{NS_A}xfrm/{NS_A}off")
+    if off is None:
+        off = shape.find(f"{NS_P}xfrm/{NS_A}off")
+    if off is None:
+        off = shape.find(f"{NS_P}grpSpPr/{NS_A}xfrm/{NS_A}off")
+    if off is None:
+        return (1 << 62, 1 << 62)
+    return int(off.get("y", 0)), int(off.get("x", 0))
+
+
+def _ordered_shapes(tree: ET.Element) -> List[ET.Element]:
+    """Фигуры в порядке чтения (сверху вниз, слева направо); группы раскрываются."""
+    shapes = []
+    for child in tree:
+        if child.tag == f"{NS_MC}AlternateContent":
+            choice = child.find(f"{NS_MC}Choice")
+            if choice is None:
+                choice = child.find(f"{NS_MC}Fallback")
+            shapes.extend(_ordered_shapes(choice) if choice is not None else [])
+        elif child.tag == f"{NS_P}grpSp":
+            shapes.append(child)
+        elif child.tag in (f"{NS_P}sp", f"{NS_P}pic", f"{NS_P}graphicFrame", f"{NS_P}cxnSp"):
+            shapes.append(child)
+    result = []
+    for shape in sorted(shapes, key=_offset):
+        if shape.tag == f"{NS_P}grpSp":
+            result.extend(_ordered_shapes(shape))
+        else:
+            result.append(shape)
+    return result
+
+
+def _paragraphs(body: ET.Element) -> List[Tuple[str, bool]]:
+    """Непустые абзацы текстовой рамки: (текст, есть ли маркер списка)."""
+    out = []
+    for p in body.iter(f"{NS_A}p"):
+        parts = []
+        for node in p:
+            if node.tag in (f"{NS_A}r", f"{NS_A}fld"):
+                parts.append(node.findtext(f"{NS_A}t", ""))
+            elif node.tag == f"{NS_A}br":
+                parts.append("\n")
+        text = "".join(parts).strip()
+        if not text:
+            continue
+        ppr = p.find(f"{NS_A}pPr")
+        bullet = ppr is not None and (
+            ppr.find(f"{NS_A}buChar") is not None or ppr.find(f"{NS_A}buAutoNum") is not None
+            or int(ppr.get("lvl", 0)) > 0
+        )
+        out.append((text, bullet))
+    return out
+
+
+def _table(tbl: Optional[ET.Element]) -> Optional[Dict]:
+    """Таблица слайда в формате сущности: первая строка — заголовки; продолжения объединений пустые."""
+    if tbl is None:
+        return None
+    grid = []
+    for tr in tbl.iter(f"{NS_A}tr"):
+        row = []
+        for tc in tr.findall(f"{NS_A}tc"):
+            if tc.get("hMerge") in ("1", "true") or tc.get("vMerge") in ("1", "true"):
+                row.append("")
+                continue
+            body = tc.find(f"{NS_A}txBody")
+            row.append("\n".join(text for text, _ in _paragraphs(body)) if body is not None else "")
+        grid.append(row)
+    if not any(any(cell for cell in row) for row in grid):
+        return None
+    return {"headers": grid[0], "rows": grid[1:]}
+
+
+def read_presentation(file_path: str) -> List[Dict]:
+    """
+    Слайды презентации: [{"slide_num", "title", "entities", "notes", "visuals"}].
+    visuals — причины отправить слайд в VLM: picture / chart / smartart / ole.
+    """
+    with PresentationReader(file_path) as reader:
+        return reader.read()
+
+
+def slide_extraction(slide: Dict) -> Dict:
+    """Результат слайда в формате ответа layout-промпта (metadata + entities)."""
+    metadata = {"type": "document", "source": "pptx_xml", "summary": slide["title"]}
+    if slide["notes"]:
+        metadata["notes"] = slide["notes"]
+    return {"metadata": metadata, "entities": slide["entities"]}
+
+
+# --- сборка результата презентации (пайплайн парсера и document_dispatcher) ---
+
+def load_slides(file_path: str) -> Optional[List[Dict]]:
+    """Слайды PPTX из XML; None — нестандартный пакет, нужен путь через конвертацию в PDF."""
+    try:
+        return read_presentation(file_path)
+    except Exception as e:
+        logger.warning(f"⚠️ {file_path}: не удалось прочитать слайды из XML ({type(e).__name__}: {e}), "
+                       f"файл пойдет через LibreOffice", exc_info=True)
+        return None
+
+
+def fallback_extraction(slide: Dict) -> Dict:
+    """
+    Результат визуального слайда без рендера: текст, таблицы и заметки из XML,
+    metadata.degraded — графика (metadata.visuals) не разобрана.
+    """
+    extraction = slide_extraction(slide)
+    extraction["metadata"].update(degraded=True, visuals=slide["visuals"])
+    return extraction
+
+
+def split_slides(slides: List[Dict]) -> Tuple[Dict[int, Dict], List[Dict]]:
+    """
+    Результаты всех слайдов из XML (номер -> результат) и визуальные слайды для рендера и VLM.
+    Для визуальных слайдов результат из XML — запасной, его заменяет ответ по рендеру.
+    """
+    results = {s["slide_num"]: fallback_extraction(s) if s["visuals"] else slide_extraction(s) for s in slides}
+    return results, [s for s in slides if s["visuals"]]
+
+
+def log_render_failure(file_path: str, error: Exception):
+    logger.warning(f"⚠️ {file_path}: слайды с графикой не отрендерены ({type(error).__name__}: {error}), "
+                   f"в результат идет текст из XML", exc_info=True)
+
+
+def degraded_slides(pages: List[Dict]) -> List[int]:
+    """Номера слайдов, для которых в результате только запасной текст из XML."""
+    return [item["page"] for item in pages if item["extraction"].get("metadata", {}).get("degraded")]
+
+
+def visual_subset_pdf(pdf_path: str, visual: List[Dict]) -> str:
+    """
+    PDF только из визуальных слайдов: страницы PDF совпадают с видимыми слайдами,
+    страница i подмножества — слайд visual[i - 1].
+    """
+    import fitz
+    subset_path = os.path.splitext(pdf_path)[0] + "_visual.pdf"
+    with fitz.open(pdf_path) as doc:
+        doc.select([s["slide_num"] - 1 for s in visual])
+        doc.save(subset_path)
+    return subset_path
+
+
+def merge_rendered(results: Dict[int, Dict], visual: List[Dict], rendered: Optional[List[Dict]]) -> List[Dict]:
+    """
+    Итог презентации в формате process_single_file: [{"page": номер слайда, "extraction": {...}}].
+    rendered — результаты страниц PDF из visual_subset_pdf в том же формате; визуальные слайды
+    без ответа остаются с запасным результатом из split_slides.
+    """
+    for item in rendered or []:
+        page = item.get("page", 0)
+        if not 1 <= page <= len(visual) or not item.get("extraction"):
+            continue
+        slide = visual[page - 1]
+        extraction = item["extraction"]
+        if slide["notes"]:
+            # Заметки докладчика в рендер слайда не попадают
+            extraction.setdefault("metadata", {})["notes"] = slide["notes"]
+        results[slide["slide_num"]] = extraction
+    return [{"page": slide_num, "extraction": results[slide_num]} for slide_num in sorted(results)]
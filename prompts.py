@@ -1,14 +1,10 @@
-def get_layout_prompt(pre_ocr, text_layer):
-    return f"""
+_LAYOUT_ROLE = """
 <ROLE>
 Ты — атомный парсер документов. Твоя цель: разбить страницу на независимые сущности. Запрещено объединять текст и графику в один объект, если они физически разнесены.
 </ROLE>
+""".strip()
 
-<INPUT_DATA>
-<PRE_OCR>{pre_ocr}</PRE_OCR>
-<TEXT_LAYER>{text_layer}</TEXT_LAYER>
-</INPUT_DATA>
-
+_LAYOUT_RULES = """
 <STRICT_RULES>
 1. **АТОМАРНОСТЬ**: Один логический блок на странице = одна сущность в JSON. Текст над картинкой — это "text_block". Сама картинка под ним — это "diagram_or_chart" или "figure". НЕ объединяй их.
 2. **ФОРМАТ МЕТОК**: Поле "extracted_labels" — это строго МАССИВ СТРОК `["label1", "label2"]`. Никаких вложенных объектов с "role" или "name" внутри этого массива!
@@ -19,15 +15,15 @@ def get_layout_prompt(pre_ocr, text_layer):
 
 <ENTITY_TYPES_CONFIG>
 - "text_block": 
-    * data: {{ "role": "title|heading|paragraph|list", "text": "..." }}
+    * data: { "role": "title|heading|paragraph|list", "text": "..." }
 - "table": 
-    * data: {{ "headers": ["col1", "col2"], "rows": [["val1", "val2"], ["val3", "val4"]] }}
+    * data: { "headers": ["col1", "col2"], "rows": [["val1", "val2"], ["val3", "val4"]] }
 - "diagram_or_chart": (для скриншотов ПО, схем, графиков)
-    * data: {{ "description": "функциональная суть", "extracted_labels": ["строка1", "строка2"] }}
+    * data: { "description": "функциональная суть", "extracted_labels": ["строка1", "строка2"] }
 - "figure": (только фото/иллюстрации без структуры)
-    * data: {{ "description": "что изображено" }}
+    * data: { "description": "что изображено" }
 - "form": (анкетные поля)
-    * data: {{ "fields": [{{ "name": "...", "value": "...", "checked": bool }}] }}
+    * data: { "fields": [{ "name": "...", "value": "...", "checked": bool }] }
 </ENTITY_TYPES_CONFIG>
 
 <ALGORITHM>
@@ -36,6 +32,27 @@ def get_layout_prompt(pre_ocr, text_layer):
 3. Если внутри графики есть текст, выпиши его ВЕСЬ в массив строк "extracted_labels".
 4. Сортируй entities строго по порядку чтения (сверху-вниз).
 </ALGORITHM>
+""".strip()
+
+
+_NATIVE_TABLES_NOTE = """
+<NOTE>
+Таблицы этой страницы уже извлечены из векторного слоя PDF и закрашены белым на изображении. Не ищи их и не выдумывай содержимое белых областей — разбери только остальные элементы.
+</NOTE>
+""".strip()
+
+
+def get_layout_prompt(pre_ocr, text_layer, tables_masked=False):
+    note = f"\n{_NATIVE_TABLES_NOTE}\n" if tables_masked else ""
+    return f"""
+{_LAYOUT_ROLE}
+
+<INPUT_DATA>
+<PRE_OCR>{pre_ocr}</PRE_OCR>
+<TEXT_LAYER>{text_layer}</TEXT_LAYER>
+</INPUT_DATA>
+{note}
+{_LAYOUT_RULES}
 
 <JSON_FORMAT>
 Верни ТОЛЬКО чистый JSON. Без ```json, без пояснений.
@@ -56,3 +73,74 @@ def get_layout_prompt(pre_ocr, text_layer):
 }}
 </JSON_FORMAT>
 """.strip()
+
+
+def get_batch_layout_prompt(items):
+    """
+    Промпт для нескольких изображений в одном запросе.
+    :param items: список (pre_ocr, text_layer[, tables_masked]) в порядке изображений
+    """
+    blocks = []
+    for idx, (pre_ocr, text_layer, *rest) in enumerate(items):
+        note = f"\n{_NATIVE_TABLES_NOTE}" if rest and rest[0] else ""
+        blocks.append(f"""<IMAGE index="{idx}">
+<PRE_OCR>{pre_ocr}</PRE_OCR>
+<TEXT_LAYER>{text_layer}</TEXT_LAYER>{note}
+</IMAGE>""")
+    inputs = "\n".join(blocks)
+    return f"""
+{_LAYOUT_ROLE}
+
+Тебе передано {len(items)} изображений. Каждое — отдельная страница: разбирай их НЕЗАВИСИМО, сущности разных изображений не смешивай.
+Нумерация изображений начинается с 0 и совпадает с порядком картинок в запросе.
+
+<INPUT_DATA>
+{inputs}
+</INPUT_DATA>
+
+{_LAYOUT_RULES}
+
+<JSON_FORMAT>
+Верни ТОЛЬКО чистый JSON. Без ```json, без пояснений. Ровно один элемент "results" на каждое изображение.
+{{
+  "results": [
+    {{
+      "index": 0,
+      "metadata": {{ "type": "...", "language": "...", "summary": "..." }},
+      "entities": [ {{ "id": "E1", "type": "...", "confidence": 0.0-1.0, "data": {{ ... }} }} ]
+    }}
+  ]
+}}
+</JSON_FORMAT>
+""".strip()
+
+
+def get_repair_prompt(broken_json, errors):
+    """Промпт для ремонта JSON без повторной отправки картинки."""
+    errors_text = "\n".join(f"- {e}" for e in errors)
+    return f"""
+<ROLE>
+Ты — валидатор JSON. Исправь ответ парсера документов так, чтобы он соответствовал схеме. Не придумывай новых данных.
+</ROLE>
+
+<ERRORS>
+{errors_text}
+</ERRORS>
+
+<BROKEN_JSON>
+{broken_json}
+</BROKEN_JSON>
+
+<SCHEMA>
+{{
+  "metadata": {{ "type": "...", "language": "...", "summary": "..." }},
+  "entities": [
+    {{ "id": "E1", "type": "text_block|table|diagram_or_chart|figure|form", "confidence": 0.0-1.0, "data": {{ ... }} }}
+  ]
+}}
+- "extracted_labels" — строго массив строк.
+- "table": data = {{ "headers": [...], "rows": [[...], ...] }}
+</SCHEMA>
+
+Верни ТОЛЬКО исправленный JSON. Без ```json, без пояснений.
+""".strip()
@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("LLMScheduler")
+
+# Межпроцессный семафор запросов к LLM; ставится воркерами document_dispatcher.
+# В одиночных запусках пайплайнов его нет — ограничения не действуют.
+_llm_semaphore = None
+_waiters = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm_slot")
+
+
+class LLMScheduler:
+    """
+    Очередь запросов к LLM внутри процесса: одновременно не больше capacity,
+    освободившийся слот получает самый дешевый из ожидающих (shortest-job-first).
+    Чтобы дорогие запросы не голодали, приоритет стареет: cost - aging_per_sec * ожидание.
+    """
+
+    def __init__(self, capacity: int, aging_per_sec: float):
+        self.capacity = capacity
+        self.aging_per_sec = aging_per_sec
+        self._cond = threading.Condition()
+        self._waiting: List[Tuple[float, float, int]] = []  # (стоимость, время постановки, порядковый номер)
+        self._active = 0
+        self._seq = itertools.count()
+
+    def _priority(self, entry: Tuple[float, float, int], now: float) -> Tuple[float, int]:
+        return entry[0] - self.aging_per_sec * (now - entry[1]), entry[2]
+
+    def acquire(self, cost: float):
+        entry = (cost, time.monotonic(), next(self._seq))
+        with self._cond:
+            self._waiting.append(entry)
+            while True:
+                if self._active < self.capacity:
+                    now = time.monotonic()
+                    if min(self._waiting, key=lambda e: self._priority(e, now)) is entry:
+                        break
+                self._cond.wait()
+            self._waiting.remove(entry)
+            self._active += 1
+            # Слотов может остаться несколько — пусть следующий кандидат тоже проверит
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+
+_scheduler: Optional[LLMScheduler] = None
+_queue_log: List[Tuple[str, float, float]] = []  # (метка, стоимость, ожидание в секундах)
+_queue_log_lock = threading.Lock()
+
+
+def install(llm_semaphore):
+    global _llm_semaphore
+    _llm_semaphore = llm_semaphore
+
+
+def configure(capacity: int, aging_per_sec: float):
+    """Очередь запросов процесса; capacity <= 0 — без очереди и лимита."""
+    global _scheduler
+    _scheduler = LLMScheduler(capacity, aging_per_sec) if capacity > 0 else None
+
+
+def _acquire(cost: float, label: str) -> Optional[LLMScheduler]:
+    started = time.monotonic()
+    scheduler = _scheduler
+    if scheduler is not None:
+        scheduler.acquire(cost)
+    if _llm_semaphore is not None:
+        try:
+            _llm_semaphore.acquire()
+        except BaseException:
+            if scheduler is not None:
+                scheduler.release()
+            raise
+    waited = time.monotonic() - started
+    with _queue_log_lock:
+        _queue_log.append((label, cost, waited))
+    logger.info(f"⏳ LLM {label or 'запрос'}: ожидание в очереди {waited:.2f} с, стоимость ~{cost:.0f} ток.")
+    return scheduler
+
+
+def _release(scheduler: Optional[LLMScheduler]):
+    if _llm_semaphore is not None:
+        _llm_semaphore.release()
+    if scheduler is not None:
+        scheduler.release()
+
+
+@contextmanager
+def llm_slot(cost: float = 0.0, label: str = ""):
+    """Слот общего бюджета LLM на время синхронного запроса; cost — оценка в токенах."""
+    if _scheduler is None and _llm_semaphore is None:
+        yield
+        return
+    scheduler = _acquire(cost, label)
+    try:
+        yield
+    finally:
+        _release(scheduler)
+
+
+@asynccontextmanager
+async def async_llm_slot(cost: float = 0.0, label: str = ""):
+    """То же для корутин: ожидание слота уходит в поток, event loop не блокируется."""
+    if _scheduler is None and _llm_semaphore is None:
+        yield
+        return
+    waiter = _waiters.submit(_acquire, cost, label)
+    try:
+        scheduler = await asyncio.wrap_future(waiter)
+    except asyncio.CancelledError:
+        # Уже запущенный поток все равно дождется слота — отдаем его обратно
+        waiter.add_done_callback(lambda f: _release(f.result()) if not f.cancelled() and not f.exception() else None)
+        raise
+    try:
+        yield
+    finally:
+        _release(scheduler)
+
+
+def queue_stats(reset: bool = False) -> Dict:
+    """Сводка ожидания в очереди LLM по запросам процесса (с прошлого reset)."""
+    with _queue_log_lock:
+        waits = sorted(w for _, _, w in _queue_log)
+        if reset:
+            _queue_log.clear()
+    if not waits:
+        return {"requests": 0}
+    return {
+        "requests": len(waits),
+        "avg_wait_sec": round(sum(waits) / len(waits), 3),
+        "p95_wait_sec": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3),
+        "max_wait_sec": round(waits[-1], 3),
+    }
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import shutil
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # быстрый бэкенд необязателен
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # бинарный формат необязателен
+    msgpack = None
+
+logger = logging.getLogger("Serializer")
+
+EXTENSIONS = {"json": ".json", "msgpack": ".msgpack"}
+_warned = False
+
+
+def resolve_format(fmt: str) -> str:
+    """msgpack без установленного пакета откатывается на json (с предупреждением один раз)."""
+    global _warned
+    if fmt == "msgpack" and msgpack is None:
+        if not _warned:
+            logger.warning("msgpack не установлен — результаты пишутся в JSON")
+            _warned = True
+        return "json"
+    return fmt if fmt in EXTENSIONS else "json"
+
+
+def result_path(path: str, fmt: str) -> str:
+    """Путь результата с расширением формата: out/doc.json -> out/doc.msgpack."""
+    return os.path.splitext(path)[0] + EXTENSIONS[resolve_format(fmt)]
+
+
+def dumps(obj: Any, fmt: str = "json", compact: bool = True) -> bytes:
+    fmt = resolve_format(fmt)
+    if fmt == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | (0 if compact else orjson.OPT_INDENT_2))
+    if compact:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def loads(data: bytes, fmt: str = "json") -> Any:
+    if fmt == "msgpack":
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class ResultWriter:
+    """
+    Потоковая запись списка или словаря: элементы сериализуются по одному и сразу
+    уходят в файл, весь результат строкой в памяти не собирается. Пишется во временный
+    файл, на место встает при close() — читатель не увидит недописанный результат.
+    """
+
+    def __init__(self, path: str, fmt: str = "json", compact: bool = True, mapping: bool = False):
+        self.fmt = resolve_format(fmt)
+        self.path = result_path(path, self.fmt)
+        self.compact = compact
+        self.mapping = mapping
+        self.count = 0
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._tmp = f"{self.path}.{os.getpid()}.tmp"
+        # У msgpack длина массива пишется в заголовке — элементы копятся в отдельном файле
+        self._body_path = self._tmp + ".body" if self.fmt == "msgpack" else self._tmp
+        self._f = open(self._body_path, "wb")
+        if self.fmt == "json":
+            self._f.write(b"{" if mapping else b"[")
+
+    def _json_chunk(self, obj: Any) -> bytes:
+        chunk = dumps(obj, "json", self.compact)
+        # В JSON переводы строк бывают только между токенами — сдвиг под вложенность безопасен
+        return chunk if self.compact else chunk.replace(b"\n", b"\n  ")
+
+    def _separator(self):
+        if self.fmt == "json":
+            self._f.write((b"," if self.count else b"") + (b"" if self.compact else b"\n  "))
+        self.count += 1
+
+    def append(self, item: Any):
+        self._separator()
+        self._f.write(self._json_chunk(item) if self.fmt == "json" else dumps(item, "msgpack"))
+
+    def put(self, key: str, value: Any):
+        self._separator()
+        if self.fmt == "json":
+            self._f.write(self._json_chunk(str(key)) + (b":" if self.compact else b": ") + self._json_chunk(value))
+        else:
+            self._f.write(dumps(key, "msgpack") + dumps(value, "msgpack"))
+
+    def close(self) -> str:
+        if self.fmt == "json":
+            closing = b"}" if self.mapping else b"]"
+            self._f.write(closing if self.compact or not self.count else b"\n" + closing)
+            self._f.close()
+        else:
+            self._f.close()
+            packer = msgpack.Packer(use_bin_type=True)
+            header = packer.pack_map_header(self.count) if self.mapping else packer.pack_array_header(self.count)
+            with open(self._tmp, "wb") as out, open(self._body_path, "rb") as body:
+                out.write(header)
+                shutil.copyfileobj(body, out)
+            os.remove(self._body_path)
+        os.replace(self._tmp, self.path)
+        return self.path
+
+    def abort(self):
+        self._f.close()
+        for path in {self._tmp, self._body_path}:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def write_result(path: str, obj: Any, fmt: str = "json", compact: bool = True) -> str:
+    """Запись результата; списки и словари — потоково. Возвращает итоговый путь."""
+    if not isinstance(obj, (list, dict)):
+        final_path = result_path(path, fmt)
+        tmp_path = f"{final_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dumps(obj, fmt, compact))
+        os.replace(tmp_path, final_path)
+        return final_path
+    writer = ResultWriter(path, fmt, compact, mapping=isinstance(obj, dict))
+    try:
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                writer.put(key, value)
+        else:
+            for item in obj:
+                writer.append(item)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def read_result(path: str, fmt: Optional[str] = None) -> Any:
+    """Чтение результата; формат — по расширению файла, если не задан."""
+    if fmt is None:
+        fmt = "msgpack" if path.endswith(EXTENSIONS["msgpack"]) else "json"
+    with open(path, "rb") as f:
+        return loads(f.read(), fmt)
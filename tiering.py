@@ -0,0 +1,54 @@
+from typing import Dict, Optional
+from config import TIER_CONFIDENCE_THRESHOLD, TIER_AGREEMENT_THRESHOLD, TIER_ENTITY_CONFIDENCE_FLOOR
+from llm_output import least_confident, mean_confidence, text_layer_agreement
+from utils import logger
+
+def escalation_reason(result: Optional[Dict], text_layer: str) -> Optional[str]:
+    """Причина повторной отправки страницы в высоком разрешении; None — ответ принят."""
+    if not result or not result.get("entities"):
+        return "пустой ответ"
+    conf = mean_confidence(result)
+    if conf is not None and conf < TIER_CONFIDENCE_THRESHOLD:
+        return f"уверенность {conf:.2f}"
+    weakest = least_confident(result)
+    if weakest is not None and weakest["confidence"] < TIER_ENTITY_CONFIDENCE_FLOOR:
+        return f"сущность {weakest.get('id', '?')} ({weakest.get('type', '?')}): уверенность {weakest['confidence']:.2f}"
+    agreement = text_layer_agreement(result, text_layer)
+    if agreement is not None and agreement < TIER_AGREEMENT_THRESHOLD:
+        return f"совпадение с текстовым слоем {agreement:.2f}"
+    return None
+
+class TierStats:
+    """
+    Счетчик попаданий по уровням разрешения. failed — эскалация без ответа
+    в полном разрешении (страница осталась с результатом низкого уровня).
+    """
+
+    def __init__(self):
+        self.counts = {"low": 0, "high": 0, "failed": 0}
+        self.reasons: Dict[str, int] = {}
+
+    def hit(self, tier: str):
+        self.counts[tier] += 1
+
+    def escalated(self, reason: str):
+        key = reason.split()[0]
+        self.reasons[key] = self.reasons.get(key, 0) + 1
+
+    def report(self) -> Dict:
+        total = sum(self.counts.values()) or 1
+        return {
+            "pages": sum(self.counts.values()),
+            "low_hit_rate": round(self.counts["low"] / total, 3),
+            "high_hit_rate": round(self.counts["high"] / total, 3),
+            "high_failed": self.counts["failed"],
+            "escalation_reasons": dict(self.reasons),
+        }
+
+    def log(self):
+        rep = self.report()
+        logger.info(
+            f"🎚️ Уровни разрешения: low {rep['low_hit_rate']:.0%}, high {rep['high_hit_rate']:.0%} "
+            f"из {rep['pages']} стр. (без ответа в high: {rep['high_failed']}); "
+            f"причины эскалации: {rep['escalation_reasons']}"
+        )
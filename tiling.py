@@ -0,0 +1,297 @@
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import fitz
+from config import (MAX_IMAGE_WIDTH, TILE_TRIGGER_PAGE_AREA, TILE_TRIGGER_QUALITY, TILE_OVERLAP,
+                    TILE_MAX_TILES, TILE_CONCURRENCY)
+from image_utils import process_and_compress_image
+from native_tables import mask_rects, text_outside
+from prompts import get_layout_prompt
+from llm_client import call_gemma_sync
+from utils import logger, timer
+
+# Эталонный лист A4 в пунктах PDF: при MAX_IMAGE_WIDTH он еще читается моделью
+A4_WIDTH_PT, A4_HEIGHT_PT = 595.0, 842.0
+
+
+def needs_tiling(page, jpeg_quality: int) -> bool:
+    """Страница слишком крупная или сжатие уронило качество JPEG до нечитаемого."""
+    area_ratio = (page.rect.width * page.rect.height) / (A4_WIDTH_PT * A4_HEIGHT_PT)
+    return area_ratio >= TILE_TRIGGER_PAGE_AREA or jpeg_quality <= TILE_TRIGGER_QUALITY
+
+
+def tile_grid(rect, dense: bool = False) -> Tuple[int, int]:
+    """Сетка (строки, колонки) так, чтобы масштаб тайла был не хуже A4 целиком."""
+    cols = max(1, math.ceil(rect.width / A4_WIDTH_PT - 0.1))
+    rows = max(1, math.ceil(rect.height / A4_HEIGHT_PT - 0.1))
+    if dense and rows * cols == 1:
+        # Плотная страница обычного формата: режем пополам по высоте
+        rows = 2
+    while rows * cols > TILE_MAX_TILES:
+        if rows >= cols:
+            rows -= 1
+        else:
+            cols -= 1
+    return rows, cols
+
+
+def tile_rects(rect, rows: int, cols: int) -> List[List["fitz.Rect"]]:
+    """Прямоугольники тайлов с перекрытием TILE_OVERLAP, построчно."""
+    step_w, step_h = rect.width / cols, rect.height / rows
+    pad_w, pad_h = step_w * TILE_OVERLAP, step_h * TILE_OVERLAP
+    grid = []
+    for r in range(rows):
+        line = []
+        for c in range(cols):
+            line.append(fitz.Rect(
+                max(rect.x0, rect.x0 + c * step_w - pad_w),
+                max(rect.y0, rect.y0 + r * step_h - pad_h),
+                min(rect.x1, rect.x0 + (c + 1) * step_w + pad_w),
+                min(rect.y1, rect.y0 + (r + 1) * step_h + pad_h),
+            ))
+        grid.append(line)
+    return grid
+
+
+def prepare_tiles(page, ocr_manager, dense: bool = False, masked: Optional[List] = None) -> List[List[Dict]]:
+    """
+    Рендер тайлов в читаемом разрешении и OCR-подсказки для каждого.
+    :param masked: прямоугольники уже извлеченных векторных таблиц
+    """
+    rows, cols = tile_grid(page.rect, dense)
+    logger.info(f"🧩 Страница {page.number + 1}: тайлинг {rows}x{cols}")
+    grid = []
+    for r, line in enumerate(tile_rects(page.rect, rows, cols)):
+        items = []
+        for c, clip in enumerate(line):
+            # Рендерим сразу в целевую ширину, чтобы не пережимать при сжатии
+            matrix = fitz.Matrix(MAX_IMAGE_WIDTH / clip.width, MAX_IMAGE_WIDTH / clip.width)
+            pix = page.get_pixmap(matrix=matrix, clip=clip)
+            if masked:
+                mask_rects(pix, masked, matrix)
+            b64_img = process_and_compress_image(pix.tobytes("jpeg"))
+            with timer("EasyOCR (тайл)"):
+                pre_ocr = ocr_manager.get_preocr_data(b64_img)
+            items.append({
+                "text_layer": text_outside(page, masked, clip) if masked else page.get_text("text", clip=clip).strip(),
+                "pre_ocr": pre_ocr,
+                "b64": b64_img,
+                "tables_masked": bool(masked),
+                "label": f"стр. {page.number + 1}, тайл {r + 1}x{c + 1}",
+            })
+        grid.append(items)
+    return grid
+
+
+def _extract_tile(item: Dict) -> Optional[Dict]:
+    prompt = get_layout_prompt(item["pre_ocr"], item["text_layer"], item.get("tables_masked", False))
+    return call_gemma_sync(prompt, item["b64"], label=item.get("label", "тайл"))
+
+
+def extract_tiled(grid: List[List[Dict]]) -> Optional[Dict]:
+    """Параллельное извлечение тайлов и сшивка результата."""
+    flat = [item for line in grid for item in line]
+    with timer(f"Тайлы ({len(flat)} шт.)"):
+        with ThreadPoolExecutor(max_workers=TILE_CONCURRENCY) as pool:
+            flat_results = list(pool.map(_extract_tile, flat))
+
+    results, pos = [], 0
+    for line in grid:
+        results.append(flat_results[pos:pos + len(line)])
+        pos += len(line)
+    return stitch_tile_results(results)
+
+
+# --- Сшивка ---
+
+def _norm(value) -> str:
+    return re.sub(r"\s+", " ", str(value)).strip().lower()
+
+
+def _row_key(row) -> tuple:
+    return tuple(_norm(v) for v in row)
+
+
+def _merge_columns(left: Dict, right: Dict) -> bool:
+    """
+    Склейка соседних по горизонтали частей таблицы: одинаковое число строк
+    и хотя бы одна общая колонка из зоны перекрытия (она не дублируется).
+    """
+    l_rows, r_rows = left.get("rows") or [], right.get("rows") or []
+    if not l_rows or len(l_rows) != len(r_rows):
+        return False
+    l_head, r_head = left.get("headers") or [], right.get("headers") or []
+    overlap = 0
+    for k in range(min(len(l_rows[0]), len(r_rows[0])), 0, -1):
+        if (all(_row_key(a[-k:]) == _row_key(b[:k]) for a, b in zip(l_rows, r_rows))
+                and _row_key(l_head[-k:]) == _row_key(r_head[:k])):
+            overlap = k
+            break
+    if not overlap:
+        return False
+    left["headers"] = l_head + r_head[overlap:]
+    left["rows"] = [a + b[overlap:] for a, b in zip(l_rows, r_rows)]
+    return True
+
+
+def _merge_rows(target: Dict, source: Dict):
+    """
+    Склейка продолжения таблицы снизу. Дублем считается только полоса перекрытия —
+    самый длинный хвост target, совпадающий с началом source; одинаковые строки
+    вне нее (пустые, "—/0", повторяющиеся позиции) сохраняются.
+    """
+    rows = target.setdefault("rows", [])
+    new_rows = source.get("rows") or []
+    tail = [_row_key(r) for r in rows[-len(new_rows):]] if new_rows else []
+    head = [_row_key(r) for r in new_rows[:len(tail)]]
+    overlap = next((k for k in range(len(tail), 0, -1) if tail[-k:] == head[:k]), 0)
+    rows.extend(new_rows[overlap:])
+
+
+def _continue_rows(target: Dict, source: Dict) -> bool:
+    """
+    Продолжение таблицы в тайле ниже. Шапка у продолжения бывает повторенной,
+    пустой или это первая строка данных, принятая моделью за шапку, — последнее
+    принимается, только если эта строка есть в хвосте target (полоса перекрытия).
+    Число колонок должно совпадать.
+    """
+    t_head, s_head = target.get("headers") or [], source.get("headers") or []
+    s_rows = source.get("rows") or []
+    t_rows = target.get("rows") or []
+    width = len(t_head) or (len(t_rows[0]) if t_rows else 0)
+    if t_head and _row_key(s_head) == _row_key(t_head):
+        rows = s_rows
+    elif not any(_norm(h) for h in s_head):
+        rows = s_rows
+    elif len(s_head) == width and _row_key(s_head) in {_row_key(r) for r in t_rows[-(len(s_rows) + 1):]}:
+        rows = [list(s_head)] + s_rows
+    else:
+        return False
+    if width and rows and len(rows[0]) != width:
+        return False
+    _merge_rows(target, {"rows": rows})
+    return True
+
+
+def _stitch_rows(above: List[Dict], below: List[Dict]) -> set:
+    """
+    Склейка таблиц соседних рядов тайлов: нижняя таблица ряда выше продолжается
+    верхней таблицей ряда ниже в тех же колонках тайлов. Записи — {"data", "cols"}.
+    Возвращает id данных таблиц ряда below, вошедших в таблицы выше;
+    продолжившаяся запись ряда выше занимает их место в below.
+    """
+    bottom: Dict[int, Dict] = {}
+    for rec in above:
+        for col in rec["cols"]:
+            bottom[col] = rec
+    covered, used, merged = set(), set(), set()
+    for i, rec in enumerate(below):
+        top_cols = rec["cols"] - covered
+        covered |= rec["cols"]
+        target = next((bottom[col] for col in sorted(top_cols) if col in bottom), None)
+        if target is None or id(target) in used or not _continue_rows(target["data"], rec["data"]):
+            continue
+        used.add(id(target))
+        merged.add(id(rec["data"]))
+        target["cols"] = target["cols"] | rec["cols"]
+        below[i] = target
+    return merged
+
+
+def _is_duplicate_text(kept: List[Dict], ent: Dict) -> bool:
+    """Текст из зоны перекрытия: совпадает или целиком входит в уже найденный."""
+    text = _norm(ent.get("data", {}).get("text", ""))
+    if not text:
+        return False
+    for other in kept:
+        if other.get("type") != "text_block":
+            continue
+        other_text = _norm(other.get("data", {}).get("text", ""))
+        if text == other_text or (len(text) >= 20 and text in other_text):
+            return True
+        if len(other_text) >= 20 and other_text in text:
+            # Новый фрагмент полнее — заменяем старый
+            other["data"]["text"] = ent["data"]["text"]
+            return True
+    return False
+
+
+def _add_entity(kept: List[Dict], ent: Dict):
+    e_type, data = ent.get("type"), ent.get("data") or {}
+    if e_type == "text_block":
+        if _is_duplicate_text(kept, ent):
+            return
+    elif e_type in ("diagram_or_chart", "figure"):
+        desc = _norm(data.get("description", ""))
+        for other in kept:
+            if other.get("type") == e_type and desc and _norm(other["data"].get("description", "")) == desc:
+                labels = other["data"].setdefault("extracted_labels", [])
+                labels += [l for l in data.get("extracted_labels", []) if l not in labels]
+                return
+    elif e_type == "form":
+        seen = {(_norm(f.get("name", "")), _norm(f.get("value", "")))
+                for other in kept if other.get("type") == "form"
+                for f in other["data"].get("fields", []) if isinstance(f, dict)}
+        data["fields"] = [f for f in data.get("fields", []) if not isinstance(f, dict)
+                          or (_norm(f.get("name", "")), _norm(f.get("value", ""))) not in seen]
+        if not data["fields"]:
+            return
+    kept.append(ent)
+
+
+def stitch_tile_results(grid: List[List[Optional[Dict]]]) -> Optional[Dict]:
+    """
+    Сборка сущностей тайлов в одну страницу: сначала склейка таблиц внутри
+    ряда тайлов по колонкам, затем сверху вниз — с таблицей тайла выше в тех же
+    колонках — и удаление дублей из перекрытий.
+    """
+    metadata, summaries, ordered = {}, [], []
+    above: List[Dict] = []  # таблицы предыдущего ряда: {"data", "cols"}
+    for line in grid:
+        prev_tables: List[Dict] = []
+        line_entities, line_tables = [], []
+        for col, res in enumerate(line):
+            if not res:
+                prev_tables = []
+                continue
+            if not metadata and res.get("metadata"):
+                metadata = dict(res["metadata"])
+            summary = (res.get("metadata") or {}).get("summary")
+            if summary and summary not in summaries:
+                summaries.append(summary)
+
+            cur_tables = []
+            for ent in res.get("entities") or []:
+                if not isinstance(ent, dict) or not isinstance(ent.get("data"), dict):
+                    continue
+                if ent.get("type") == "table":
+                    partner = next((t for t in prev_tables if _merge_columns(t["data"], ent["data"])), None)
+                    if partner is not None:
+                        # Склеенная таблица может продолжиться и в следующем тайле ряда
+                        prev_tables.remove(partner)
+                        partner["cols"].add(col)
+                        cur_tables.append(partner)
+                        continue
+                    record = {"data": ent["data"], "cols": {col}}
+                    cur_tables.append(record)
+                    line_tables.append(record)
+                line_entities.append(ent)
+            prev_tables = cur_tables
+        continued = _stitch_rows(above, line_tables)
+        ordered.extend(ent for ent in line_entities if id(ent["data"]) not in continued)
+        above = line_tables
+
+    if not ordered and not metadata:
+        return None
+
+    kept: List[Dict] = []
+    for ent in ordered:
+        _add_entity(kept, ent)
+    for idx, ent in enumerate(kept, start=1):
+        ent["id"] = f"E{idx}"
+
+    if summaries:
+        metadata["summary"] = " ".join(summaries)
+    metadata["tiles"] = sum(len(line) for line in grid)
+    return {"metadata": metadata, "entities": kept}
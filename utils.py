@@ -23,3 +23,7 @@ def timer(name: str):
 
 def get_base64_size_kb(b64_str: str) -> float:
     return (len(b64_str) * 3 / 4) / 1024
+
+def estimate_text_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (смешанный ru/en текст ~3 символа на токен)."""
+    return len(text) // 3 + 1 if text else 0
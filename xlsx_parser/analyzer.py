@@ -1,15 +1,28 @@
 import openpyxl
 from openpyxl.utils import get_column_letter
+import hashlib
+import io
 import logging
 import os
-import uuid
 import asyncio
-import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import groupby
 from typing import Dict, List, Optional, Callable, Any
+from clustering import cluster_spans
+from grid import SheetGrid
+from image_cache import ImageAnalysisCache, image_digest
+from merged import MergedIndex, range_ref
+from reader import SheetData, StreamingWorkbookReader, iter_sheets_openpyxl
+from table_export import TableWriter, export_base
 
 # Импортируем настройки по умолчанию
 try:
-    from config import DEFAULT_SETTINGS
+    from config import (DEFAULT_SETTINGS, XLSX_STREAMING_LOADER, XLSX_SHEET_WORKERS, XLSX_PARALLEL_MIN_CELLS,
+                        XLSX_IMAGE_CONCURRENCY, XLSX_IMAGE_CACHE, XLSX_IMAGE_CACHE_DIR,
+                        XLSX_IMAGE_CACHE_MAX_ENTRIES, XLSX_TABLE_EXPORT, XLSX_TABLE_EXPORT_DIR,
+                        XLSX_TABLE_EXPORT_FORMAT, XLSX_TABLE_EXPORT_BATCH_ROWS)
 except ImportError:
     # Запасной вариант, если config.py не найден
     DEFAULT_SETTINGS = {
@@ -20,9 +33,44 @@ except ImportError:
         "VALIDATION_THRESHOLD": 0.98,
         "SHOW_MERGED_MAP": True
     }
+    XLSX_STREAMING_LOADER = True
+    XLSX_SHEET_WORKERS = 0
+    XLSX_PARALLEL_MIN_CELLS = 20000
+    XLSX_IMAGE_CONCURRENCY = 8
+    XLSX_IMAGE_CACHE = False
+    XLSX_IMAGE_CACHE_DIR = "image_analysis_cache"
+    XLSX_IMAGE_CACHE_MAX_ENTRIES = 5000
+    XLSX_TABLE_EXPORT = False
+    XLSX_TABLE_EXPORT_DIR = "table_exports"
+    XLSX_TABLE_EXPORT_FORMAT = "parquet"
+    XLSX_TABLE_EXPORT_BATCH_ROWS = 10000
 
 logger = logging.getLogger("ExcelAnalyzer")
 
+
+def workbook_dirname(file_path: str) -> str:
+    """Имя папки результатов книги с расширением: a.xlsx и a.xlsm в одном пакете не смешиваются."""
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    return f"{stem}_{ext.lstrip('.').lower()}" if ext else stem
+
+
+class _WorkbookState:
+    """Разобранная книга, переиспользуемая между итерациями тюнинга."""
+    __slots__ = ("signature", "order", "sheets", "complete", "images", "image_tasks", "reports", "export_dir",
+                 "shared_strings")
+
+    def __init__(self, signature: tuple, export_dir: Optional[str] = None):
+        self.signature = signature              # (mtime_ns, size) файла
+        self.order: List[str] = []              # порядок листов в книге
+        self.sheets: Dict[str, SheetData] = {}  # сетки и индексы объединений
+        self.complete = False                   # загружены все листы
+        self.images: Dict[str, List[Dict]] = {}  # лист -> ответы VLM
+        self.image_tasks: Dict[str, asyncio.Future] = {}  # хэш картинки -> ответ VLM (первая копия)
+        self.reports: Dict[str, tuple] = {}      # лист -> (ключ параметров, отчет)
+        self.export_dir = export_dir            # каталог выгрузки таблиц книги (None — без выгрузки)
+        self.shared_strings: Optional[List[str]] = None  # общие строки, пока не загружены все листы
+
+
 class RobustExcelParser:
     def __init__(self, global_config: Optional[Dict] = None):
         """
@@ -31,10 +79,15 @@ class RobustExcelParser:
         """
         self.global_config = global_config or DEFAULT_SETTINGS.copy()
         self.sheet_configs: Dict[str, Dict] = {}
-        self.temp_dir = "temp_vlm_images"
-        
-        if not os.path.exists(self.temp_dir):
-            os.makedirs(self.temp_dir)
+        self._states: Dict[str, _WorkbookState] = {}  # abspath -> разобранная книга
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Ограничение одновременных обращений к VLM по картинкам (на все листы сразу)
+        self._image_semaphore: Optional[asyncio.Semaphore] = None
+        self._image_semaphore_loop = None
+        # Ответы VLM по хэшу картинки между файлами
+        self._image_cache: Optional[ImageAnalysisCache] = (
+            ImageAnalysisCache(XLSX_IMAGE_CACHE_DIR, XLSX_IMAGE_CACHE_MAX_ENTRIES) if XLSX_IMAGE_CACHE else None
+        )
 
     def set_sheet_config(self, sheet_name: str, params: Dict):
         """Установка индивидуальных параметров для конкретного листа."""
@@ -47,21 +100,6 @@ class RobustExcelParser:
         """Получение параметров для листа (индивидуальных или глобальных)."""
         return self.sheet_configs.get(sheet_name, self.global_config)
 
-    def _is_significant(self, cell, in_merged: bool) -> bool:
-        """Проверка ячейки на наличие данных, границ или заливки."""
-        if cell.value is not None and str(cell.value).strip() != "":
-            return True
-        if in_merged:
-            return True
-        # Проверка границ
-        b = cell.border
-        if b and any([b.left.style, b.right.style, b.top.style, b.bottom.style]):
-            return True
-        # Проверка заливки
-        if cell.fill and cell.fill.patternType and cell.fill.patternType != 'none':
-            return True
-        return False
-
     async def parse_file(
         self, 
         file_path: str, 
@@ -71,214 +109,533 @@ class RobustExcelParser:
     ) -> Dict:
         """
         Основной метод парсинга файла.
-        :param vlm_callback: Асинхронная функция вида func(session, file_path, filename)
+        Сетки листов, индексы объединений и ответы VLM по картинкам кэшируются
+        между вызовами: повторный прогон с другими допусками только перекластеризует
+        листы, у которых изменились параметры.
+        :param image_callback: Асинхронная функция вида func(session, image_bytes, filename)
         :param target_sheets: Список листов для обработки. Если None - все.
         """
         logger.info(f"Opening workbook: {file_path}")
+        loop = asyncio.get_running_loop()
         try:
-            # data_only=True позволяет получать значения формул
-            wb = openpyxl.load_workbook(file_path, data_only=True)
+            state = self._get_state(file_path)
+            # Разбор XML — CPU-работа: выносим из event loop
+            await loop.run_in_executor(None, self._load_sheets, file_path, state, target_sheets)
         except Exception as e:
             logger.error(f"Failed to load workbook: {e}")
             return {"error": str(e)}
 
-        manifest = {}
-        
-        # Определяем список листов для обработки
-        worksheets = wb.worksheets
-        if target_sheets:
-            worksheets = [s for s in wb.worksheets if s.title in target_sheets]
+        titles = [
+            title for title in state.order
+            if title in state.sheets and (not target_sheets or title in target_sheets)
+        ]
+
+        async def run_sheet(title: str) -> Dict:
+            sheet = state.sheets[title]
+            params = self._get_params(title)
+            key = self._params_key(params)
 
-        for sheet in worksheets:
-            params = self._get_params(sheet.title)
+            cached = state.reports.get(title)
+            if cached and cached[0] == key:
+                logger.info(f"Sheet {title}: params unchanged, reusing report")
+                return dict(cached[1])
             logger.info(f"Processing sheet: {sheet.title} with params: {params}")
-            
-            sheet_data = await self._process_sheet(sheet, params, image_callback, session)
-            if sheet_data:
-                manifest[sheet.title] = sheet_data
+            sheet_data = await self._process_sheet(sheet, params, image_callback, session, state)
+            state.reports[title] = (key, sheet_data)
+            return dict(sheet_data)
 
-        # Очистка временной папки после всего процесса
-        self._cleanup_temp()
-        
+        # Листы обрабатываются параллельно; манифест собирается в порядке книги
+        results = await asyncio.gather(*(run_sheet(title) for title in titles))
+        manifest = {title: data for title, data in zip(titles, results) if data}
+        if self._image_cache:
+            self._image_cache.evict()
         return manifest
 
-    async def _process_sheet(self, sheet, params, image_callback, session) -> Dict:
-        sig_data = {}
-        merged_lookup = {}
-        
-        # 1. Кэшируем объединенные ячейки
-        for rng in sheet.merged_cells.ranges:
-            for r in range(rng.min_row, rng.max_row + 1):
-                for c in range(rng.min_col, rng.max_col + 1):
-                    merged_lookup[(r, c)] = rng
-
-        # 2. Собираем все значимые координаты
-        for row in sheet.iter_rows():
-            for cell in row:
-                if self._is_significant(cell, (cell.row, cell.column) in merged_lookup):
-                    sig_data[(cell.row, cell.column)] = cell.value
-
-        if not sig_data:
+    def close(self):
+        """Остановка пула процессов сегментации."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if XLSX_SHEET_WORKERS <= 1:
+            return None
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=XLSX_SHEET_WORKERS)
+        return self._pool
+
+    async def _segment(self, sheet: SheetData, params: Dict, export_dir: Optional[str] = None) -> Dict:
+        """
+        Сегментация листа вне event loop: крупные листы — в пул процессов
+        (туда уходит только сетка, без картинок), мелкие — в пул потоков.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool() if len(sheet.grid) >= XLSX_PARALLEL_MIN_CELLS else None
+        if pool is not None:
+            try:
+                return await loop.run_in_executor(pool, segment_sheet, _grid_only(sheet), params, export_dir)
+            except BrokenProcessPool as e:
+                logger.warning(f"Sheet worker pool failed ({e}), falling back to threads")
+                self._pool = None
+        return await loop.run_in_executor(None, segment_sheet, sheet, params, export_dir)
+
+    def clear_cache(self, file_path: Optional[str] = None):
+        """Сброс кэша разобранных книг (одной или всех)."""
+        if file_path is None:
+            self._states.clear()
+        else:
+            self._states.pop(os.path.abspath(file_path), None)
+
+    def prune_exports(self, file_path: str, manifest: Dict) -> int:
+        """
+        Удаляет выгрузки таблиц книги, на которые не ссылается итоговый манифест:
+        файлы отвергнутых попыток и пресетов. Возвращает число удаленных файлов.
+        """
+        if not XLSX_TABLE_EXPORT:
+            return 0
+        export_dir = os.path.join(XLSX_TABLE_EXPORT_DIR, workbook_dirname(os.path.abspath(file_path)))
+        if not os.path.isdir(export_dir):
+            return 0
+        keep = {
+            os.path.abspath(region["export"]["path"])
+            for report in manifest.values() if isinstance(report, dict)
+            for region in report.get("regions") or [] if region.get("export")
+        }
+        removed = 0
+        for folder, _, names in os.walk(export_dir, topdown=False):
+            for name in names:
+                path = os.path.abspath(os.path.join(folder, name))
+                if path not in keep:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError as e:
+                        logger.warning(f"Cannot remove stale table export {path}: {e}")
+            if folder != export_dir and not os.listdir(folder):
+                os.rmdir(folder)
+        if removed:
+            logger.info(f"Removed {removed} table exports not referenced by the final result of {file_path}")
+        return removed
+
+    def sheet_digests(self, file_path: str) -> Dict[str, str]:
+        """Отпечатки содержимого листов (в порядке книги); пусто, если пакет не читается потоково."""
+        try:
+            state = self._get_state(file_path)
+            with StreamingWorkbookReader(file_path, state.shared_strings) as reader:
+                # Общие строки остаются в состоянии книги — загрузка листов их не перечитывает
+                state.shared_strings = reader.shared_strings
+                return reader.sheet_digests()
+        except Exception as e:
+            logger.warning(f"Cannot fingerprint sheets of {file_path}: {e}")
+            return {}
+
+    def _get_state(self, file_path: str) -> "_WorkbookState":
+        """Состояние книги из кэша; если файл изменился на диске — новое."""
+        path = os.path.abspath(file_path)
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        state = self._states.get(path)
+        if state is None or state.signature != signature:
+            export_dir = None
+            if XLSX_TABLE_EXPORT:
+                export_dir = os.path.join(XLSX_TABLE_EXPORT_DIR, workbook_dirname(path))
+            state = self._states[path] = _WorkbookState(signature, export_dir)
+        return state
+
+    def _load_sheets(self, file_path: str, state: "_WorkbookState", target_sheets: Optional[List[str]]):
+        """Читает с диска только листы, которых еще нет в кэше."""
+        if target_sheets:
+            wanted = [t for t in target_sheets if t not in state.sheets]
+            if state.order:
+                # Книга уже открывалась: несуществующие листы не перечитываем
+                wanted = [t for t in wanted if t in state.order]
+                if not wanted:
+                    return
+        elif state.complete:
+            return
+        else:
+            wanted = None
+
+        loaded = False
+        if XLSX_STREAMING_LOADER:
+            try:
+                loaded = self._load_streaming(file_path, state, wanted)
+                if not loaded:
+                    logger.warning(f"Streaming loader found no worksheets in {file_path}, falling back to openpyxl")
+            except Exception as e:
+                # Нестандартный пакет: часть книги не по xl/workbook.xml, strict-OOXML и т. п.
+                logger.warning(f"Streaming loader failed for {file_path} ({type(e).__name__}: {e}), "
+                               f"falling back to openpyxl")
+        if not loaded:
+            # data_only=True позволяет получать значения формул
+            wb = openpyxl.load_workbook(file_path, data_only=True)
+            state.order = [ws.title for ws in wb.worksheets]
+            for sheet in iter_sheets_openpyxl(wb, wanted):
+                if sheet.title not in state.sheets:
+                    state.sheets[sheet.title] = sheet
+        if wanted is None:
+            state.complete = True
+        if state.complete:
+            state.shared_strings = None
+
+    @staticmethod
+    def _load_streaming(file_path: str, state: "_WorkbookState", wanted: Optional[List[str]]) -> bool:
+        """Потоковое чтение XML листов без объектной модели openpyxl; False — в книге не нашлось листов."""
+        with StreamingWorkbookReader(file_path, state.shared_strings) as reader:
+            if not reader.sheets:
+                return False
+            state.shared_strings = reader.shared_strings
+            state.order = [title for title, _ in reader.sheets]
+            for sheet in reader.iter_sheets(wanted):
+                if sheet.title not in state.sheets:
+                    state.sheets[sheet.title] = sheet
+        return True
+
+    @staticmethod
+    def _params_key(params: Dict) -> tuple:
+        return tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+    async def _process_sheet(self, sheet: SheetData, params, image_callback, session,
+                             state: Optional["_WorkbookState"] = None) -> Dict:
+        # 1-2. Сетка значимых ячеек уже собрана загрузчиком (значения, границы, заливки, объединения)
+        grid = sheet.grid
+
+        if not len(grid):
             return {"status": "empty"}
 
-        # 3. Обработка изображений (если есть)
+        # Попытки с разными параметрами выгружают таблицы в свои подкаталоги:
+        # выгрузка выбранной попытки не перезаписывается следующими
+        export_dir = None
+        if state and state.export_dir:
+            key = hashlib.sha1(repr(self._params_key(params)).encode("utf-8")).hexdigest()[:10]
+            export_dir = os.path.join(state.export_dir, f"params_{key}")
+
+        # 3. Обработка изображений (если есть) и 4-5. кластеризация с анализом регионов — одновременно
+        vlm_results, report = await asyncio.gather(
+            self._sheet_images(sheet, image_callback, session, state),
+            self._segment(sheet, params, export_dir),
+        )
+        report["vlm_data"] = vlm_results
+        return report
+
+    async def _sheet_images(self, sheet: SheetData, image_callback, session,
+                            state: Optional["_WorkbookState"] = None) -> List[Dict]:
+        """Ответы VLM по картинкам листа — один раз на лист за время жизни кэша."""
+        vlm_results = state.images.get(sheet.title) if state else None
+        if vlm_results is not None:
+            return vlm_results
         vlm_results = []
-        if hasattr(sheet, '_images') and sheet._images:
-            for idx, img in enumerate(sheet._images):
-                vlm_res = await self._handle_image(img, sheet.title, image_callback, session)
-                if vlm_res:
-                    vlm_results.append(vlm_res)
-
-        # 4. Кластеризация
-        clusters = self._cluster_regions(list(sig_data.keys()), params)
-        
-        # 5. Анализ регионов
+        if sheet.images:
+            # Вызовы запускаются одновременно, чтобы callback мог склеить их в один запрос
+            handled = await asyncio.gather(*(
+                self._handle_image(img, sheet.title, image_callback, session, state)
+                for img in sheet.images
+            ))
+            vlm_results = [res for res in handled if res]
+        if state:
+            state.images[sheet.title] = vlm_results
+            # Байты картинок больше не нужны: ответы VLM уже в кэше
+            sheet.images = []
+        return vlm_results
+
+    async def parse_file_presets(
+        self,
+        file_path: str,
+        presets: Dict[str, Dict],
+        target_sheets: Optional[List[str]] = None,
+        image_callback: Optional[Callable] = None,
+        session: Any = None
+    ) -> Dict:
+        """
+        Спекулятивный режим: сегментация каждого листа сразу всеми пресетами.
+        Книга читается и картинки отправляются в VLM один раз, кластеризации
+        по пресетам идут параллельно (пул процессов для крупных листов).
+        :param presets: {имя пресета: полные параметры}
+        :return: {имя пресета: манифест как у parse_file}
+        """
+        logger.info(f"Opening workbook: {file_path} (speculative, presets: {list(presets)})")
+        loop = asyncio.get_running_loop()
+        try:
+            state = self._get_state(file_path)
+            await loop.run_in_executor(None, self._load_sheets, file_path, state, target_sheets)
+        except Exception as e:
+            logger.error(f"Failed to load workbook: {e}")
+            return {"error": str(e)}
+
+        sheets = [
+            state.sheets[title] for title in state.order
+            if title in state.sheets and (not target_sheets or title in target_sheets)
+        ]
+        images = await asyncio.gather(*(
+            self._sheet_images(sheet, image_callback, session, state) for sheet in sheets if len(sheet.grid)
+        ))
+        vlm_by_sheet = dict(zip([sheet.title for sheet in sheets if len(sheet.grid)], images))
+
+        jobs = [(name, sheet) for name in presets for sheet in sheets if len(sheet.grid)]
+        # Выгрузка таблиц — в подкаталог пресета: одинаковые диапазоны разных пресетов не пересекаются
+        reports = await asyncio.gather(*(
+            self._segment(sheet, presets[name], state.export_dir and os.path.join(state.export_dir, name))
+            for name, sheet in jobs
+        ))
+        by_job = {(name, sheet.title): report for (name, sheet), report in zip(jobs, reports)}
+
+        variants = {}
+        for name in presets:
+            manifest = {}
+            for sheet in sheets:
+                report = by_job.get((name, sheet.title))
+                if report is None:
+                    manifest[sheet.title] = {"status": "empty"}
+                    continue
+                report["vlm_data"] = vlm_by_sheet[sheet.title]
+                manifest[sheet.title] = report
+            variants[name] = manifest
+
+        if self._image_cache:
+            self._image_cache.evict()
+        return variants
+
+    @staticmethod
+    def _segment_sheet(sheet: SheetData, params: Dict, export_dir: Optional[str] = None) -> Dict:
+        """
+        Кластеризация и отчет по регионам: зависит только от сетки и параметров.
+        С export_dir таблицы (data_table) целиком выгружаются в колоночные файлы.
+        """
+        grid = sheet.grid
+        clusters = RobustExcelParser._cluster_regions(grid, params)
+
         regions = []
         cells_covered = 0
         for cluster in clusters:
-            cells_covered += len(cluster)
-            region_report = self._analyze_region(sheet, cluster, sig_data, merged_lookup, params)
+            cells_covered += sum(end - start + 1 for _, start, end in cluster)
+            region_report = RobustExcelParser._analyze_region(
+                sheet, cluster, grid.values, grid.merged, params, export_dir
+            )
             regions.append(region_report)
 
-        coverage = cells_covered / len(sig_data) if sig_data else 1.0
+        coverage = cells_covered / len(grid)
         
         return {
-            "params_used": params,
+            "params_used": dict(params),
             "coverage": round(coverage, 4),
             "regions": regions,
-            "vlm_data": vlm_results
         }
 
-    async def _handle_image(self, img, sheet_title, image_callback, session) -> Optional[Dict]:
-        """Сохранение изображения и вызов VLM."""
-        unique_id = str(uuid.uuid4())[:8]
-        filename = f"{sheet_title}_{unique_id}.png".replace(" ", "_")
-        file_path = os.path.join(self.temp_dir, filename)
-        
-        try:
-            # Извлечение изображения
-            from PIL import Image as PILImage
-            # У openpyxl изображение хранится в img.ref (это BytesIO или путь)
-            image_data = PILImage.open(img.ref)
-            image_data.save(file_path)
-
-            analysis = "VLM Not Configured"
-            if image_callback:
-                # Вызываем переданную асинхронную функцию
-                analysis = await image_callback(session, file_path, filename)
-            
-            # Определяем позицию (якорь)
-            anchor = "Unknown"
-            try:
-                anchor = f"{get_column_letter(img.anchor._from.col + 1)}{img.anchor._from.row + 1}"
-            except: pass
+    def _get_image_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._image_semaphore_loop is not loop:
+            self._image_semaphore = asyncio.Semaphore(XLSX_IMAGE_CONCURRENCY)
+            self._image_semaphore_loop = loop
+        return self._image_semaphore
 
-            return {"anchor": anchor, "vlm_analysis": analysis}
+    async def _handle_image(self, img: Dict, sheet_title, image_callback, session,
+                            state: Optional["_WorkbookState"] = None) -> Optional[Dict]:
+        """
+        Ответ VLM по картинке с дедупликацией по хэшу содержимого.
+        Копия уже встреченной в книге картинки ждет ответ первой копии,
+        известная по прошлым файлам — берется из постоянного кэша.
+        В записи поле dedup: "new" | "workbook" | "cache".
+        img: {"data": bytes, "anchor": "B3"}
+        """
+        digest = image_digest(img["data"])
+        if not image_callback:
+            return {"anchor": img["anchor"], "vlm_analysis": "VLM Not Configured", "image_hash": digest, "dedup": "new"}
+
+        task = state.image_tasks.get(digest) if state else None
+        if task is not None:
+            dedup = "workbook"
+        else:
+            cached = self._image_cache.get(digest) if self._image_cache else None
+            if cached:
+                dedup = "cache"
+                task = asyncio.get_running_loop().create_future()
+                task.set_result(cached)
+            else:
+                dedup = "new"
+                task = asyncio.ensure_future(self._analyze_image(img["data"], digest, sheet_title, image_callback, session))
+            if state:
+                state.image_tasks[digest] = task
+        try:
+            analysis = await task
         except Exception as e:
+            if state and state.image_tasks.get(digest) is task:
+                # Неудачный ответ не переиспользуем: следующий прогон спросит заново
+                del state.image_tasks[digest]
             logger.error(f"Error processing image on {sheet_title}: {e}")
             return None
-        finally:
-            # Удаляем конкретный файл сразу после обработки
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-    def _cluster_regions(self, coords: List[tuple], params: Dict) -> List[List[tuple]]:
-        """Алгоритм поиска связанных компонентов на основе допусков."""
-        coords_set = set(coords)
-        visited = set()
-        clusters = []
-        sorted_coords = sorted(coords)
-
-        v_tol = params["V_TOLERANCE"]
-        h_tol = params["H_TOLERANCE"]
-
-        for node in sorted_coords:
-            if node in visited:
-                continue
-            
-            cluster = []
-            queue = [node]
-            visited.add(node)
-            
-            while queue:
-                r, c = queue.pop(0)
-                cluster.append((r, c))
-                
-                # Поиск соседей в окне допусков
-                for nr in range(r - v_tol, r + v_tol + 1):
-                    for nc in range(c - h_tol, c + h_tol + 1):
-                        neighbor = (nr, nc)
-                        if neighbor in coords_set and neighbor not in visited:
-                            visited.add(neighbor)
-                            queue.append(neighbor)
-            clusters.append(cluster)
-        return clusters
-
-    def _analyze_region(self, sheet, cluster_coords, sig_data, merged_lookup, params) -> Dict:
-        """Анализирует блок ячеек и превращает его в текст."""
-        rows = [c[0] for c in cluster_coords]
-        cols = [c[1] for c in cluster_coords]
-        min_r, max_r, min_c, max_c = min(rows), max(rows), min(cols), max(cols)
-        
-        lines = []
-        for r in range(min_r, max_r + 1):
+        if dedup == "new" and self._image_cache:
+            self._image_cache.put(digest, analysis)
+        return {"anchor": img["anchor"], "vlm_analysis": analysis, "image_hash": digest, "dedup": dedup}
+
+    async def _analyze_image(self, data: bytes, digest: str, sheet_title, image_callback, session) -> Any:
+        """
+        Вызов VLM для картинки прямо из памяти, без временных файлов.
+        PNG/JPEG передаются как есть, остальные форматы перекодируются в PNG.
+        """
+        ext = _image_format(data)
+        if ext is None:
+            # Перекодирование — CPU-работа: выносим из event loop
+            data = await asyncio.get_running_loop().run_in_executor(None, _to_png, data)
+            ext = "png"
+        filename = f"{sheet_title}_{digest[:12]}.{ext}".replace(" ", "_")
+
+        # Вызываем переданную асинхронную функцию
+        async with self._get_image_semaphore():
+            analysis = await image_callback(session, data, filename)
+        # Пустой ответ — сбой VLM: не кэшируется, копии картинки спросят заново
+        if analysis is None or (isinstance(analysis, str) and not analysis.strip()):
+            raise RuntimeError(f"empty VLM answer for {filename}")
+        return analysis
+
+    @staticmethod
+    def _cluster_regions(grid: SheetGrid, params: Dict) -> List[List[tuple]]:
+        """
+        Связные компоненты на основе допусков (union-find по отрезкам строк, без BFS по окну).
+        Кластер — список отрезков (row, start_col, end_col); объединение дает отрезок на строку.
+        """
+        return cluster_spans(*grid.spans(), params["V_TOLERANCE"], params["H_TOLERANCE"])
+
+    @staticmethod
+    def _analyze_region(sheet, cluster_spans, sig_data, merged: MergedIndex, params,
+                        export_dir: Optional[str] = None) -> Dict:
+        """
+        Анализирует блок ячеек и превращает его в текст.
+        Обходятся только отрезки самого кластера (по строкам), а не весь bbox;
+        для таблицы в памяти остаются лишь первые и последние 5 строк.
+        С export_dir строки таблицы в том же проходе пишутся в колоночный файл
+        (колонки — буквы столбцов региона), ссылка на него попадает в отчет.
+        """
+        min_r, max_r = cluster_spans[0][0], cluster_spans[-1][0]
+        min_c = min(span[1] for span in cluster_spans)
+        max_c = max(span[2] for span in cluster_spans)
+        max_chars, min_rows = params["MAX_CHARS_BLOCK"], params["MIN_TABLE_ROWS"]
+        cell_range = f"{get_column_letter(min_c)}{min_r}:{get_column_letter(max_c)}{max_r}"
+
+        lines: List[str] = []  # все строки, пока тип не ясен; для таблицы — только начало
+        tail: Optional[deque] = None
+        n_lines, n_chars = 0, 0
+        # Строки значений для выгрузки: копятся, пока тип не ясен, затем пишутся сразу
+        pending: Optional[List[List[Optional[str]]]] = [] if export_dir else None
+        writer: Optional[TableWriter] = None
+
+        for r, spans in groupby(cluster_spans, key=lambda span: span[0]):
             row_parts = []
-            skip_cols = set()
-            for c in range(min_c, max_c + 1):
-                if c in skip_cols: continue
-                
-                coord = (r, c)
-                if coord in merged_lookup:
-                    m = merged_lookup[coord]
-                    if r == m.min_row and c == m.min_col:
-                        val = sig_data.get(coord, "")
-                        addr = str(m) if params["SHOW_MERGED_MAP"] else f"{get_column_letter(c)}{r}"
+            row_values = [None] * (max_c - min_c + 1) if pending is not None else None
+            for _, start, end in spans:
+                m = merged.lookup(r, start) if len(merged) else None
+                if m is not None:
+                    # Объединение выводится один раз — в строке и колонке якоря
+                    if r == m[0] and start == m[1]:
+                        val = sig_data.get((r, start), "")
+                        addr = range_ref(m) if params["SHOW_MERGED_MAP"] else f"{get_column_letter(start)}{r}"
                         row_parts.append(f"[{addr}]: {str(val).strip()}" if val is not None else f"[{addr}]: ")
-                    # Пропускаем остальные колонки в этом объединении для текущей строки
-                    for col_idx in range(m.min_col, m.max_col + 1):
-                        skip_cols.add(col_idx)
-                else:
-                    val = sig_data.get(coord)
+                        if row_values is not None and val is not None:
+                            row_values[start - min_c] = str(val).strip()
+                    continue
+                for c in range(start, end + 1):
+                    val = sig_data.get((r, c))
                     if val is not None:
                         row_parts.append(f"[{get_column_letter(c)}{r}]: {str(val).strip()}")
-            
-            if row_parts:
-                lines.append(" | ".join(row_parts))
+                        if row_values is not None:
+                            row_values[c - min_c] = str(val).strip()
 
-        # Определение типа региона
-        full_text = "\n".join(lines)
-        is_table = len(full_text) > params["MAX_CHARS_BLOCK"] and len(lines) > params["MIN_TABLE_ROWS"]
-        
-        if is_table:
-            head = lines[:5]
-            tail = lines[-5:]
-            skipped = len(lines) - 10
-            preview = "\n".join(head) + f"\n... [SKIPPED {skipped} ROWS] ...\n" + "\n".join(tail)
+            if not row_parts:
+                continue
+            line = " | ".join(row_parts)
+            n_chars += len(line) + (1 if n_lines else 0)
+            n_lines += 1
+            if writer is not None:
+                writer.write_row(row_values)
+            elif pending is not None:
+                pending.append(row_values)
+            if tail is not None:
+                tail.append(line)
+                if len(lines) < 5:
+                    lines.append(line)
+                continue
+            lines.append(line)
+            # Оба счетчика только растут: как только пороги пройдены, регион — таблица
+            if n_chars > max_chars and n_lines > min_rows:
+                tail = deque(lines[-5:], maxlen=5)
+                del lines[5:]
+                if pending is not None:
+                    try:
+                        writer = RobustExcelParser._open_table_writer(sheet, export_dir, cell_range, min_c, max_c, pending)
+                    except Exception as e:
+                        logger.error(f"Table export failed for {sheet.title}!{cell_range}: {e}")
+                    pending = None
+
+        export = None
+        if writer is not None:
+            try:
+                export = writer.close()
+            except Exception as e:
+                logger.error(f"Table export failed for {sheet.title}!{cell_range}: {e}")
+                writer.abort()
+
+        if tail is not None:
+            skipped = n_lines - 10
+            marker = f"SKIPPED {skipped} ROWS" + (f", FULL TABLE: {export['path']}" if export else "")
+            preview = "\n".join(lines) + f"\n... [{marker}] ...\n" + "\n".join(tail)
             r_type = "data_table"
         else:
-            preview = full_text
+            preview = "\n".join(lines)
             r_type = "data_form"
 
-        return {
+        report = {
             "type": r_type,
-            "range": f"{get_column_letter(min_c)}{min_r}:{get_column_letter(max_c)}{max_r}",
+            "range": cell_range,
             "preview": preview,
-            "metrics": {"rows": len(lines), "cells": len(cluster_coords)}
+            "metrics": {"rows": n_lines, "cells": sum(end - start + 1 for _, start, end in cluster_spans)}
         }
+        if export:
+            report["export"] = export
+        return report
+
+    @staticmethod
+    def _open_table_writer(sheet, export_dir: str, cell_range: str, min_c: int, max_c: int,
+                           rows: List[List[Optional[str]]]) -> TableWriter:
+        """Файл выгрузки таблицы с уже накопленными строками."""
+        columns = [get_column_letter(c) for c in range(min_c, max_c + 1)]
+        writer = TableWriter(export_base(export_dir, sheet.title, cell_range), columns,
+                             XLSX_TABLE_EXPORT_FORMAT, XLSX_TABLE_EXPORT_BATCH_ROWS)
+        for row in rows:
+            writer.write_row(row)
+        return writer
+
+def _image_format(data: bytes) -> Optional[str]:
+    """Расширение для форматов, которые VLM принимает без перекодирования."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    return None
+
+
+def _to_png(data: bytes) -> bytes:
+    from PIL import Image as PILImage
+    buffer = io.BytesIO()
+    with PILImage.open(io.BytesIO(data)) as image:
+        image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def segment_sheet(sheet: SheetData, params: Dict, export_dir: Optional[str] = None) -> Dict:
+    """Точка входа воркера: сегментация одного листа (без картинок и обращений к VLM)."""
+    return RobustExcelParser._segment_sheet(sheet, params, export_dir)
+
+
+def _grid_only(sheet: SheetData) -> SheetData:
+    """Компактная копия листа для передачи в процесс: сетка и объединения, без байтов картинок."""
+    light = SheetData(sheet.title)
+    light.grid = sheet.grid
+    light.merged = sheet.merged
+    return light
 
-    def _cleanup_temp(self):
-        """Полная очистка временной папки."""
-        try:
-            if os.path.exists(self.temp_dir):
-                shutil.rmtree(self.temp_dir)
-                os.makedirs(self.temp_dir)
-        except Exception as e:
-            logger.error(f"Cleanup error: {e}")
 
-# --- Пример использования (Mock-тест) ---
 async def main():
     # Имитация VLM функции
-    async def mock_vlm(session, file_path, filename):
+    async def mock_vlm(session, image_bytes, filename):
         await asyncio.sleep(0.1) # имитация сетевой задержки
         return f"VLM_RESULT_FOR_{filename}"
 
@@ -0,0 +1,175 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Dict, List, Optional
+
+import config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("BatchRunner")
+
+XLSX_EXTENSIONS = (".xlsx", ".xlsm")
+
+
+def _limit_memory(memory_mb: int):
+    """Лимит адресного пространства процесса книги (на Windows не поддерживается)."""
+    if not memory_mb:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    limit = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _run_file(file_path: str, output_dir: str, memory_mb: int, conn):
+    """Точка входа процесса книги: полный цикл диспетчера, итог — в канал."""
+    if hasattr(os, "setsid"):
+        # Своя группа процессов: по таймауту убивается вместе с пулом сегментации
+        os.setsid()
+    _limit_memory(memory_mb)
+    report = {"file": file_path}
+    try:
+        from dispatcher import ExcelProcessingDispatcher
+        dispatcher = ExcelProcessingDispatcher(output_dir=output_dir)
+        try:
+            result = asyncio.run(dispatcher.process_file_workflow(file_path))
+        finally:
+            dispatcher.parser.close()
+        if isinstance(result, dict) and "error" in result:
+            report.update(status="error", error=str(result["error"]))
+        else:
+            report.update(status="ok", sheets=len(result or {}))
+    except MemoryError:
+        report.update(status="memory", error=f"memory limit {memory_mb} MB exceeded")
+    except Exception as e:
+        report.update(status="error", error=f"{type(e).__name__}: {e}")
+    conn.send(report)
+    conn.close()
+
+
+def _kill(proc):
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass  # процесс еще не успел создать свою группу
+    proc.kill()
+    proc.join()
+
+
+def find_workbooks(input_dir: str) -> List[str]:
+    return sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if name.lower().endswith(XLSX_EXTENSIONS) and not name.startswith("~$")
+    )
+
+
+def run_batch(files: List[str], output_dir: str, workers: int, timeout: float, memory_mb: int) -> List[Dict]:
+    """
+    Обработка книг пулом процессов: не больше workers одновременно,
+    каждая книга — в свежем процессе с лимитами времени и памяти.
+    Зависшая или упавшая книга не останавливает остальные.
+    """
+    ctx = mp.get_context("spawn")
+    queue = list(files)
+    running: Dict[str, tuple] = {}  # путь -> (процесс, канал, время старта)
+    reports = []
+
+    while queue or running:
+        while queue and len(running) < workers:
+            file_path = queue.pop(0)
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_run_file, args=(file_path, output_dir, memory_mb, send_conn), daemon=False)
+            proc.start()
+            send_conn.close()
+            running[file_path] = (proc, recv_conn, time.monotonic())
+            logger.info(f"▶️ {file_path}")
+
+        wait([proc.sentinel for proc, _, _ in running.values()] + [conn for _, conn, _ in running.values()],
+             timeout=1.0)
+
+        now = time.monotonic()
+        for file_path, (proc, conn, started) in list(running.items()):
+            report: Optional[Dict] = None
+            if conn.poll():
+                try:
+                    report = conn.recv()
+                except EOFError:
+                    report = None
+                proc.join(5)
+                if proc.is_alive():
+                    _kill(proc)
+            elif not proc.is_alive():
+                proc.join()
+                report = {"file": file_path, "status": "crashed", "error": f"exit code {proc.exitcode}"}
+            elif now - started > timeout:
+                _kill(proc)
+                report = {"file": file_path, "status": "timeout", "error": f"wall-clock limit {timeout}s exceeded"}
+            else:
+                continue
+            if report is None:
+                report = {"file": file_path, "status": "crashed", "error": f"exit code {proc.exitcode}"}
+            conn.close()
+            report["seconds"] = round(now - started, 2)
+            reports.append(report)
+            del running[file_path]
+            icon = "✅" if report["status"] == "ok" else "❌"
+            logger.info(f"{icon} {file_path}: {report['status']} за {report['seconds']} с")
+    return reports
+
+
+def summarize(reports: List[Dict], elapsed: float, slowest: int) -> Dict:
+    statuses: Dict[str, int] = {}
+    for r in reports:
+        statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+    return {
+        "files": len(reports),
+        "elapsed_sec": round(elapsed, 2),
+        "files_per_min": round(len(reports) / elapsed * 60, 2) if elapsed else 0.0,
+        "statuses": statuses,
+        "slowest": sorted(reports, key=lambda r: r["seconds"], reverse=True)[:slowest],
+        "failed": [r for r in reports if r["status"] != "ok"],
+    }
+
+
+def print_summary(summary: Dict):
+    print(f"\nКниг: {summary['files']} за {summary['elapsed_sec']} с — {summary['files_per_min']} книг/мин")
+    print("Статусы: " + ", ".join(f"{k}={v}" for k, v in sorted(summary["statuses"].items())))
+    print("Самые медленные:")
+    for r in summary["slowest"]:
+        print(f"  {r['seconds']:>9.2f} с  {r['status']:<8} {r['file']}")
+    for r in summary["failed"]:
+        print(f"  ❌ {r['file']}: {r.get('error')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетный парсинг XLSX-книг из каталога")
+    parser.add_argument("input_dir")
+    parser.add_argument("--output", default=config.XLSX_OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=config.XLSX_BATCH_WORKERS)
+    parser.add_argument("--timeout", type=float, default=config.XLSX_BATCH_TIMEOUT_SEC)
+    parser.add_argument("--memory-mb", type=int, default=config.XLSX_BATCH_MEMORY_MB)
+    args = parser.parse_args()
+
+    files = find_workbooks(args.input_dir)
+    logger.info(f"📂 {len(files)} книг, воркеров: {args.workers}")
+    start = time.monotonic()
+    reports = run_batch(files, args.output, max(1, args.workers), args.timeout, args.memory_mb)
+    summary = summarize(reports, time.monotonic() - start, config.XLSX_BATCH_SLOWEST)
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, "batch_report.json"), "w", encoding="utf-8") as f:
+        json.dump({**summary, "reports": reports}, f, ensure_ascii=False, indent=2)
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Бенчмарк кластеризации значимых ячеек.
+
+    python bench_clustering.py [макс. число ячеек]
+
+Сначала сверяет результат с исходным BFS на случайных листах с разными
+допусками, затем меряет время на синтетических листах до миллионов ячеек.
+"""
+import random
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from clustering import cluster_cells, cluster_coords, cluster_spans
+from config import PRESETS
+
+
+def reference_bfs(coords, v_tol, h_tol) -> List[List[tuple]]:
+    """Исходный алгоритм _cluster_regions (очередь на списке, окно соседей)."""
+    coords_set = set(coords)
+    visited = set()
+    clusters = []
+    for node in sorted(coords):
+        if node in visited:
+            continue
+        cluster, queue = [], [node]
+        visited.add(node)
+        while queue:
+            r, c = queue.pop(0)
+            cluster.append((r, c))
+            for nr in range(r - v_tol, r + v_tol + 1):
+                for nc in range(c - h_tol, c + h_tol + 1):
+                    neighbor = (nr, nc)
+                    if neighbor in coords_set and neighbor not in visited:
+                        visited.add(neighbor)
+                        queue.append(neighbor)
+        clusters.append(cluster)
+    return clusters
+
+
+def check_equivalence(rounds: int = 300):
+    rng = random.Random(42)
+    for _ in range(rounds):
+        n_rows, n_cols = rng.randint(1, 40), rng.randint(1, 40)
+        density = rng.choice([0.02, 0.1, 0.3, 0.7])
+        coords = [(r, c) for r in range(1, n_rows + 1) for c in range(1, n_cols + 1) if rng.random() < density]
+        v_tol, h_tol = rng.randint(0, 6), rng.randint(0, 6)
+        expected = [sorted(cl) for cl in reference_bfs(coords, v_tol, h_tol)]
+        actual = cluster_coords(coords, v_tol, h_tol)
+        assert expected == actual, f"Расхождение при V={v_tol}, H={h_tol}"
+    print(f"Эквивалентность с BFS: {rounds} случайных листов — OK")
+
+    # Отрезки объединений дают те же кластеры, что и развернутые по ячейкам
+    for _ in range(rounds):
+        spans = set()
+        for r in range(1, rng.randint(2, 30)):
+            c = 1
+            while c < 30:
+                c += rng.randint(1, 5)
+                width = rng.choice([1, 1, 1, 3, 8])
+                spans.add((r, c, c + width - 1))
+                c += width
+        spans = sorted(spans)
+        v_tol, h_tol = rng.randint(0, 6), rng.randint(0, 6)
+        cells = [(r, c) for r, c0, c1 in spans for c in range(c0, c1 + 1)]
+        expected = [sorted(cl) for cl in reference_bfs(cells, v_tol, h_tol)]
+        rows, starts, ends = (np.array(x) for x in zip(*spans))
+        actual = [[(r, c) for r, c0, c1 in cl for c in range(c0, c1 + 1)]
+                  for cl in cluster_spans(rows, starts, ends, v_tol, h_tol)]
+        assert expected == actual, f"Расхождение отрезков при V={v_tol}, H={h_tol}"
+    print(f"Эквивалентность отрезков объединений: {rounds} случайных листов — OK")
+
+
+def synthetic_sheets(n_cells: int) -> Dict[str, np.ndarray]:
+    """Типовые формы: плотная таблица, разреженный шум, диагональ, набор форм."""
+    rng = np.random.default_rng(0)
+    width = 50
+    table = np.arange(n_cells, dtype=np.int64)
+
+    side = int(np.sqrt(n_cells * 20)) + 1
+    noise = np.unique(rng.integers(0, side * side, n_cells))
+
+    diag = np.arange(n_cells, dtype=np.int64)
+
+    # Блоки 30x8 с промежутками в 3 строки/колонки
+    blocks = np.arange(n_cells, dtype=np.int64)
+    b_idx, inner = blocks // 240, blocks % 240
+    b_rows, b_cols = (b_idx // 20) * 33 + inner // 8, (b_idx % 20) * 11 + inner % 8
+
+    return {
+        "dense_table": (table // width + 1, table % width + 1),
+        "sparse_noise": (noise // side + 1, noise % side + 1),
+        "diagonal": (diag + 1, diag + 1),
+        "form_blocks": _row_major(b_rows + 1, b_cols + 1),
+    }
+
+
+def _row_major(rows, cols):
+    order = np.lexsort((cols, rows))
+    return rows[order], cols[order]
+
+
+def run_benchmark(max_cells: int):
+    sizes = [10_000, 100_000, 1_000_000]
+    sizes = [s for s in sizes if s < max_cells] + [max_cells]
+    presets = [(name, p["V_TOLERANCE"], p["H_TOLERANCE"]) for name, p in PRESETS.items()]
+
+    print(f"{'лист':<14}{'ячеек':>10}{'пресет':>10}{'кластеров':>11}{'новый, с':>10}{'BFS, с':>10}")
+    for n in sizes:
+        for name, (rows, cols) in synthetic_sheets(n).items():
+            for preset, v_tol, h_tol in presets:
+                start = time.perf_counter()
+                clusters = cluster_cells(rows, cols, v_tol, h_tol)
+                fast = time.perf_counter() - start
+
+                slow = "-"
+                # Исходный BFS квадратичен по размеру кластера: меряем только на малых листах
+                if len(rows) <= 10_000:
+                    coords = list(zip(rows.tolist(), cols.tolist()))
+                    start = time.perf_counter()
+                    reference_bfs(coords, v_tol, h_tol)
+                    slow = f"{time.perf_counter() - start:.3f}"
+                print(f"{name:<14}{len(rows):>10}{preset:>10}{len(clusters):>11}{fast:>10.3f}{slow:>10}")
+
+
+if __name__ == "__main__":
+    check_equivalence()
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000)
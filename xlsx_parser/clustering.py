@@ -0,0 +1,113 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+def _find(parent: List[int], x: int) -> int:
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def label_segments(seg_rows: Sequence[int], seg_starts: Sequence[int], seg_ends: Sequence[int],
+                   v_tol: int, h_tol: int) -> List[int]:
+    """
+    Связные компоненты горизонтальных отрезков (отсортированы по строке и началу).
+    Внутри отрезка соседние ячейки отстоят не более чем на h_tol колонок.
+
+    Отрезки T (строка выше, не дальше v_tol) и S связаны тогда и только тогда,
+    когда [T.start, T.end] пересекает [S.start - h_tol, S.end + h_tol]: разрывы
+    внутри отрезков не больше h_tol, поэтому найдется пара ячеек на расстоянии
+    <= h_tol. Это ровно семантика окна (2V+1)x(2H+1) исходного BFS.
+    Пары ищутся проходом с монотонным указателем — O(V * число отрезков).
+    """
+    n = len(seg_rows)
+    parent = list(range(n))
+
+    # Границы строк в массиве отрезков: (номер строки, начало, конец)
+    bands = []
+    for i in range(n):
+        if not bands or seg_rows[i] != bands[-1][0]:
+            bands.append([seg_rows[i], i, i + 1])
+        else:
+            bands[-1][2] = i + 1
+
+    for k, (row, a, b) in enumerate(bands):
+        p = k - 1
+        while p >= 0 and row - bands[p][0] <= v_tol:
+            j0, j_end = bands[p][1], bands[p][2]
+            for i in range(a, b):
+                lo, hi = seg_starts[i] - h_tol, seg_ends[i] + h_tol
+                # Нижняя граница только растет: расширенные отрезки S упорядочены по lo
+                while j0 < j_end and seg_ends[j0] < lo:
+                    j0 += 1
+                j = j0
+                while j < j_end and seg_starts[j] <= hi:
+                    ri, rj = _find(parent, i), _find(parent, j)
+                    if ri != rj:
+                        parent[max(ri, rj)] = min(ri, rj)
+                    j += 1
+            p -= 1
+
+    # Номера компонент по порядку первого отрезка (row-major минимум кластера)
+    labels, order = [0] * n, {}
+    for i in range(n):
+        root = _find(parent, i)
+        labels[i] = order.setdefault(root, len(order))
+    return labels
+
+
+def cluster_spans(rows: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                  v_tol: int, h_tol: int) -> List[List[Tuple[int, int, int]]]:
+    """
+    Кластеры горизонтальных отрезков ячеек (строка, начало, конец).
+    Отрезок — сплошной ряд значимых ячеек, например строка объединения.
+    :param rows, starts, ends: отсортированы row-major, отрезки не пересекаются
+    :return: кластеры в порядке минимальной ячейки, отрезки внутри — row-major
+    """
+    if not len(rows):
+        return []
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if h_tol < 1 and np.any(ends > starts):
+        # Без горизонтального допуска соседние ячейки не связаны: дробим отрезки
+        widths = ends - starts + 1
+        rows = np.repeat(rows, widths)
+        starts = np.repeat(starts, widths) + np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+        ends = starts
+
+    # Сегменты: отрезки одной строки с разрывами не больше h_tol
+    brk = np.flatnonzero((np.diff(rows) != 0) | (starts[1:] - ends[:-1] > h_tol)) + 1
+    first = np.concatenate(([0], brk))
+    last = np.concatenate((brk, [len(rows)])) - 1
+
+    seg_labels = label_segments(
+        rows[first].tolist(), starts[first].tolist(), ends[last].tolist(), v_tol, h_tol
+    )
+    span_labels = np.repeat(np.asarray(seg_labels, dtype=np.int64), last - first + 1)
+
+    # Стабильная сортировка по метке сохраняет row-major порядок внутри кластера
+    perm = np.argsort(span_labels, kind="stable")
+    bounds = np.flatnonzero(np.diff(span_labels[perm])) + 1
+    spans = list(zip(rows[perm].tolist(), starts[perm].tolist(), ends[perm].tolist()))
+    edges = [0] + bounds.tolist() + [len(spans)]
+    return [spans[edges[k]:edges[k + 1]] for k in range(len(edges) - 1)]
+
+
+def cluster_cells(rows: np.ndarray, cols: np.ndarray, v_tol: int, h_tol: int) -> List[List[Tuple[int, int]]]:
+    """
+    Кластеры отдельных ячеек с допусками по строкам/колонкам.
+    :param rows, cols: координаты, отсортированные row-major (без дублей)
+    :return: кластеры в порядке минимальной ячейки, ячейки внутри — row-major
+    """
+    return [[(r, c) for r, c, _ in cluster] for cluster in cluster_spans(rows, cols, cols, v_tol, h_tol)]
+
+
+def cluster_coords(coords: Sequence[Tuple[int, int]], v_tol: int, h_tol: int) -> List[List[Tuple[int, int]]]:
+    """То же для произвольного набора координат (row, col)."""
+    if not coords:
+        return []
+    arr = np.unique(np.asarray(coords, dtype=np.int64).reshape(-1, 2), axis=0)
+    return cluster_cells(arr[:, 0], arr[:, 1], v_tol, h_tol)
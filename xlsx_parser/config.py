@@ -1,3 +1,5 @@
+import os
+
 class AnalyzerConfig:
     # Эвристики поиска
     GAP_TOLERANCE_ROW = 2  # Сколько пустых строк допустимо внутри одного блока
@@ -101,4 +103,76 @@ PRESETS = {
     "Relaxed": {"V_TOLERANCE": 6, "H_TOLERANCE": 5, "MAX_CHARS_BLOCK": 6000, "MIN_TABLE_ROWS": 10}
 }
 
-DEFAULT_SETTINGS = {**PRESETS["Standard"], "VALIDATION_THRESHOLD": 0.98, "SHOW_MERGED_MAP": True}
+DEFAULT_PRESET = "Standard"
+DEFAULT_SETTINGS = {**PRESETS[DEFAULT_PRESET], "VALIDATION_THRESHOLD": 0.98, "SHOW_MERGED_MAP": True}
+
+# Склейка изображений листов в multi-image запросы к VLM
+XLSX_COALESCE_IMAGES = False
+XLSX_COALESCE_MAX_IMAGES = 6
+XLSX_COALESCE_TOKEN_BUDGET = 4000     # визуальные токены на один запрос
+XLSX_COALESCE_SMALL_IMAGE_TOKENS = 600  # крупнее — отправляется отдельно
+XLSX_COALESCE_WINDOW_SEC = 0.05       # сколько ждать соседей перед отправкой пакета
+
+# Потоковая загрузка листов (iterparse по XML) вместо полной модели openpyxl;
+# если пакет так не читается или листов не нашлось — запасной путь через openpyxl
+XLSX_STREAMING_LOADER = True
+
+# Спекулятивный тюнинг: все пресеты считаются сразу, LLM один раз выбирает лучший на лист
+XLSX_SPECULATIVE_TUNING = False
+
+# Локальный скорер сегментации: LLM спрашивается только в неоднозначной зоне
+XLSX_LOCAL_SCORER = True
+XLSX_LOCAL_ACCEPT_SCORE = 0.9   # не ниже — принимаем без LLM
+XLSX_LOCAL_REJECT_SCORE = 0.5   # не выше — перепарсинг по рекомендации скорера без LLM
+XLSX_SCORER_AUDIT_RATE = 0.0    # доля уверенных случаев, которые все равно сверяются с LLM
+XLSX_SCORER_STATS_FILE = "scorer_agreement.json"
+XLSX_SCORER_MAX_SAMPLES = 500
+
+# Параллельная сегментация листов в пуле процессов (0/1 — без пула, в потоке)
+XLSX_SHEET_WORKERS = int(os.getenv("XLSX_SHEET_WORKERS", 4))  # document_dispatcher ставит 0: CPU делится на уровне задач
+XLSX_PARALLEL_MIN_CELLS = 20000  # меньшие листы дешевле обработать в потоке, чем передавать в процесс
+
+# Одновременные запросы к VLM по картинкам листов
+XLSX_IMAGE_CONCURRENCY = 8
+
+# Дедупликация картинок по хэшу содержимого: в пределах книги и между файлами
+XLSX_IMAGE_CACHE = True
+XLSX_IMAGE_CACHE_DIR = "image_analysis_cache"  # одна запись — один файл
+XLSX_IMAGE_CACHE_MAX_ENTRIES = 5000
+
+# Полная выгрузка регионов data_table в колоночные файлы в том же проходе
+XLSX_TABLE_EXPORT = False
+XLSX_TABLE_EXPORT_DIR = "table_exports"
+XLSX_TABLE_EXPORT_FORMAT = "parquet"  # parquet | arrow | csv (без pyarrow — всегда csv)
+XLSX_TABLE_EXPORT_BATCH_ROWS = 10000
+
+# Бюджет контекста для оценки сегментации: большие книги режутся на части по листам,
+# части оцениваются параллельно, решения сливаются в одну оценку документа
+XLSX_PROMPT_PAYLOAD_TOKENS = 8000  # данные в одном промпте (num_ctx запроса — 16000)
+XLSX_PROMPT_CONCURRENCY = 4        # одновременные запросы по частям
+
+# Очередь запросов к LLM: дешевые первыми (shortest-job-first) со старением ожидающих.
+# Работает, когда корень репозитория в sys.path (resource_budget), например через document_dispatcher
+XLSX_LLM_CONCURRENCY = 4
+XLSX_LLM_AGING_TOKENS_PER_SEC = 500      # удешевление ожидающего запроса в секунду
+XLSX_LLM_DECODE_WEIGHT = 8               # токен ответа дороже токена промпта
+XLSX_LLM_EXPECTED_OUTPUT_RATIO = 0.1     # ответ тюнинга — короткий JSON по листам промпта
+XLSX_LLM_IMAGE_OUTPUT_TOKENS = 120       # описание одной картинки
+
+# Кэш итоговых отчетов листов по отпечатку XML листа (+ sharedStrings, стили) и параметрам
+XLSX_SHEET_CACHE = True
+XLSX_SHEET_CACHE_DIR = "sheet_cache"
+XLSX_SHEET_CACHE_VERSION = 1  # поднять при изменении логики сегментации или оценки в коде
+
+# Результаты книг: <XLSX_OUTPUT_DIR>/<имя книги>/{initial,final}_results.json
+XLSX_OUTPUT_DIR = "xlsx_results"
+# Формат записи результатов (serializer.py в корне репозитория): json | msgpack.
+# Компактный режим — без отступов и без params_used у листов с DEFAULT_SETTINGS
+XLSX_RESULT_FORMAT = os.getenv("RESULT_FORMAT", "json")
+XLSX_RESULT_COMPACT = os.getenv("RESULT_COMPACT", "True").lower() == "true"
+
+# Пакетная обработка каталога (batch.py): каждая книга — в отдельном процессе
+XLSX_BATCH_WORKERS = 4
+XLSX_BATCH_TIMEOUT_SEC = 900    # лимит времени на книгу
+XLSX_BATCH_MEMORY_MB = 4096     # лимит адресного пространства процесса книги (только POSIX)
+XLSX_BATCH_SLOWEST = 10         # сколько самых медленных книг показать в отчете
@@ -1,43 +1,91 @@
-import asyncio, aiohttp, logging, json, os, config
-from analyzer import RobustExcelParser
-from prompts import get_tuning_prompt
-from llm_client import call_gemma_async
+import asyncio, aiohttp, logging, json, os, random, config
+from analyzer import RobustExcelParser, workbook_dirname
+from prompts import get_tuning_prompt, get_selection_prompt
+from llm_client import call_gemma_async, process_images_batch, ImageCoalescer, estimate_text_tokens
+from scoring import score_workbook, is_ambiguous, AgreementTracker
+from sheet_cache import SheetResultCache, sheet_key, cache_version
+
+try:
+    # Потоковая запись и быстрые бэкенды (корень репозитория в sys.path, как в document_dispatcher)
+    from serializer import write_result
+except ImportError:
+    write_result = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("Dispatcher")
 
 class ExcelProcessingDispatcher:
-    def __init__(self):
+    def __init__(self, image_callback=None, output_dir=None):
         self.parser = RobustExcelParser(global_config=config.DEFAULT_SETTINGS)
+        self.output_dir = output_dir or config.XLSX_OUTPUT_DIR
+        self.image_callback = image_callback
+        self.scorer_stats = AgreementTracker() if config.XLSX_LOCAL_SCORER else None
+        self.sheet_cache = SheetResultCache(config.XLSX_SHEET_CACHE_DIR) if config.XLSX_SHEET_CACHE else None
+        self.cache_version = cache_version() if self.sheet_cache else ""
+        self.undecided_sheets = []  # листы последнего файла без оценки LLM или скорера
+        if config.XLSX_COALESCE_IMAGES:
+            self.image_callback = ImageCoalescer(
+                process_images_batch,
+                single_fn=image_callback,
+                max_images=config.XLSX_COALESCE_MAX_IMAGES,
+                token_budget=config.XLSX_COALESCE_TOKEN_BUDGET,
+                small_image_tokens=config.XLSX_COALESCE_SMALL_IMAGE_TOKENS,
+                window_sec=config.XLSX_COALESCE_WINDOW_SEC,
+            )
 
     async def process_file_workflow(self, file_path: str):
+        try:
+            if config.XLSX_SPECULATIVE_TUNING:
+                return await self.process_file_speculative(file_path)
+            return await self.process_file_iterative(file_path)
+        finally:
+            if isinstance(self.image_callback, ImageCoalescer):
+                self.image_callback.log_stats(os.path.basename(file_path))
+
+    async def process_file_iterative(self, file_path: str):
         history = [] # Храним результаты всех итераций
-        
+        # Неизмененные листы берутся из кэша, тюнятся только остальные
+        cached, keys, pending = self._lookup_sheet_cache(file_path)
+        if pending == []:
+            return self._finish_from_cache(file_path, cached, keys)
+
         async with aiohttp.ClientSession() as session:
             for attempt in range(1, config.XLSX_PARSER_NUM_RETRIES + 1):
                 logger.info(f"🔄 ИТЕРАЦИЯ {attempt}: Парсинг...")
                 
                 # 1. Парсим
-                current_results = await self.parser.parse_file(file_path, session=session)
+                current_results = await self.parser.parse_file(
+                    file_path, target_sheets=pending, image_callback=self.image_callback, session=session
+                )
                 
                 # Сохраняем самый первый прогон как initial
                 if attempt == 1:
-                    self._save_json(current_results, "initial_results.json")
+                    self._save_json(current_results, file_path, "initial_results.json")
 
-                # 2. Просим LLM оценить качество
-                payload = self._prepare_smart_payload(current_results)
-                prompt = get_tuning_prompt(payload, attempt)
-                
-                decision = await call_gemma_async(prompt, session)
-                if not decision: 
-                    decision = {"quality_score": 0.0, "action": "stop"}
+                # 2. Локальная оценка; LLM — только если она неоднозначна
+                local = score_workbook(current_results) if config.XLSX_LOCAL_SCORER else None
+                if local and self._local_is_confident(local):
+                    decision = self._local_decision(local)
+                    source = "скорер"
+                else:
+                    payload = self._prepare_smart_payload(current_results)
+                    decision = await self._ask_llm(
+                        payload, lambda part, chunk: get_tuning_prompt(part, attempt, chunk), session, split_sheets=True
+                    )
+                    if not decision:
+                        # LLM не ответила: результат без оценки в кэш листов не попадет
+                        decision = {"quality_score": 0.0, "action": "stop", "fallback": True}
+                    elif local:
+                        self.scorer_stats.record(local, decision)
+                    source = "LLM"
 
                 score = decision.get("quality_score", 0.0)
-                logger.info(f"📊 Оценка LLM: {score} | Действие: {decision.get('action')}")
+                logger.info(f"📊 Оценка ({source}): {score} | Действие: {decision.get('action')}")
 
                 # Сохраняем результат и его оценку в историю
                 history.append({
                     "score": score,
+                    "source": source,
                     "results": current_results,
                     "decision": decision
                 })
@@ -54,18 +102,293 @@ class ExcelProcessingDispatcher:
                     logger.warning("⚠️ Исчерпано количество попыток тюнинга.")
 
             # 4. ВЫБИРАЕМ ЛУЧШИЙ ВАРИАНТ ИЗ ИСТОРИИ
-            best_attempt = max(history, key=lambda x: x["score"])
+            # Шкалы LLM и скорера разные: сравниваются попытки одного источника (LLM приоритетнее)
+            candidates = [h for h in history if h["source"] == "LLM" and not h["decision"].get("fallback")] \
+                or [h for h in history if h["source"] == "скорер"] or history
+            best_attempt = max(candidates, key=lambda x: x["score"])
             final_data = best_attempt["results"]
             
             # Добавляем финальную аналитику в JSON
             for s_name, s_res in final_data.items():
                 if s_name in best_attempt["decision"].get("sheets", {}):
-                    s_res["ai_analysis"] = best_attempt["decision"]["sheets"][s_name].get("summaries")
-                    s_res["ai_score"] = best_attempt["score"]
+                    self._annotate_sheet(s_res, best_attempt["decision"]["sheets"][s_name], best_attempt["score"],
+                                         best_attempt["decision"])
 
-            self._save_json(final_data, "final_results.json")
+            decided = set() if best_attempt["decision"].get("fallback") else set(final_data)
+            self.undecided_sheets = [s_name for s_name in final_data if s_name not in decided]
+            final_data = self._merge_sheet_cache(final_data, cached, keys, decided)
+            # Выгрузки таблиц отвергнутых попыток не нужны
+            self.parser.prune_exports(file_path, final_data)
+            self._save_json(final_data, file_path, "final_results.json")
             logger.info(f"🏆 Финальный выбор: Попытка со скором {best_attempt['score']}")
+            # Сетки листов и ответы VLM нужны только на время тюнинга этого файла
+            self.parser.clear_cache(file_path)
+            return final_data
+
+    async def process_file_speculative(self, file_path: str):
+        """
+        Все пресеты считаются за один проход, LLM один раз выбирает лучший
+        вариант для каждого листа: один запрос вместо цикла из N попыток.
+        """
+        presets = {name: {**config.DEFAULT_SETTINGS, **preset} for name, preset in config.PRESETS.items()}
+        cached, keys, pending = self._lookup_sheet_cache(file_path)
+        if pending == []:
+            return self._finish_from_cache(file_path, cached, keys)
+
+        async with aiohttp.ClientSession() as session:
+            logger.info(f"🔀 Спекулятивный режим: пресеты {list(presets)}")
+            variants = await self.parser.parse_file_presets(
+                file_path, presets, target_sheets=pending, image_callback=self.image_callback, session=session
+            )
+            if "error" in variants:
+                return variants
+            self._save_json(variants[config.DEFAULT_PRESET], file_path, "initial_results.json")
+
+            local = self._local_selection(variants) if config.XLSX_LOCAL_SCORER else None
+            if local and self._local_is_confident(local, accept_only=True):
+                decision = local
+            else:
+                payload = self._prepare_selection_payload(variants)
+                decision = await self._ask_llm(payload, get_selection_prompt, session)
+                if not decision:
+                    decision = {"quality_score": 0.0, "sheets": {}, "fallback": True}
+                elif local:
+                    self.scorer_stats.record(local, decision)
+
+        final_data = {}
+        sheet_decisions = decision.get("sheets") or {}
+        for s_name in variants[config.DEFAULT_PRESET]:
+            sheet_decision = sheet_decisions.get(s_name) or {}
+            preset_name = sheet_decision.get("preset")
+            if preset_name not in variants:
+                preset_name = config.DEFAULT_PRESET
+            s_res = variants[preset_name][s_name]
+            if sheet_decision:
+                self._annotate_sheet(s_res, sheet_decision,
+                                     sheet_decision.get("quality_score", decision.get("quality_score", 0.0)), decision)
+            final_data[s_name] = s_res
+            logger.info(f"⚙️ Лист '{s_name}' -> пресет {preset_name}")
+
+        # В кэш — только листы, для которых пресет выбран по ответу LLM или скорера
+        self.undecided_sheets = [s_name for s_name in final_data if s_name not in sheet_decisions]
+        final_data = self._merge_sheet_cache(final_data, cached, keys, set(sheet_decisions))
+        # Выгрузки таблиц невыбранных пресетов не нужны
+        self.parser.prune_exports(file_path, final_data)
+        self._save_json(final_data, file_path, "final_results.json")
+        logger.info(f"🏆 Выбор за один запрос, общий скор {decision.get('quality_score', 0.0)}")
+        self.parser.clear_cache(file_path)
+        return final_data
+
+    @staticmethod
+    def _annotate_sheet(s_res, sheet_decision, score, decision):
+        """
+        Оценка и описание листа в итоговом отчете. Скорер описаний блоков не дает:
+        ai_analysis тогда не пишется, а ai_source показывает, откуда оценка.
+        """
+        local = decision.get("source") == "local"
+        if not local:
+            s_res["ai_analysis"] = sheet_decision.get("summaries")
+        s_res["ai_score"] = score
+        s_res["ai_source"] = "local" if local else "llm"
+
+    def _lookup_sheet_cache(self, file_path):
+        """
+        Поиск итоговых отчетов листов в кэше по отпечатку листа и его параметрам.
+        Возвращает (отчеты из кэша, ключи всех листов, листы для обработки):
+        None вместо списка листов — обрабатывать все, [] — все листы уже в кэше.
+        """
+        if not self.sheet_cache:
+            return {}, {}, None
+        digests = self.parser.sheet_digests(file_path)
+        keys = {
+            title: sheet_key(digest, self.parser._get_params(title), self.cache_version)
+            for title, digest in digests.items()
+        }
+        cached = {}
+        for title, key in keys.items():
+            entry = self.sheet_cache.get(key)
+            if entry:
+                cached[title] = {**entry["report"], "from_cache": True}
+        if not cached:
+            return cached, keys, None
+        pending = [title for title in keys if title not in cached]
+        logger.info(f"💾 Из кэша: {len(cached)} листов, к обработке: {len(pending)}")
+        return cached, keys, pending
+
+    def _finish_from_cache(self, file_path, cached, keys):
+        self.undecided_sheets = []
+        final_data = {title: cached[title] for title in keys}
+        self._save_json(final_data, file_path, "final_results.json")
+        logger.info("🏆 Все листы книги не изменились: результат взят из кэша")
+        return final_data
+
+    def _merge_sheet_cache(self, final_data, cached, keys, decided):
+        """
+        Запись новых отчетов в кэш и сборка результата в порядке листов книги.
+        decided — листы, оценка которых получена от LLM или скорера: результат
+        запасной ветки (LLM недоступна) в кэш не пишется, иначе закрепится навсегда.
+        """
+        if not keys:
             return final_data
+        for title, report in final_data.items():
+            if title in keys and title in decided and isinstance(report, dict) and "error" not in report:
+                self.sheet_cache.put(keys[title], _preset_of(report.get("params_used") or {}), report)
+        merged = {}
+        for title in keys:
+            if title in final_data:
+                merged[title] = final_data[title]
+            elif title in cached:
+                merged[title] = cached[title]
+        return merged
+
+    def _local_is_confident(self, local, accept_only=False):
+        """Уверенная локальная оценка (кроме выборочного аудита через LLM)."""
+        score = local["quality_score"]
+        if accept_only and score < config.XLSX_LOCAL_ACCEPT_SCORE:
+            return False
+        if is_ambiguous(score):
+            return False
+        return random.random() >= config.XLSX_SCORER_AUDIT_RATE
+
+    def _local_decision(self, local):
+        """Решение цикла тюнинга по локальному скореру в формате ответа LLM."""
+        score = local["quality_score"]
+        return {
+            "quality_score": score,
+            "action": "stop" if score >= config.XLSX_LOCAL_ACCEPT_SCORE else "reparse",
+            "reason": "local scorer",
+            "source": "local",
+            "sheets": {
+                name: {"recommended_preset": s["recommended_preset"], "reasons": s["reasons"]}
+                for name, s in local["sheets"].items() if s["metrics"]
+            },
+        }
+
+    def _local_selection(self, variants):
+        """Лучший по локальному скору пресет для каждого листа (при равенстве — пресет по умолчанию)."""
+        scored = {name: score_workbook(results) for name, results in variants.items()}
+        sheets = {}
+        for s_name in variants[config.DEFAULT_PRESET]:
+            best = max(
+                scored,
+                key=lambda n: (scored[n]["sheets"].get(s_name, {}).get("quality_score", 0.0), n == config.DEFAULT_PRESET),
+            )
+            sheet_score = scored[best]["sheets"].get(s_name, {})
+            if sheet_score.get("metrics"):
+                sheets[s_name] = {
+                    "preset": best,
+                    "recommended_preset": best,
+                    "quality_score": sheet_score["quality_score"],
+                }
+        scores = [s["quality_score"] for s in sheets.values()]
+        return {"quality_score": min(scores) if scores else 0.0, "source": "local", "sheets": sheets}
+
+    def _prepare_selection_payload(self, variants):
+        """Лист -> пресет -> срез данных; совпадающие сегментации не дублируются."""
+        per_preset = {name: self._prepare_smart_payload(results) for name, results in variants.items()}
+        payload = {}
+        for s_name in variants[config.DEFAULT_PRESET]:
+            options, seen = {}, {}
+            for name, sheets in per_preset.items():
+                if s_name not in sheets:
+                    continue
+                key = json.dumps(sheets[s_name], ensure_ascii=False, sort_keys=True)
+                options[name] = f"same_as:{seen[key]}" if key in seen else sheets[s_name]
+                seen.setdefault(key, name)
+            payload[s_name] = options
+        return payload
+
+    async def _ask_llm(self, payload, build_prompt, session, split_sheets=False):
+        """
+        Запрос к LLM с учетом бюджета контекста: срез, не влезающий в
+        XLSX_PROMPT_PAYLOAD_TOKENS, режется на части по листам, части оцениваются
+        параллельно в общей сессии, решения сливаются в одно.
+        build_prompt(часть среза, (номер части, всего частей) или None) -> prompt
+        """
+        chunks = self._chunk_payload(payload, split_sheets)
+        if len(chunks) == 1:
+            return await call_gemma_async(build_prompt(payload, None), session)
+
+        logger.info(f"✂️ Срез данных разбит на {len(chunks)} частей")
+        semaphore = asyncio.Semaphore(config.XLSX_PROMPT_CONCURRENCY)
+
+        async def ask(num, part):
+            async with semaphore:
+                return await call_gemma_async(build_prompt(part, (num, len(chunks))), session,
+                                              label=f"часть {num}/{len(chunks)}")
+
+        decisions = await asyncio.gather(*(ask(num, part) for num, part in enumerate(chunks, 1)))
+        return self._merge_decisions(decisions)
+
+    def _chunk_payload(self, payload, split_sheets=False):
+        """
+        Жадная упаковка листов в части под бюджет токенов. С split_sheets лист,
+        который один не влезает, делится по блокам (части одного листа — в разных промптах).
+        """
+        budget = config.XLSX_PROMPT_PAYLOAD_TOKENS
+        chunks, current, used = [], {}, 0
+        for s_name, s_data in payload.items():
+            parts = self._split_sheet(s_data, budget) if split_sheets else [s_data]
+            for part in parts:
+                tokens = _payload_tokens({s_name: part})
+                if current and (used + tokens > budget or s_name in current):
+                    chunks.append(current)
+                    current, used = {}, 0
+                current[s_name] = part
+                used += tokens
+        if current or not chunks:
+            chunks.append(current)
+        return chunks
+
+    @staticmethod
+    def _split_sheet(s_data, budget):
+        """Лист из среза тюнинга ({"coverage", "blocks"}) -> части по блокам под бюджет."""
+        if _payload_tokens(s_data) <= budget:
+            return [s_data]
+        parts, blocks, used = [], [], 0
+        for block in s_data.get("blocks", []):
+            tokens = _payload_tokens(block)
+            if blocks and used + tokens > budget:
+                parts.append({"coverage": s_data.get("coverage"), "blocks": blocks})
+                blocks, used = [], 0
+            blocks.append(block)
+            used += tokens
+        parts.append({"coverage": s_data.get("coverage"), "blocks": blocks})
+        return parts
+
+    @staticmethod
+    def _merge_decisions(decisions):
+        """
+        Слияние ответов по частям: оценка документа — худшая из частей,
+        "stop" — только если его вернули все части. У листа, разбитого на части,
+        пресет берется из худшей части, описания объединяются.
+        """
+        answered = [d for d in decisions if isinstance(d, dict)]
+        if not answered:
+            return None
+        if len(answered) < len(decisions):
+            logger.warning(f"⚠️ Нет ответа LLM по {len(decisions) - len(answered)} частям из {len(decisions)}")
+
+        scores = [_decision_score(d) for d in answered]
+        merged = {
+            "quality_score": min(scores),
+            "reason": "; ".join(str(d["reason"]) for d in answered if d.get("reason")),
+            "sheets": {},
+        }
+        if any("action" in d for d in answered):
+            merged["action"] = "stop" if all(d.get("action") == "stop" for d in answered) else "reparse"
+
+        # От лучших частей к худшим: решение худшей части по листу перекрывает остальные
+        for score, d in sorted(zip(scores, answered), key=lambda item: item[0], reverse=True):
+            for s_name, sheet in (d.get("sheets") or {}).items():
+                if not isinstance(sheet, dict):
+                    continue
+                prev = merged["sheets"].get(s_name)
+                sheet = {"quality_score": score, **sheet}
+                if prev:
+                    sheet["summaries"] = _as_list(prev.get("summaries")) + _as_list(sheet.get("summaries"))
+                merged["sheets"][s_name] = sheet
+        return merged
 
     def _apply_recommendations(self, decision):
         """Применяет пресеты, рекомендованные LLM для следующего круга."""
@@ -97,13 +420,59 @@ class ExcelProcessingDispatcher:
         if len(lines) <= 10: return text
         return "\n".join(lines[:5]) + "\n... [SKIP] ...\n" + "\n".join(lines[-5:])
 
-    def _save_json(self, data, filename):
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def _save_json(self, data, file_path, filename):
+        """
+        Результаты книги пишутся в свою папку: <output_dir>/<имя книги>_<расширение>/<filename>.
+        В компактном режиме params_used опускается у листов с DEFAULT_SETTINGS.
+        """
+        folder = os.path.join(self.output_dir, workbook_dirname(file_path))
+        os.makedirs(folder, exist_ok=True)
+        compact = config.XLSX_RESULT_COMPACT
+        if compact:
+            data = {title: _without_default_params(report) for title, report in data.items()}
+        if write_result is not None:
+            write_result(os.path.join(folder, filename), data, config.XLSX_RESULT_FORMAT, compact)
+            return
+        with open(os.path.join(folder, filename), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, **({"separators": (",", ":")} if compact else {"indent": 2}))
+
+def _without_default_params(report):
+    if isinstance(report, dict) and report.get("params_used") == config.DEFAULT_SETTINGS:
+        return {k: v for k, v in report.items() if k != "params_used"}
+    return report
+
+def _preset_of(params):
+    """Имя пресета, которому соответствуют параметры листа (None — индивидуальные)."""
+    for name, preset in config.PRESETS.items():
+        if all(params.get(k) == v for k, v in preset.items()):
+            return name
+    return None
+
+
+def _payload_tokens(obj):
+    return estimate_text_tokens(json.dumps(obj, ensure_ascii=False, separators=(",", ":")))
+
+
+def _decision_score(decision):
+    try:
+        return float(decision.get("quality_score") or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _as_list(value):
+    if not value:
+        return []
+    return list(value) if isinstance(value, list) else [value]
+
 
 async def main():
     path = r"C:\\Users\\sigur\\docling\\xlsx_parser\\price_10.2023.xlsx"
-    await ExcelProcessingDispatcher().process_file_workflow(path)
+    dispatcher = ExcelProcessingDispatcher()
+    try:
+        await dispatcher.process_file_workflow(path)
+    finally:
+        dispatcher.parser.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
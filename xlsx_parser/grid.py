@@ -0,0 +1,102 @@
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from merged import MergedIndex, MergedRange
+
+
+class SheetGrid:
+    """
+    Значимые ячейки листа: координаты вне объединений в массивах NumPy
+    (row-major порядок), объединения — индексом диапазонов, значения —
+    разреженной картой. Сами объекты ячеек не создаются.
+    """
+    __slots__ = ("rows", "cols", "values", "merged")
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, values: Dict[Tuple[int, int], object],
+                 merged: MergedIndex):
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.merged = merged
+
+    def __len__(self) -> int:
+        # Ячейки объединений значимы все, как MergedCell в openpyxl
+        return len(self.rows) + self.merged.area
+
+    def spans(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Горизонтальные отрезки (строка, начало, конец) в row-major порядке:
+        одиночные ячейки и по отрезку на каждую строку объединения.
+        """
+        ranges = np.asarray(self.merged.ranges, dtype=np.int64).reshape(-1, 4)
+        heights = ranges[:, 2] - ranges[:, 0] + 1
+        # Номер строки внутри диапазона: 0..height-1 для каждого диапазона подряд
+        offsets = np.arange(heights.sum()) - np.repeat(np.cumsum(heights) - heights, heights)
+
+        rows = np.concatenate([self.rows, np.repeat(ranges[:, 0], heights) + offsets]).astype(np.int64)
+        starts = np.concatenate([self.cols, np.repeat(ranges[:, 1], heights)]).astype(np.int64)
+        ends = np.concatenate([self.cols, np.repeat(ranges[:, 3], heights)]).astype(np.int64)
+        order = np.lexsort((starts, rows))
+        return rows[order], starts[order], ends[order]
+
+
+class GridBuilder:
+    """
+    Накопитель сырых ячеек при чтении листа. Значимость считается одним
+    векторным проходом: has_value | decorated[style_index], где decorated —
+    флаг "есть граница/заливка", вычисленный один раз на индекс стиля.
+    """
+
+    def __init__(self):
+        self.rows = array("i")
+        self.cols = array("i")
+        self.styles = array("i")
+        self.filled = bytearray()
+        self.values: Dict[Tuple[int, int], object] = {}
+        self.blank: List[int] = []  # позиции ячеек со строкой из пробелов
+
+    def add(self, row: int, col: int, style: int, value, filled: bool):
+        self.rows.append(row)
+        self.cols.append(col)
+        self.styles.append(style)
+        self.filled.append(filled)
+        if value is not None:
+            self.values[(row, col)] = value
+            if not filled:
+                self.blank.append(len(self.filled) - 1)
+
+    def build(self, decorated_styles: List[bool], merged: List[MergedRange]) -> SheetGrid:
+        rows = np.frombuffer(self.rows, dtype=np.int32) if self.rows else np.empty(0, np.int32)
+        cols = np.frombuffer(self.cols, dtype=np.int32) if self.cols else np.empty(0, np.int32)
+        styles = np.frombuffer(self.styles, dtype=np.int32) if self.styles else np.empty(0, np.int32)
+        filled = np.frombuffer(bytes(self.filled), dtype=np.uint8).astype(bool)
+
+        # Неизвестный индекс стиля -> последний элемент (False)
+        decorated = np.array(list(decorated_styles) + [False], dtype=bool)
+        mask = filled | decorated[np.clip(styles, 0, len(decorated) - 1)]
+
+        values = self.values
+        # Незначимые ячейки (например, строка из пробелов без оформления) в карту не попадают
+        for k in self.blank:
+            if not mask[k]:
+                values.pop((int(rows[k]), int(cols[k])), None)
+
+        rows, cols = rows[mask], cols[mask]
+        index = MergedIndex(merged)
+        if merged:
+            # Ячейки внутри объединений хранит индекс; значение остается только у якоря
+            inside = np.zeros(len(rows), dtype=bool)
+            for k in np.flatnonzero(index.rows_mask(rows)).tolist():
+                r, c = int(rows[k]), int(cols[k])
+                rng = index.lookup(r, c)
+                if rng is not None:
+                    inside[k] = True
+                    if (r, c) != (rng[0], rng[1]):
+                        values.pop((r, c), None)
+            rows, cols = rows[~inside], cols[~inside]
+
+        # Сортировка row-major одним проходом
+        order = np.lexsort((cols, rows))
+        return SheetGrid(rows[order].astype(np.int32), cols[order].astype(np.int32), values, index)
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Optional
+
+logger = logging.getLogger("ImageCache")
+
+
+def image_digest(data: bytes) -> str:
+    """Ключ картинки — хэш исходных байтов (до перекодирования)."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageAnalysisCache:
+    """
+    Ответы VLM по картинкам между файлами: логотипы, печати и подписи
+    повторяются во всех книгах организации. Одна запись — один JSON-файл
+    в каталоге кэша (как в кэше листов): параллельные воркеры пишут разные
+    файлы и не затирают записи друг друга. Давно не использованные записи вытесняются.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 5000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._written = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, digest: str) -> Optional[Any]:
+        path = self._path(digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                analysis = json.load(f)
+            os.utime(path)  # время использования — для вытеснения
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot read image cache {path}: {e}")
+            return None
+        return analysis or None
+
+    def put(self, digest: str, analysis: Any):
+        if not analysis:
+            return
+        path = self._path(digest)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(analysis, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._written += 1
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Cannot write image cache {path}: {e}")
+
+    def evict(self):
+        """Удаление давно не использованных записей сверх max_entries (после разбора книги)."""
+        if not self._written:
+            return
+        self._written = 0
+        entries = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass  # уже удалена соседним воркером
+        except OSError as e:
+            logger.warning(f"Cannot list image cache {self.directory}: {e}")
+            return
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -88,14 +88,28 @@ def _manual_json_clean(text: str) -> Optional[Dict[str, Any]]:
     return None
 
 import aiohttp
+import base64
+import io
 import json
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, List
+
+try:
+    # Общий бюджет и очередь запросов к LLM (корень репозитория в sys.path, как в document_dispatcher)
+    from resource_budget import async_llm_slot, configure as configure_llm_queue
+    from config import XLSX_LLM_CONCURRENCY, XLSX_LLM_AGING_TOKENS_PER_SEC
+    configure_llm_queue(XLSX_LLM_CONCURRENCY, XLSX_LLM_AGING_TOKENS_PER_SEC)
+except ImportError:
+    from contextlib import nullcontext
+
+    def async_llm_slot(cost: float = 0.0, label: str = ""):
+        return nullcontext()
 
 logger = logging.getLogger("LLM_Client")
 
-async def call_gemma_async(prompt: str, session: aiohttp.ClientSession, image_b64: str = "") -> Optional[Dict[str, Any]]:
-    from config import LLM_ENDPOINT, LLM_MODEL
+async def call_gemma_async(prompt: str, session: aiohttp.ClientSession, image_b64: str = "",
+                           label: str = "") -> Optional[Dict[str, Any]]:
+    from config import LLM_ENDPOINT, LLM_MODEL, XLSX_LLM_EXPECTED_OUTPUT_RATIO
     
     # Печатаем промпт для отладки
     print("\n" + "="*50 + "\nPROMPT TO LLM:\n" + prompt + "\n" + "="*50)
@@ -112,7 +126,9 @@ async def call_gemma_async(prompt: str, session: aiohttp.ClientSession, image_b6
     }
 
     try:
-        async with session.post(f"{LLM_ENDPOINT}/api/chat", json=payload, timeout=120) as response:
+        cost = request_cost(prompt, expected_output=XLSX_LLM_EXPECTED_OUTPUT_RATIO * estimate_text_tokens(prompt))
+        async with async_llm_slot(cost, label), \
+                session.post(f"{LLM_ENDPOINT}/api/chat", json=payload, timeout=120) as response:
             if response.status != 200:
                 logger.error(f"Ollama error: {response.status}")
                 return None
@@ -124,7 +140,169 @@ async def call_gemma_async(prompt: str, session: aiohttp.ClientSession, image_b6
         logger.error(f"Error calling LLM: {e}")
         return None
 
-async def process_image(session: aiohttp.ClientSession, file_path: str, filename: str) -> str:
+async def process_image(session: aiohttp.ClientSession, image_bytes: bytes, filename: str) -> str:
     """Моковая функция VLM для тестов"""
     await asyncio.sleep(0.5)
     return f"VLM_ANALYSIS: На изображении {filename} обнаружена подпись или печать."
+
+async def process_images_batch(session: aiohttp.ClientSession, images_b64: List[str]) -> List[Optional[str]]:
+    """
+    Один multi-image запрос к VLM. Возвращает описания в порядке картинок;
+    None — описание не получено (ошибка запроса или пустой ответ по картинке).
+    """
+    from config import XLSX_LLM_IMAGE_OUTPUT_TOKENS
+    from prompts import get_image_batch_prompt
+
+    payload = {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "user", "content": get_image_batch_prompt(len(images_b64)), "images": images_b64}
+        ],
+        "stream": False,
+        "format": "json",
+        "options": {"temperature": 0.0, "num_ctx": 16000}
+    }
+
+    descriptions: List[Optional[str]] = [None] * len(images_b64)
+    try:
+        prompt = payload["messages"][0]["content"]
+        cost = request_cost(prompt, images_b64, XLSX_LLM_IMAGE_OUTPUT_TOKENS * len(images_b64))
+        async with async_llm_slot(cost, f"картинки x{len(images_b64)}"), \
+                session.post(f"{LLM_ENDPOINT}/api/chat", json=payload, timeout=120) as response:
+            if response.status != 200:
+                logger.error(f"Ollama error: {response.status}")
+                return descriptions
+            res_data = await response.json()
+            content = res_data.get("message", {}).get("content", "").strip()
+            items = (json.loads(content) or {}).get("results", [])
+    except Exception as e:
+        logger.error(f"Error calling VLM batch: {e}")
+        return descriptions
+
+    for pos, item in enumerate(items if isinstance(items, list) else []):
+        if not isinstance(item, dict):
+            continue
+        idx = item.get("index", pos)
+        description = str(item.get("description") or "").strip()
+        if isinstance(idx, int) and 0 <= idx < len(descriptions) and description:
+            descriptions[idx] = description
+    return descriptions
+
+def _estimate_image_tokens(data: bytes, patch_px: int = 28) -> int:
+    """Оценка визуальных токенов по размеру картинки (один токен на блок 28x28)."""
+    from PIL import Image as PILImage
+    with PILImage.open(io.BytesIO(data)) as img:
+        w, h = img.size
+    return -(-w // patch_px) * -(-h // patch_px)
+
+def estimate_text_tokens(text: str, chars_per_token: float = 3.0) -> int:
+    """Грубая оценка токенов текста (кириллица и JSON-разметка — около 3 символов на токен)."""
+    return int(len(text) / chars_per_token) + 1
+
+def request_cost(prompt: str, images_b64: List[str] = (), expected_output: float = 0) -> float:
+    """
+    Оценка стоимости запроса для очереди LLM в токенах промпта:
+    текст и картинки плюс ожидаемый ответ с весом декодирования.
+    """
+    from config import XLSX_LLM_DECODE_WEIGHT
+    image_tokens = sum(_estimate_image_tokens(base64.b64decode(b64)) for b64 in images_b64)
+    return estimate_text_tokens(prompt) + image_tokens + XLSX_LLM_DECODE_WEIGHT * expected_output
+
+class ImageCoalescer:
+    """
+    Обертка над image_callback: параллельные вызовы мелких картинок
+    собираются в один multi-image запрос (batch_fn) под бюджет токенов,
+    ответы раскладываются обратно по вызывающим корутинам; картинки без ответа
+    в пакете добираются одиночным запросом single_fn.
+    Совместима по сигнатуре с image_callback(session, image_bytes, filename).
+    """
+
+    def __init__(self, batch_fn: Callable, single_fn: Optional[Callable] = None,
+                 max_images: int = 6, token_budget: int = 4000,
+                 small_image_tokens: int = 600, window_sec: float = 0.05):
+        self.batch_fn = batch_fn
+        self.single_fn = single_fn
+        self.max_images = max_images
+        self.token_budget = token_budget
+        self.small_image_tokens = small_image_tokens
+        self.window_sec = window_sec
+        self._pending: List[tuple] = []  # (b64, tokens, future, image_bytes, filename)
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._session = None
+        self._tasks: set = set()  # ссылки на запущенные пакеты: иначе задачу может собрать GC
+        self.stats = {"images": 0, "requests": 0}
+
+    def log_stats(self, label: str):
+        """Лог картинок и запросов к VLM с прошлого вызова; счетчики начинаются с нуля."""
+        images, requests = self.stats["images"], self.stats["requests"]
+        if images:
+            logger.info(f"🧩 {label}: {images} картинок за {requests} запросов к VLM "
+                        f"({images / max(requests, 1):.1f} на запрос)")
+        self.stats = {"images": 0, "requests": 0}
+
+    async def __call__(self, session, image_bytes: bytes, filename: str) -> str:
+        data = image_bytes
+        tokens = _estimate_image_tokens(data)
+        self.stats["images"] += 1
+
+        if tokens > self.small_image_tokens:
+            self.stats["requests"] += 1
+            if self.single_fn:
+                return await self.single_fn(session, image_bytes, filename)
+            return (await self.batch_fn(session, [base64.b64encode(data).decode("utf-8")]))[0]
+
+        self._session = session
+        if self._pending and self._pending_tokens + tokens > self.token_budget:
+            self._flush()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((base64.b64encode(data).decode("utf-8"), tokens, future, image_bytes, filename))
+        self._pending_tokens += tokens
+
+        if len(self._pending) >= self.max_images:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_sec, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        self.stats["requests"] += 1
+        task = asyncio.ensure_future(self._run_batch(self._session, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, session, batch: List[tuple]):
+        try:
+            results = await self.batch_fn(session, [item[0] for item in batch])
+        except Exception as e:
+            logger.error(f"Image batch failed: {e}")
+            results = [None] * len(batch)
+        results = list(results)[:len(batch)] + [None] * (len(batch) - len(results))
+
+        retry = [item for item, res in zip(batch, results) if not res] if self.single_fn else []
+        for item, res in zip(batch, results):
+            if res and not item[2].done():
+                item[2].set_result(res)
+        if retry:
+            # Картинка не вернулась из пакета — добираем отдельным запросом
+            self.stats["requests"] += len(retry)
+            singles = await asyncio.gather(
+                *(self.single_fn(session, image_bytes, filename) for _, _, _, image_bytes, filename in retry),
+                return_exceptions=True,
+            )
+            for item, res in zip(retry, singles):
+                if item[2].done():
+                    continue
+                if isinstance(res, BaseException):
+                    item[2].set_exception(res)
+                else:
+                    item[2].set_result(res)
+        for item in batch:
+            if not item[2].done():
+                item[2].set_result(None)
@@ -0,0 +1,71 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from openpyxl.utils import get_column_letter
+
+# (min_row, min_col, max_row, max_col)
+MergedRange = Tuple[int, int, int, int]
+
+
+def range_ref(rng: MergedRange) -> str:
+    """(1, 1, 3, 3) -> 'A1:C3'"""
+    min_row, min_col, max_row, max_col = rng
+    return f"{get_column_letter(min_col)}{min_row}:{get_column_letter(max_col)}{max_row}"
+
+
+class MergedIndex:
+    """
+    Индекс объединенных диапазонов без разворачивания по ячейкам.
+    Строки делятся на полосы по границам диапазонов; в каждой полосе —
+    отсортированные по колонке интервалы. Поиск — два bisect, O(log n).
+    Баннер A1:XFD1 занимает одну запись, а не 16384.
+    """
+    __slots__ = ("ranges", "area", "_edges", "_band_starts", "_band_cols", "_band_ranges")
+
+    def __init__(self, ranges: Iterable[MergedRange] = ()):
+        self.ranges: List[MergedRange] = list(ranges)
+        self.area = sum((r[2] - r[0] + 1) * (r[3] - r[1] + 1) for r in self.ranges)
+
+        edges = sorted({r[0] for r in self.ranges} | {r[2] + 1 for r in self.ranges})
+        self._edges = edges
+        self._band_starts = edges[:-1]
+        bands: List[List[Tuple[int, MergedRange]]] = [[] for _ in self._band_starts]
+        for rng in self.ranges:
+            for i in range(bisect_left(edges, rng[0]), bisect_left(edges, rng[2] + 1)):
+                bands[i].append((rng[1], rng))
+        for band in bands:
+            band.sort()
+        self._band_cols = [[col for col, _ in band] for band in bands]
+        self._band_ranges = [[rng for _, rng in band] for band in bands]
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+    def rows_mask(self, rows: np.ndarray) -> np.ndarray:
+        """Векторная предпроверка: строка пересекается хотя бы с одним диапазоном."""
+        if not self.ranges:
+            return np.zeros(len(rows), dtype=bool)
+        filled = np.array([bool(cols) for cols in self._band_cols] + [False])
+        band = np.searchsorted(np.asarray(self._edges), rows, side="right") - 1
+        # Строки выше первой границы и ниже последней не попадают ни в одну полосу
+        band[band < 0] = len(filled) - 1
+        return filled[band]
+
+    def lookup(self, row: int, col: int) -> Optional[MergedRange]:
+        """Диапазон, которому принадлежит ячейка, или None."""
+        i = bisect_right(self._band_starts, row) - 1
+        if i < 0:
+            return None
+        j = bisect_right(self._band_cols[i], col) - 1
+        if j < 0:
+            return None
+        rng = self._band_ranges[i][j]
+        if rng[0] <= row <= rng[2] and col <= rng[3]:
+            return rng
+        return None
+
+    def anchor(self, row: int, col: int) -> Optional[Tuple[int, int]]:
+        """Левая верхняя ячейка объединения, содержащего (row, col)."""
+        rng = self.lookup(row, col)
+        return (rng[0], rng[1]) if rng else None
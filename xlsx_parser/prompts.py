@@ -1,16 +1,24 @@
 import json
 import config
 
-def get_tuning_prompt(payload, attempt_num):
+def _chunk_note(chunk):
+    """Пояснение для части большого файла: (номер, всего)."""
+    if not chunk or chunk[1] <= 1:
+        return ""
+    return (f"\nФайл большой: это часть {chunk[0]} из {chunk[1]}. Оценивай только листы (блоки) из этой части;"
+            f" лист может быть разбит на несколько частей.\n")
+
+
+def get_tuning_prompt(payload, attempt_num, chunk=None):
     return f"""
 Ты — AI-аудитор структуры документов. Твоя задача: оценить качество сегментации Excel-файла на логические блоки.
 Это попытка №{attempt_num} из {config.XLSX_PARSER_NUM_RETRIES}.
-
+{_chunk_note(chunk)}
 БИБЛИОТЕКА ТИПОВ:
-{json.dumps(config.BLOCK_TYPES_LIBRARY, indent=2, ensure_ascii=False)}
+{json.dumps(config.BLOCK_TYPES_LIBRARY, ensure_ascii=False, separators=(",", ":"))}
 
 АНАЛИЗИРУЕМЫЕ ДАННЫЕ (Превью блоков):
-{json.dumps(payload, indent=2, ensure_ascii=False)}
+{json.dumps(payload, ensure_ascii=False, separators=(",", ":"))}
 
 ТВОИ ЗАДАЧИ:
 1. Вычисли quality_score (от 0.0 до 1.0) для всего документа.
@@ -35,3 +43,53 @@ def get_tuning_prompt(payload, attempt_num):
   }}
 }}
 """
+
+def get_image_batch_prompt(count):
+    return f"""
+Тебе передано {count} изображений из Excel-файла (подписи, печати, логотипы, сканы).
+Опиши каждое изображение НЕЗАВИСИМО: что изображено и весь читаемый текст.
+Нумерация изображений начинается с 0 и совпадает с порядком картинок.
+
+ОТВЕТЬ ТОЛЬКО JSON:
+{{
+  "results": [
+    {{"index": 0, "description": "что изображено и распознанный текст"}}
+  ]
+}}
+"""
+
+def get_selection_prompt(payload, chunk=None):
+    return f"""
+Ты — AI-аудитор структуры документов. Каждый лист Excel-файла уже сегментирован на блоки
+несколькими пресетами. Выбери для КАЖДОГО листа лучший вариант сегментации.
+{_chunk_note(chunk)}
+ПРЕСЕТЫ:
+- "Tight": малые допуски, блоки режутся мельче.
+- "Standard": средние допуски.
+- "Relaxed": большие допуски, соседние части объединяются.
+
+БИБЛИОТЕКА ТИПОВ:
+{json.dumps(config.BLOCK_TYPES_LIBRARY, ensure_ascii=False, separators=(",", ":"))}
+
+ВАРИАНТЫ ПО ЛИСТАМ (лист -> пресет -> coverage и превью блоков;
+строка "same_as:<пресет>" значит, что сегментация совпадает с указанным пресетом):
+{json.dumps(payload, ensure_ascii=False, separators=(",", ":"))}
+
+КРИТЕРИИ:
+- Хороший вариант: каждый блок содержит только один тип данных.
+- ОШИБКА "Склейка": в одном блоке разные типы данных (напр. Анкета и Таблица) — нужен более узкий пресет.
+- ОШИБКА "Распад": одна логическая таблица разбита на множество мелких блоков — нужен более широкий пресет.
+
+ОТВЕТЬ ТОЛЬКО JSON:
+{{
+  "quality_score": 0.0-1.0,
+  "reason": "техническое обоснование",
+  "sheets": {{
+     "ИмяЛиста": {{
+        "preset": "Tight" или "Standard" или "Relaxed",
+        "quality_score": 0.0-1.0,
+        "summaries": ["Краткое описание структуры листа"]
+     }}
+  }}
+}}
+"""
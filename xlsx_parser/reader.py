@@ -0,0 +1,396 @@
+import hashlib
+import logging
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import from_excel, CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900
+
+from grid import GridBuilder, SheetGrid
+from merged import MergedRange
+
+logger = logging.getLogger("ExcelReader")
+
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+NS_XDR = "{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}"
+NS_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+_REF_RE = re.compile(r"([A-Z]+)(\d+)")
+# Ячейка с общей строкой: <c ... t="s" ...><v>индекс</v></c>
+_SST_CELL_RE = re.compile(rb'(<c\b[^>]*\bt="s"[^>]*>\s*<v>)(\d+)(</v>)')
+_COL_CACHE: Dict[str, int] = {}
+_DIGEST_CHUNK = 1 << 20
+
+
+def column_index(letters: str) -> int:
+    idx = _COL_CACHE.get(letters)
+    if idx is None:
+        idx = 0
+        for ch in letters:
+            idx = idx * 26 + ord(ch) - 64
+        _COL_CACHE[letters] = idx
+    return idx
+
+
+def parse_ref(ref: str) -> Tuple[int, int]:
+    """'B12' -> (12, 2)"""
+    m = _REF_RE.match(ref)
+    return int(m.group(2)), column_index(m.group(1))
+
+
+def parse_range(ref: str) -> MergedRange:
+    """'A1:C3' -> (1, 1, 3, 3)"""
+    start, _, end = ref.partition(":")
+    r1, c1 = parse_ref(start)
+    r2, c2 = parse_ref(end or start)
+    return min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2)
+
+
+def has_value(value) -> bool:
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return value.strip() != ""
+    return True
+
+
+class SheetData:
+    """
+    Компактное представление листа для стадий значимости и кластеризации:
+    сетка значимых ячеек, объединения и картинки — без объектной модели openpyxl.
+    """
+    __slots__ = ("title", "grid", "merged", "images")
+
+    def __init__(self, title: str):
+        self.title = title
+        self.grid: Optional[SheetGrid] = None
+        self.merged: List[MergedRange] = []
+        self.images: List[Dict] = []  # {"data": bytes, "anchor": "B3"}
+
+
+class StreamingWorkbookReader:
+    """
+    Потоковое чтение XLSX: XML листов разбирается через iterparse построчно,
+    стили (границы/заливки/форматы дат) берутся из таблицы стилей по индексу.
+    Память зависит от числа непустых ячеек, а не от размеров листа.
+    """
+
+    def __init__(self, file_path: str, shared_strings: Optional[List[str]] = None):
+        """
+        :param shared_strings: уже разобранные общие строки этой книги
+                               (от предыдущего чтения) — sharedStrings.xml не перечитывается
+        """
+        self.file_path = file_path
+        self.zf = zipfile.ZipFile(file_path)
+        self._names = set(self.zf.namelist())
+        self.epoch = CALENDAR_WINDOWS_1900
+        self.sheets = self._read_workbook()        # [(title, part_path)]
+        self.shared_strings = self._read_shared_strings() if shared_strings is None else shared_strings
+        self.decorated_styles, self.date_styles = self._read_styles()
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- служебные части пакета ---
+
+    def _parse(self, path: str) -> Optional[ET.Element]:
+        if path not in self._names:
+            return None
+        with self.zf.open(path) as f:
+            return ET.parse(f).getroot()
+
+    def _rels(self, part_path: str) -> Dict[str, Tuple[str, str]]:
+        """Id связи -> (тип, абсолютный путь цели) для части пакета."""
+        folder, name = posixpath.split(part_path)
+        root = self._parse(posixpath.join(folder, "_rels", name + ".rels"))
+        rels = {}
+        if root is None:
+            return rels
+        for rel in root.iter(f"{NS_PKG_REL}Relationship"):
+            target = rel.get("Target", "")
+            if rel.get("TargetMode") == "External":
+                continue
+            if target.startswith("/"):
+                path = target.lstrip("/")
+            else:
+                path = posixpath.normpath(posixpath.join(folder, target))
+            rels[rel.get("Id")] = (rel.get("Type", ""), path)
+        return rels
+
+    def _read_workbook(self) -> List[Tuple[str, str]]:
+        root = self._parse("xl/workbook.xml")
+        if root is None:
+            raise ValueError("xl/workbook.xml not found")
+        pr = root.find(f"{NS_MAIN}workbookPr")
+        if pr is not None and pr.get("date1904") in ("1", "true"):
+            self.epoch = CALENDAR_MAC_1904
+        rels = self._rels("xl/workbook.xml")
+        sheets = []
+        for sh in root.iter(f"{NS_MAIN}sheet"):
+            rel_type, path = rels.get(sh.get(f"{NS_REL}id"), ("", ""))
+            # Как и wb.worksheets в openpyxl: только рабочие листы, без chartsheet
+            if rel_type.endswith("/worksheet") and path in self._names:
+                sheets.append((sh.get("name"), path))
+        return sheets
+
+    def _read_shared_strings(self) -> List[str]:
+        path = "xl/sharedStrings.xml"
+        if path not in self._names:
+            return []
+        strings = []
+        with self.zf.open(path) as f:
+            for _, elem in ET.iterparse(f):
+                if elem.tag != f"{NS_MAIN}si":
+                    continue
+                # Фонетические подсказки (rPh) openpyxl тоже пропускает
+                parts = [t.text or "" for t in elem.findall(f"{NS_MAIN}t")]
+                parts += [t.text or "" for t in elem.findall(f"{NS_MAIN}r/{NS_MAIN}t")]
+                strings.append("".join(parts))
+                elem.clear()
+        return strings
+
+    def _read_styles(self) -> Tuple[List[bool], List[bool]]:
+        """
+        Для каждого индекса стиля ячейки (cellXfs): есть ли граница/заливка
+        и является ли формат датой. Считается один раз на стиль, а не на ячейку.
+        """
+        root = self._parse("xl/styles.xml")
+        if root is None:
+            return [], []
+
+        custom_formats = {}
+        for fmt in root.iter(f"{NS_MAIN}numFmt"):
+            custom_formats[int(fmt.get("numFmtId"))] = fmt.get("formatCode", "")
+
+        borders = []
+        for border in root.iterfind(f"{NS_MAIN}borders/{NS_MAIN}border"):
+            borders.append(any(
+                side is not None and side.get("style")
+                for side in (border.find(f"{NS_MAIN}{name}") for name in ("left", "right", "top", "bottom"))
+            ))
+
+        fills = []
+        for fill in root.iterfind(f"{NS_MAIN}fills/{NS_MAIN}fill"):
+            pattern = fill.find(f"{NS_MAIN}patternFill")
+            if pattern is not None:
+                fills.append(pattern.get("patternType") not in (None, "none"))
+            else:
+                fills.append(fill.find(f"{NS_MAIN}gradientFill") is not None)
+
+        decorated, dates = [], []
+        for xf in root.iterfind(f"{NS_MAIN}cellXfs/{NS_MAIN}xf"):
+            b_id, f_id = int(xf.get("borderId", 0)), int(xf.get("fillId", 0))
+            decorated.append((b_id < len(borders) and borders[b_id]) or (f_id < len(fills) and fills[f_id]))
+            fmt_id = int(xf.get("numFmtId", 0))
+            fmt = custom_formats.get(fmt_id, BUILTIN_FORMATS.get(fmt_id, "General"))
+            dates.append(is_date_format(fmt))
+        return decorated, dates
+
+    # --- отпечатки листов ---
+
+    def _hash_member(self, h, path: str):
+        with self.zf.open(path) as f:
+            for chunk in iter(lambda: f.read(_DIGEST_CHUNK), b""):
+                h.update(chunk)
+
+    def sheet_digests(self) -> Dict[str, str]:
+        """Отпечаток содержимого каждого листа (в порядке книги) — без разбора ячеек."""
+        styles = hashlib.sha256()
+        if "xl/styles.xml" in self._names:
+            self._hash_member(styles, "xl/styles.xml")
+        styles_digest = styles.digest()
+        return {title: self.sheet_digest(path, styles_digest) for title, path in self.sheets}
+
+    def sheet_digest(self, path: str, styles_digest: bytes = b"") -> str:
+        """
+        SHA-256 XML листа, стилей, календаря книги и его картинок. Индексы общих строк
+        подменяются самими строками: правка другого листа перенумеровывает
+        sharedStrings, но не меняет отпечаток этого.
+        XML читается кусками: хвост от последнего "<c" переносится в следующий кусок,
+        чтобы ячейка на границе кусков не осталась без подмены.
+        """
+        h = hashlib.sha256()
+        h.update(styles_digest)
+        h.update(b"1904" if self.epoch == CALENDAR_MAC_1904 else b"1900")
+        strings = self.shared_strings
+
+        def resolve(m):
+            idx = int(m.group(2))
+            text = strings[idx] if idx < len(strings) else ""
+            return m.group(1) + b"\x00" + text.encode("utf-8") + m.group(3)
+
+        tail = b""
+        with self.zf.open(path) as f:
+            for chunk in iter(lambda: f.read(_DIGEST_CHUNK), b""):
+                buf = tail + chunk
+                # Совпадение начинается с "<c" и других "<c" не содержит
+                cut = buf.rfind(b"<c")
+                if cut < 0:
+                    cut = len(buf) - 1
+                h.update(_SST_CELL_RE.sub(resolve, buf[:cut]))
+                tail = buf[cut:]
+        h.update(_SST_CELL_RE.sub(resolve, tail))
+        for rel_type, drawing_path in sorted(self._rels(path).values()):
+            if not rel_type.endswith("/drawing") or drawing_path not in self._names:
+                continue
+            self._hash_member(h, drawing_path)
+            for _, media_path in sorted(self._rels(drawing_path).values()):
+                if media_path in self._names:
+                    self._hash_member(h, media_path)
+        return h.hexdigest()
+
+    # --- листы ---
+
+    def iter_sheets(self, target_sheets: Optional[List[str]] = None) -> Iterator[SheetData]:
+        for title, path in self.sheets:
+            if target_sheets and title not in target_sheets:
+                continue
+            yield self.read_sheet(title, path)
+
+    def _cell_value(self, c_type: Optional[str], raw: Optional[str], style: int, inline: Optional[ET.Element]):
+        if c_type == "inlineStr":
+            if inline is None:
+                return None
+            return "".join(t.text or "" for t in inline.iter(f"{NS_MAIN}t"))
+        if raw is None:
+            return None
+        if c_type == "s":
+            return self.shared_strings[int(raw)]
+        if c_type in ("str", "e", "d"):
+            return raw
+        if c_type == "b":
+            return raw in ("1", "true")
+        if any(ch in raw for ch in ".eE"):
+            value = float(raw)
+        else:
+            value = int(raw)
+        if style < len(self.date_styles) and self.date_styles[style]:
+            try:
+                return from_excel(value, self.epoch)
+            except (ValueError, OverflowError):
+                return value
+        return value
+
+    def read_sheet(self, title: str, path: str) -> SheetData:
+        sheet = SheetData(title)
+        builder = GridBuilder()
+        row_idx, col_idx = 0, 0
+        sheet_data_elem = None
+
+        with self.zf.open(path) as f:
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                tag = elem.tag
+                if event == "start":
+                    if tag == f"{NS_MAIN}sheetData":
+                        sheet_data_elem = elem
+                    elif tag == f"{NS_MAIN}row":
+                        r = elem.get("r")
+                        row_idx = int(r) if r else row_idx + 1
+                        col_idx = 0
+                    continue
+
+                if tag == f"{NS_MAIN}c":
+                    ref = elem.get("r")
+                    if ref:
+                        row_idx, col_idx = parse_ref(ref)
+                    else:
+                        col_idx += 1
+                    style = int(elem.get("s", 0))
+                    v = elem.find(f"{NS_MAIN}v")
+                    value = self._cell_value(
+                        elem.get("t"), v.text if v is not None else None, style, elem.find(f"{NS_MAIN}is")
+                    )
+                    builder.add(row_idx, col_idx, style, value, has_value(value))
+                elif tag == f"{NS_MAIN}row":
+                    # Обработанные строки выбрасываем, чтобы дерево не росло
+                    elem.clear()
+                    if sheet_data_elem is not None:
+                        sheet_data_elem.remove(elem)
+                elif tag == f"{NS_MAIN}mergeCell":
+                    sheet.merged.append(parse_range(elem.get("ref")))
+
+        sheet.grid = builder.build(self.decorated_styles, sheet.merged)
+        sheet.images = self._read_images(path)
+        return sheet
+
+    def _read_images(self, sheet_path: str) -> List[Dict]:
+        images = []
+        for rel_type, drawing_path in self._rels(sheet_path).values():
+            if not rel_type.endswith("/drawing"):
+                continue
+            root = self._parse(drawing_path)
+            if root is None:
+                continue
+            media = self._rels(drawing_path)
+            for anchor in root:
+                blip = anchor.find(f".//{NS_A}blip")
+                if blip is None:
+                    continue
+                _, media_path = media.get(blip.get(f"{NS_REL}embed"), ("", ""))
+                if media_path not in self._names:
+                    continue
+                pos = "Unknown"
+                frm = anchor.find(f"{NS_XDR}from")
+                if frm is not None:
+                    col = int(frm.findtext(f"{NS_XDR}col", "0"))
+                    row = int(frm.findtext(f"{NS_XDR}row", "0"))
+                    pos = f"{get_column_letter(col + 1)}{row + 1}"
+                images.append({"data": self.zf.read(media_path), "anchor": pos})
+        return images
+
+
+def _openpyxl_decorated(cell) -> bool:
+    """Есть ли у ячейки граница или заливка."""
+    b = cell.border
+    if b and any(side is not None and side.style for side in (b.left, b.right, b.top, b.bottom)):
+        return True
+    if cell.fill and getattr(cell.fill, "patternType", None) and cell.fill.patternType != 'none':
+        return True
+    return False
+
+
+def iter_sheets_openpyxl(wb, target_sheets: Optional[List[str]] = None) -> Iterator[SheetData]:
+    """Запасной путь: полная объектная модель openpyxl (нестандартные пакеты)."""
+    for ws in wb.worksheets:
+        if target_sheets and ws.title not in target_sheets:
+            continue
+        sheet = SheetData(ws.title)
+        sheet.merged = [(r.min_row, r.min_col, r.max_row, r.max_col) for r in ws.merged_cells.ranges]
+        builder = GridBuilder()
+        # Оформление проверяется один раз на пару (borderId, fillId), а не на каждую ячейку
+        style_index: Dict[Optional[Tuple[int, int]], int] = {}
+        decorated: List[bool] = []
+        for row in ws.iter_rows():
+            for cell in row:
+                # Ячейки без собственного стиля (_style is None) делят стиль по умолчанию
+                key = (cell._style.borderId, cell._style.fillId) if cell._style is not None else None
+                style = style_index.get(key)
+                if style is None:
+                    style = style_index[key] = len(decorated)
+                    decorated.append(_openpyxl_decorated(cell))
+                value = cell.value
+                builder.add(cell.row, cell.column, style, value, has_value(value))
+        sheet.grid = builder.build(decorated, sheet.merged)
+
+        for img in getattr(ws, "_images", []):
+            try:
+                anchor = f"{get_column_letter(img.anchor._from.col + 1)}{img.anchor._from.row + 1}"
+            except Exception:
+                anchor = "Unknown"
+            try:
+                sheet.images.append({"data": img._data(), "anchor": anchor})
+            except Exception as e:
+                logger.error(f"Cannot read image on {ws.title}: {e}")
+        yield sheet
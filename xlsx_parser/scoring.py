@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import config
+from reader import parse_range
+
+logger = logging.getLogger("Scoring")
+
+_PART_RE = re.compile(r"\[([A-Z]+\d+)(?::([A-Z]+\d+))?\]:")
+_SKIP_RE = re.compile(r"^\.\.\. \[SKIPPED -?\d+ ROWS(, [^\]]*)?\] \.\.\.$")
+
+
+def _preset_order() -> List[str]:
+    """Пресеты от узких допусков к широким."""
+    return sorted(config.PRESETS, key=lambda n: (config.PRESETS[n]["V_TOLERANCE"], config.PRESETS[n]["H_TOLERANCE"]))
+
+
+def _current_preset(params: Dict) -> str:
+    for name, preset in config.PRESETS.items():
+        if all(params.get(k) == v for k, v in preset.items() if k in ("V_TOLERANCE", "H_TOLERANCE")):
+            return name
+    return config.DEFAULT_PRESET
+
+
+def _shift_preset(current: str, step: int) -> str:
+    order = _preset_order()
+    idx = order.index(current) if current in order else order.index(config.DEFAULT_PRESET)
+    return order[max(0, min(len(order) - 1, idx + step))]
+
+
+def _line_shape(line: str) -> Tuple[int, int]:
+    """(число ячеек в строке превью, из них объединений)"""
+    parts = _PART_RE.findall(line)
+    return len(parts), sum(1 for _, end in parts if end)
+
+
+def _is_header_body_mix(region: Dict) -> bool:
+    """
+    Склейка анкеты и таблицы: начало блока — редкие пары/объединения,
+    конец — широкие регулярные строки.
+    """
+    lines = [l for l in region.get("preview", "").split("\n") if l.strip() and not _SKIP_RE.match(l)]
+    if len(lines) < 6:
+        return False
+    head, tail = [_line_shape(l) for l in lines[:3]], [_line_shape(l) for l in lines[-3:]]
+    head_width = sum(w for w, _ in head) / len(head)
+    tail_width = sum(w for w, _ in tail) / len(tail)
+    head_merged = sum(m for _, m in head)
+    tail_merged = sum(m for _, m in tail)
+    return tail_width >= 3 and (head_width <= tail_width / 2 or (head_merged and not tail_merged))
+
+
+def sheet_metrics(report: Dict) -> Dict:
+    """Метрики сегментации листа по отчету парсера."""
+    regions = report.get("regions") or []
+    cells = [r.get("metrics", {}).get("cells", 0) for r in regions]
+    densities = []
+    for r, n in zip(regions, cells):
+        min_row, min_col, max_row, max_col = parse_range(r["range"])
+        area = (max_row - min_row + 1) * (max_col - min_col + 1)
+        if n >= 20:
+            densities.append(n / area)
+    total = sum(cells)
+    return {
+        "coverage": report.get("coverage", 1.0),
+        "regions": len(regions),
+        "cells_per_region": round(total / len(regions), 2) if regions else 0.0,
+        # Доля "крошек": блоки из 1-2 ячеек при большом числе блоков
+        "fragmentation": round(sum(1 for n in cells if n <= 2) / len(regions), 4) if len(regions) > 5 else 0.0,
+        # Плотность крупных блоков: низкая — признак склеенных разреженных частей
+        "density": round(min(densities), 4) if densities else 1.0,
+        "mixed_regions": sum(1 for r in regions if _is_header_body_mix(r)),
+    }
+
+
+def score_sheet(report: Dict) -> Dict:
+    """Локальная оценка листа: score 0..1, рекомендованный пресет и причины."""
+    if not isinstance(report, dict) or "regions" not in report:
+        return {"quality_score": 1.0, "recommended_preset": config.DEFAULT_PRESET, "reasons": [], "metrics": {}}
+
+    m = sheet_metrics(report)
+    params = report.get("params_used") or config.DEFAULT_SETTINGS
+    current = _current_preset(params)
+    score, step, reasons = 1.0, 0, []
+
+    if m["coverage"] < params.get("VALIDATION_THRESHOLD", 0.98):
+        score -= 1.0 - m["coverage"]
+        reasons.append("low_coverage")
+    if m["fragmentation"] > 0.3:
+        score -= 0.5 * m["fragmentation"]
+        step += 1
+        reasons.append("fragmentation")
+    if m["mixed_regions"]:
+        score -= min(0.5, 0.25 * m["mixed_regions"])
+        step -= 1
+        reasons.append("header_body_mix")
+    if m["density"] < 0.25:
+        score -= 0.5 * (0.25 - m["density"]) / 0.25
+        step -= 1
+        reasons.append("sparse_glued_blocks")
+
+    return {
+        "quality_score": round(max(0.0, score), 4),
+        "recommended_preset": _shift_preset(current, (step > 0) - (step < 0)),
+        "reasons": reasons,
+        "metrics": m,
+    }
+
+
+def score_workbook(results: Dict) -> Dict:
+    """
+    Оценка книги: минимум по листам, рекомендации по каждому листу.
+    Ошибка разбора книги или листа и книга без оцененных листов — 0.
+    """
+    if not isinstance(results, dict) or isinstance(results.get("error"), str):
+        return {"quality_score": 0.0, "sheets": {}}
+    sheets = {name: score_sheet(rep) for name, rep in results.items() if isinstance(rep, dict)}
+    scores = [s["quality_score"] for s in sheets.values() if s["metrics"]]
+    failed = any(isinstance(rep, dict) and "error" in rep for rep in results.values())
+    return {"quality_score": min(scores) if scores and not failed else 0.0, "sheets": sheets}
+
+
+def is_ambiguous(score: float) -> bool:
+    return config.XLSX_LOCAL_REJECT_SCORE < score < config.XLSX_LOCAL_ACCEPT_SCORE
+
+
+class AgreementTracker:
+    """
+    Согласие локального скорера с LLM (решение stop/reparse и пресеты листов).
+    Копится в JSON-файле между запусками, чтобы подбирать пороги. Пакетные воркеры
+    пишут его параллельно: каждое наблюдение добавляется к свежему содержимому файла
+    под блокировкой, а не перезаписывает его снимком, прочитанным при старте.
+    """
+
+    _COUNTERS = ("consulted", "action_agree", "preset_total", "preset_agree")
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.XLSX_SCORER_STATS_FILE
+        self.stats = self._load()
+
+    def _load(self) -> Dict:
+        stats = {**dict.fromkeys(self._COUNTERS, 0), "samples": []}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    stats.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Cannot read scorer stats {self.path}: {e}")
+        return stats
+
+    def record(self, local: Dict, decision: Dict):
+        local_score = local["quality_score"]
+        try:
+            llm_score = float(decision.get("quality_score") or 0.0)
+        except (TypeError, ValueError):
+            llm_score = 0.0
+        accept = config.XLSX_LOCAL_ACCEPT_SCORE
+        delta = dict.fromkeys(self._COUNTERS, 0)
+        delta["consulted"] = 1
+        delta["action_agree"] = int((local_score >= accept) == (llm_score >= accept))
+        for name, sheet in (decision.get("sheets") or {}).items():
+            sheet = sheet or {}
+            preset = sheet.get("recommended_preset") or sheet.get("preset")
+            if name in local["sheets"] and preset in config.PRESETS:
+                delta["preset_total"] += 1
+                delta["preset_agree"] += preset == local["sheets"][name]["recommended_preset"]
+        self.save(delta, [local_score, llm_score])
+        st = self.stats
+        logger.info(
+            f"📐 Согласие со скорером: решения {st['action_agree']}/{st['consulted']}, "
+            f"пресеты {st['preset_agree']}/{st['preset_total']}"
+        )
+
+    def save(self, delta: Dict, sample: List[float]):
+        """Добавление наблюдения к файлу статистики: чтение, слияние и запись под блокировкой."""
+        try:
+            with _file_lock(self.path):
+                stats = self._load()
+                for key in self._COUNTERS:
+                    stats[key] += delta[key]
+                stats["samples"] = (stats["samples"] + [sample])[-config.XLSX_SCORER_MAX_SAMPLES:]
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(stats, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            self.stats = stats
+        except OSError as e:
+            logger.warning(f"Cannot write scorer stats {self.path}: {e}")
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Межпроцессная блокировка файла через соседний <path>.lock (flock / msvcrt на Windows)."""
+    with open(f"{path}.lock", "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
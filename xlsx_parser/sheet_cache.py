@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+logger = logging.getLogger("SheetCache")
+
+
+def cache_version() -> str:
+    """
+    Версия конвейера тюнинга: пресеты, настройки по умолчанию, модель, пороги
+    скорера и тексты промптов. Любая их правка делает старые записи недоступными.
+    """
+    import config
+    import prompts
+    settings = {
+        "version": config.XLSX_SHEET_CACHE_VERSION,
+        "presets": config.PRESETS,
+        "default_preset": config.DEFAULT_PRESET,
+        "default_settings": config.DEFAULT_SETTINGS,
+        "retries": config.XLSX_PARSER_NUM_RETRIES,
+        "speculative": config.XLSX_SPECULATIVE_TUNING,
+        "model": config.LLM_MODEL,
+        "scorer": [config.XLSX_LOCAL_SCORER, config.XLSX_LOCAL_ACCEPT_SCORE, config.XLSX_LOCAL_REJECT_SCORE],
+    }
+    h = hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False, default=repr).encode("utf-8"))
+    with open(prompts.__file__, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def sheet_key(digest: str, params: Dict, version: str = "") -> str:
+    """Ключ записи: отпечаток листа + исходные параметры тюнинга + версия конвейера."""
+    params_repr = json.dumps(params, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.sha256(f"{digest}\n{params_repr}\n{version}".encode("utf-8")).hexdigest()
+
+
+class SheetResultCache:
+    """
+    Итоговые отчеты листов между запусками: книги приходят повторно с правкой
+    одного листа, а неизмененные листы не нужно ни сегментировать, ни тюнить.
+    Одна запись — один JSON-файл {"preset", "report"} в каталоге кэша.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot read sheet cache {path}: {e}")
+            return None
+
+    def put(self, key: str, preset: Optional[str], report: Dict):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"preset": preset, "report": report}, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Cannot write sheet cache {path}: {e}")
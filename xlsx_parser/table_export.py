@@ -0,0 +1,106 @@
+import csv
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("TableExport")
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow не обязателен: без него выгрузка идет в CSV
+    pa = None
+
+_UNSAFE_RE = re.compile(r"[^\w\-]+")
+_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow", "csv": "csv"}
+
+
+def export_base(export_dir: str, sheet_title: str, cell_range: str) -> str:
+    """Путь выгрузки региона без расширения: <каталог книги>/<лист>_<диапазон>"""
+    name = _UNSAFE_RE.sub("_", f"{sheet_title}_{cell_range.replace(':', '-')}").strip("_")
+    return os.path.join(export_dir, name)
+
+
+class TableWriter:
+    """
+    Построчная выгрузка таблицы региона в колоночный файл.
+    Строки копятся пачками по batch_rows и сбрасываются в Parquet / Arrow IPC,
+    поэтому в памяти не лежит вся таблица. Без pyarrow — CSV.
+    Значения пишутся строками (в колонках Excel типы смешаны), пустые — null.
+    """
+
+    def __init__(self, path_base: str, columns: List[str], fmt: str = "parquet", batch_rows: int = 10000):
+        if fmt not in _EXTENSIONS:
+            raise ValueError(f"Unknown table export format: {fmt}")
+        if pa is None and fmt != "csv":
+            logger.warning("pyarrow is not installed, exporting tables as CSV")
+            fmt = "csv"
+        self.format = fmt
+        self.columns = columns
+        self.path = f"{path_base}.{_EXTENSIONS[fmt]}"
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._batch: List[List[Optional[str]]] = []
+        self._writer = None
+        self._file = None
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if fmt == "csv":
+            self._file = open(self.path, "w", encoding="utf-8", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(columns)
+        else:
+            self._schema = pa.schema([(name, pa.string()) for name in columns])
+
+    def write_row(self, values: List[Optional[str]]):
+        self.rows += 1
+        if self.format == "csv":
+            self._writer.writerow(["" if v is None else v for v in values])
+            return
+        self._batch.append(values)
+        if len(self._batch) >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        arrays = [pa.array([row[i] for row in self._batch], type=pa.string()) for i in range(len(self.columns))]
+        batch = pa.record_batch(arrays, schema=self._schema)
+        if self._writer is None:
+            if self.format == "parquet":
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            else:
+                self._file = pa.OSFile(self.path, "wb")
+                self._writer = pa_ipc.new_file(self._file, self._schema)
+        if self.format == "parquet":
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write(batch)
+        self._batch = []
+
+    def close(self) -> Optional[Dict]:
+        """Завершение файла; возвращает ссылку для манифеста или None, если ни одна строка не записана."""
+        if self.format != "csv":
+            self._flush()
+            if self._writer is not None:
+                self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        if not self.rows:
+            # Parquet / Arrow без пачек файл не создают; CSV из одного заголовка не нужен
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return None
+        return {"path": self.path, "format": self.format, "rows": self.rows, "columns": len(self.columns)}
+
+    def abort(self):
+        """Ошибка записи: недописанный файл удаляется."""
+        try:
+            if self._writer is not None:
+                self._writer.close()
+            if self._file is not None:
+                self._file.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)